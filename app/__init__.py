@@ -39,11 +39,21 @@ def create_app() -> Flask:  # noqa: D401
     app.permanent_session_lifetime = timedelta(hours=1)
 
     # Blueprint registrations (import locally to avoid circular refs)
-    from app.routes import main_bp, generate_bp, job_bp, auth_bp  # noqa: WPS433,E402
+    from app.routes import main_bp, generate_bp, job_bp, auth_bp, api_bp  # noqa: WPS433,E402
 
     app.register_blueprint(main_bp)
     app.register_blueprint(generate_bp)
     app.register_blueprint(job_bp)
     app.register_blueprint(auth_bp)
+    app.register_blueprint(api_bp)
+
+    # 学習ジョブのワーカーはリクエストを処理するプロセスで最初のリクエスト時に起動する
+    # (デバッグ時のリローダーの親プロセスではキューを処理しない)
+    from app.services.job_queue import job_queue  # noqa: WPS433,E402
+    from app.services.model_compression import start_model_compression  # noqa: WPS433,E402
+
+    app.before_request(job_queue.start)
+    # 圧縮前に保存されたモデルも同じく最初のリクエスト時から少しずつ圧縮し直す
+    app.before_request(start_model_compression)
 
     return app 
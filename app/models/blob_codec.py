@@ -0,0 +1,149 @@
+"""Compression codecs for stored model blobs.
+
+``model_data.codec`` records how each blob was stored, so rows written with
+different codecs (or before compression existed: ``NULL``, read as ``raw``)
+can be read side by side. ``MODEL_CODEC`` selects the codec for new writes; zlib is built in
+and further codecs can be added with :func:`register_codec`.
+
+Both directions work on chunks: a model can be compressed into a file
+while it is serialised, and a blob can be inflated straight from an SQLite
+blob handle, without first materialising the whole input.
+"""
+
+from __future__ import annotations
+
+import zlib
+from typing import IO, Any, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'RAW',
+    'register_codec',
+    'default_codec',
+    'compress_blob',
+    'compress_to_file',
+    'decompress_blob',
+    'decompress_chunks',
+]
+
+RAW = 'raw'
+
+# 圧縮してもこの割合までしか小さくならないなら無圧縮で保存する (展開の手間が割に合わない)
+_MIN_SAVING = 0.05
+
+
+class _Codec(NamedTuple):
+    # compress(chunk) / flush() を持つオブジェクトを返す (zlib.compressobj と同じ形)
+    compressor: Callable[[], Any]
+    # decompress(chunk) / flush() を持つオブジェクトを返す (zlib.decompressobj と同じ形)
+    decompressor: Callable[[], Any]
+
+
+class _Identity:
+    def compress(self, chunk: bytes) -> bytes:
+        return chunk
+
+    def decompress(self, chunk: bytes) -> bytes:
+        return chunk
+
+    def flush(self) -> bytes:
+        return b''
+
+
+_codecs: Dict[str, _Codec] = {
+    RAW: _Codec(_Identity, _Identity),
+    'zlib': _Codec(
+        lambda: zlib.compressobj(get_setting('MODEL_COMPRESS_LEVEL', 6, int)),
+        zlib.decompressobj,
+    ),
+}
+
+
+def register_codec(name: str, compressor: Callable[[], Any], decompressor: Callable[[], Any]) -> None:
+    """Make *name* usable as ``MODEL_CODEC`` and readable from ``model_data.codec``.
+
+    Both factories return incremental objects shaped like
+    ``zlib.compressobj()`` / ``zlib.decompressobj()``.
+    """
+    _codecs[name] = _Codec(compressor, decompressor)
+
+
+def _get(name: Optional[str]) -> _Codec:
+    if name is None:
+        name = RAW
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError(f'Unknown model codec: {name!r}') from None
+
+
+def default_codec() -> str:
+    """Codec new model blobs are written with (``MODEL_CODEC``)."""
+    name = get_setting('MODEL_CODEC', 'zlib')
+    _get(name)
+    return name
+
+
+def compress_blob(data: bytes, codec: Optional[str] = None) -> Tuple[str, bytes]:
+    """Encode *data* for storage; returns ``(codec, payload)``.
+
+    Falls back to ``raw`` when the codec saves less than 5 %.
+    """
+    codec = codec or default_codec()
+    if codec == RAW:
+        return RAW, bytes(data)
+    encoder = _get(codec).compressor()
+    payload = encoder.compress(data) + encoder.flush()
+    if not _worth_it(len(data), len(payload)):
+        return RAW, bytes(data)
+    return codec, payload
+
+
+def compress_to_file(
+    chunks: Callable[[], Iterable[bytes]],
+    out: IO[bytes],
+    codec: Optional[str] = None,
+) -> Tuple[str, int]:
+    """Streaming :func:`compress_blob`: write the pieces from ``chunks()`` encoded to *out*.
+
+    Returns the codec used and the uncompressed size. If compressing does
+    not pay off, *out* is rewritten with the raw data, which is why *chunks*
+    is a callable.
+    """
+    codec = codec or default_codec()
+    start = out.tell()
+    encoder = _get(codec).compressor()
+    raw_size = 0
+    for chunk in chunks():
+        raw_size += len(chunk)
+        out.write(encoder.compress(chunk))
+    out.write(encoder.flush())
+    if codec == RAW or _worth_it(raw_size, out.tell() - start):
+        return codec, raw_size
+    out.seek(start)
+    out.truncate()
+    for chunk in chunks():
+        out.write(chunk)
+    return RAW, raw_size
+
+
+def _worth_it(raw_size: int, stored_size: int) -> bool:
+    return stored_size <= raw_size * (1 - _MIN_SAVING)
+
+
+def decompress_chunks(codec: Optional[str], chunks: Iterable[bytes]) -> bytearray:
+    """Decode a blob delivered in pieces (e.g. read from an SQLite blob handle)."""
+    decoder = _get(codec).decompressor()
+    out = bytearray()
+    for chunk in chunks:
+        out += decoder.decompress(chunk)
+    out += decoder.flush()
+    return out
+
+
+def decompress_blob(codec: Optional[str], payload: bytes):
+    """Decode a whole stored blob."""
+    if codec is None or codec == RAW:
+        return payload
+    return decompress_chunks(codec, (payload,))
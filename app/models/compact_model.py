@@ -0,0 +1,548 @@
+"""Compact binary representation of trained Markov models.
+
+markovify の ``to_json()`` は状態・単語をすべて文字列のまま JSON に埋め込むため、
+読み込みのたびに巨大な JSON をパースする必要がある。ここでは語彙を整数 ID に
+置き換え、遷移表を ``array`` ベースの連続領域として保存する。
+
+Layout (all integers little-endian)::
+
+    header    MAGIC, version, state_size, vocab_count, state_count,
+              edge_count, vocab_bytes, check_bytes
+    vocab     UTF-8 tokens joined by '\\n', sorted (token id == rank)
+    keys      uint64 * state_count   (sorted, state ids packed base vocab_count)
+    offsets   uint32 * (state_count + 1)
+    next_ids  uint32 * edge_count
+    cumdist   uint32 * edge_count    (cumulative weights, restarting per state)
+    check     serialised OriginalityFilter used for the overlap check
+
+Version 2 stores the chain pre-compiled: ``cumdist`` holds the same running
+sums markovify builds in ``Chain.compile()`` / ``precompute_begin_state()``,
+so a loaded chain samples with a single bisect and never rebuilds weights.
+Version 3 replaces the retained corpus (UTF-8 rejoined text in versions 1
+and 2) with a hashed n-gram filter, see :mod:`app.models.originality`.
+Version 1 files (raw per-edge counts) and version 2 files are still readable.
+"""
+
+from __future__ import annotations
+
+import bisect
+import random
+import struct
+import sys
+from array import array
+from itertools import accumulate
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import markovify
+from markovify.chain import BEGIN, END
+from markovify.text import DEFAULT_MAX_OVERLAP_RATIO, DEFAULT_MAX_OVERLAP_TOTAL, DEFAULT_TRIES
+
+from app.models.originality import OriginalityFilter
+
+__all__ = [
+    'MAGIC',
+    'CompactChain',
+    'CompactText',
+    'CompactTextBuilder',
+    'is_compact',
+    'is_current',
+    'header_counts',
+    'model_counts',
+    'dump_model',
+    'dump_model_chunks',
+    'load_model',
+    'begin_words',
+]
+
+MAGIC = b'MKVC'
+FORMAT_VERSION = 3
+
+_HEADER = struct.Struct('<4sHHIIIIQ')
+_NEEDS_SWAP = sys.byteorder != 'little'
+
+ModelData = Union[str, bytes, bytearray, memoryview]
+
+
+def _typed_array(typecode: str, itemsize: int) -> array:
+    arr = array(typecode)
+    if arr.itemsize != itemsize:  # pragma: no cover – exotic platforms only
+        for alt in 'IL' if itemsize == 4 else 'LQ':
+            if array(alt).itemsize == itemsize:
+                return array(alt)
+        raise RuntimeError(f'No {itemsize}-byte array typecode available')
+    return arr
+
+
+def _u32() -> array:
+    return _typed_array('I', 4)
+
+
+def _u64() -> array:
+    return _typed_array('Q', 8)
+
+
+def _array_bytes(arr: array) -> Union[bytes, memoryview]:
+    if _NEEDS_SWAP:
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+        return arr.tobytes()
+    # リトルエンディアンならコピーせずにそのまま渡す
+    return memoryview(arr).cast('B')
+
+
+def _array_from(arr: array, buf: memoryview) -> array:
+    arr.frombytes(buf)
+    if _NEEDS_SWAP:
+        arr.byteswap()
+    return arr
+
+
+class CompactChain:
+    """Array-backed replacement for :class:`markovify.Chain`.
+
+    Only the parts of the ``Chain`` interface used by :class:`markovify.Text`
+    (``state_size``, ``move``, ``gen``, ``walk``) are implemented. The chain is
+    always compiled: ``cumdist`` holds per-state cumulative weights, and
+    sampling follows the same bisection as markovify, so the output
+    distribution is identical.
+    """
+
+    compiled = True
+
+    def __init__(
+        self,
+        state_size: int,
+        vocab: List[str],
+        keys: array,
+        offsets: array,
+        next_ids: array,
+        cumdist: array,
+    ):
+        self.state_size = state_size
+        self.vocab = vocab
+        self.keys = keys
+        self.offsets = offsets
+        self.next_ids = next_ids
+        self.cumdist = cumdist
+
+        self._base = len(vocab)
+        self._modulus = self._base ** (state_size - 1)
+        self.begin_id = self.token_id(BEGIN)
+        self.end_id = self.token_id(END)
+        self._begin_key = self._pack((self.begin_id,) * state_size)
+
+    # -------------------- id helpers --------------------
+    def token_id(self, token: str) -> int:
+        """Return the id of *token* (raises ``KeyError`` if unknown)."""
+        i = bisect.bisect_left(self.vocab, token)
+        if i == len(self.vocab) or self.vocab[i] != token:
+            raise KeyError(token)
+        return i
+
+    def _pack(self, ids: Sequence[int]) -> int:
+        key = 0
+        for i in ids:
+            key = key * self._base + i
+        return key
+
+    def _state_index(self, key: int) -> int:
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+        return i
+
+    def _state_key(self, state: Optional[Tuple[str, ...]]) -> int:
+        if not state:
+            return self._begin_key
+        return self._pack([self.token_id(t) for t in state])
+
+    def _unpack(self, key: int) -> Tuple[str, ...]:
+        ids = []
+        for _ in range(self.state_size):
+            key, i = divmod(key, self._base)
+            ids.append(i)
+        return tuple(self.vocab[i] for i in reversed(ids))
+
+    # -------------------- sampling --------------------
+    def _move_id(self, key: int, rng=random) -> int:
+        i = self._state_index(key)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        r = rng.random() * self.cumdist[hi - 1]
+        return self.next_ids[bisect.bisect(self.cumdist, r, lo, hi)]
+
+    def move(self, state: Tuple[str, ...]) -> str:
+        """Given a state, choose the next item at random."""
+        return self.vocab[self._move_id(self._state_key(state))]
+
+    def gen(self, init_state: Optional[Tuple[str, ...]] = None, rng: Optional[random.Random] = None) -> Iterator[str]:
+        """Yield successive tokens until the chain reaches the END state.
+
+        Sampling uses *rng* if given (for reproducible output), otherwise the
+        module-level generator like markovify.
+        """
+        rng = rng or random
+        key = self._state_key(init_state)
+        while True:
+            next_id = self._move_id(key, rng)
+            if next_id == self.end_id:
+                break
+            yield self.vocab[next_id]
+            key = (key % self._modulus) * self._base + next_id
+
+    def walk(self, init_state: Optional[Tuple[str, ...]] = None) -> List[str]:
+        """Return a list representing a single run of the chain."""
+        return list(self.gen(init_state))
+
+    def nbytes(self) -> int:
+        """Rough in-memory footprint (arrays + vocabulary strings) in bytes."""
+        arrays = (self.keys, self.offsets, self.next_ids, self.cumdist)
+        size = sum(arr.itemsize * len(arr) for arr in arrays)
+        # str オブジェクトのヘッダ (~50B) + リストのポインタ分を概算で加算
+        return size + sum(len(t) for t in self.vocab) * 2 + len(self.vocab) * 58
+
+    def begin_words(self) -> List[str]:
+        """Return the tokens that can start a sentence."""
+        i = self._state_index(self._begin_key)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return [self.vocab[n] for n in self.next_ids[lo:hi] if n != self.end_id]
+
+    def counts(self) -> Dict[Tuple[str, ...], Dict[str, int]]:
+        """Return the raw ``{state: {token: count}}`` mapping (inverse of :meth:`from_counts`)."""
+        model = {}
+        for i, key in enumerate(self.keys):
+            follow = {}
+            prev = 0
+            for j in range(self.offsets[i], self.offsets[i + 1]):
+                # cumdist は状態ごとの累積和なので差分が元の出現回数
+                follow[self.vocab[self.next_ids[j]]] = self.cumdist[j] - prev
+                prev = self.cumdist[j]
+            model[self._unpack(key)] = follow
+        return model
+
+    # -------------------- (de)serialisation --------------------
+    @classmethod
+    def from_counts(cls, state_size: int, model: dict) -> 'CompactChain':
+        """Build from a markovify ``{state: {token: count}}`` mapping."""
+        return cls._build(
+            state_size,
+            {state: (list(follow.keys()), accumulate(follow.values())) for state, follow in model.items()},
+        )
+
+    @classmethod
+    def _build(cls, state_size: int, model: dict) -> 'CompactChain':
+        """Build from a compiled ``{state: (choices, cumdist)}`` mapping."""
+        tokens = {BEGIN, END}
+        for state, (choices, _) in model.items():
+            tokens.update(state)
+            tokens.update(choices)
+        vocab = sorted(tokens)
+        base = len(vocab)
+        if base ** state_size > 2 ** 64:
+            raise ValueError('Vocabulary too large for the compact model format')
+        ids = {t: i for i, t in enumerate(vocab)}
+
+        packed = []
+        for state, follow in model.items():
+            key = 0
+            for t in state:
+                key = key * base + ids[t]
+            packed.append((key, follow))
+        packed.sort(key=lambda x: x[0])
+
+        keys, offsets, next_ids, cumdist = _u64(), _u32(), _u32(), _u32()
+        offsets.append(0)
+        for key, (choices, weights) in packed:
+            keys.append(key)
+            next_ids.extend(ids[token] for token in choices)
+            cumdist.extend(weights)
+            offsets.append(len(next_ids))
+        return cls(state_size, vocab, keys, offsets, next_ids, cumdist)
+
+    @classmethod
+    def from_markovify(cls, chain: markovify.Chain) -> 'CompactChain':
+        if chain.compiled:
+            # compiled chains already keep [choices, cumulative weights]
+            return cls._build(chain.state_size, chain.model)
+        return cls.from_counts(chain.state_size, chain.model)
+
+
+class CompactText(markovify.NewlineText):
+    """:class:`markovify.NewlineText` backed by a :class:`CompactChain`.
+
+    ``make_sentence_with_start`` is inherited unchanged. The overlap check
+    uses an :class:`OriginalityFilter` instead of the retained corpus;
+    models loaded from format version 1/2 still carry ``rejoined_text`` and
+    use markovify's substring check.
+    """
+
+    def __init__(
+        self,
+        chain: CompactChain,
+        rejoined_text: Optional[str] = None,
+        originality: Optional[OriginalityFilter] = None,
+    ):  # noqa: D107
+        self.state_size = chain.state_size
+        self.chain = chain
+        self.well_formed = True
+        self.originality = originality
+        self.retain_original = rejoined_text is not None
+        if rejoined_text is not None:
+            self.rejoined_text = rejoined_text
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        if self.originality is not None:
+            return self.originality.is_original(words, max_overlap_ratio, max_overlap_total)
+        return super().test_sentence_output(words, max_overlap_ratio, max_overlap_total)
+
+    def make_sentence(self, init_state=None, **kwargs):
+        """Same contract as :meth:`markovify.Text.make_sentence`."""
+        tries = kwargs.get('tries', DEFAULT_TRIES)
+        mor = kwargs.get('max_overlap_ratio', DEFAULT_MAX_OVERLAP_RATIO)
+        mot = kwargs.get('max_overlap_total', DEFAULT_MAX_OVERLAP_TOTAL)
+        test_output = kwargs.get('test_output', True) and (self.originality is not None or self.retain_original)
+        max_words = kwargs.get('max_words', None)
+        min_words = kwargs.get('min_words', None)
+
+        prefix = [] if init_state is None else [w for w in init_state if w != BEGIN]
+
+        for _ in range(tries):
+            words = prefix + self.chain.walk(init_state)
+            if (max_words is not None and len(words) > max_words) or (
+                min_words is not None and len(words) < min_words
+            ):
+                continue
+            if not test_output or self.test_sentence_output(words, mor, mot):
+                return self.word_join(words)
+        return None
+
+    def with_originality_filter(self) -> 'CompactText':
+        """Return a copy that uses an originality filter instead of the corpus."""
+        if self.originality is not None or not self.retain_original:
+            return self
+        # 文の区切りは失われているが、markovify の部分文字列判定も文をまたいで一致を見るので同等
+        originality = OriginalityFilter.from_runs([self.rejoined_text.split(' ')])
+        return CompactText(self.chain, originality=originality)
+
+    def nbytes(self) -> int:
+        """Rough in-memory footprint of the chain and overlap check data in bytes."""
+        check = len(self.rejoined_text) * 2 if self.retain_original else 0
+        if self.originality is not None:
+            check += self.originality.nbytes()
+        return self.chain.nbytes() + check
+
+    def to_bytes(self) -> bytes:
+        return b''.join(self.iter_bytes())
+
+    def iter_bytes(self) -> Iterator[Union[bytes, memoryview]]:
+        """Yield the serialised model section by section (see :func:`dump_model_chunks`)."""
+        chain = self.chain
+        vocab_blob = '\n'.join(chain.vocab).encode('utf-8')
+        originality = self.with_originality_filter().originality
+        check_blob = originality.to_bytes() if originality is not None else b''
+        header = _HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            chain.state_size,
+            len(chain.vocab),
+            len(chain.keys),
+            len(chain.next_ids),
+            len(vocab_blob),
+            len(check_blob),
+        )
+        yield header
+        yield vocab_blob
+        yield _array_bytes(chain.keys)
+        yield _array_bytes(chain.offsets)
+        yield _array_bytes(chain.next_ids)
+        yield _array_bytes(chain.cumdist)
+        yield check_blob
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, bytearray, memoryview]) -> 'CompactText':
+        buf = memoryview(data)
+        (
+            magic,
+            version,
+            state_size,
+            vocab_count,
+            state_count,
+            edge_count,
+            vocab_bytes,
+            check_bytes,
+        ) = _HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError('Not a compact model')
+        if version not in (1, 2, FORMAT_VERSION):
+            raise ValueError(f'Unsupported compact model version: {version}')
+
+        pos = _HEADER.size
+
+        def take(n: int) -> memoryview:
+            nonlocal pos
+            chunk = buf[pos:pos + n]
+            pos += n
+            return chunk
+
+        vocab = str(take(vocab_bytes), 'utf-8').split('\n') if vocab_count else []
+        keys = _array_from(_u64(), take(8 * state_count))
+        offsets = _array_from(_u32(), take(4 * (state_count + 1)))
+        next_ids = _array_from(_u32(), take(4 * edge_count))
+        cumdist = _array_from(_u32(), take(4 * edge_count))
+        check = take(check_bytes)
+
+        if version == 1:
+            cumdist = _compile_counts(offsets, cumdist)
+
+        chain = CompactChain(state_size, vocab, keys, offsets, next_ids, cumdist)
+        if version < 3:
+            return cls(chain, rejoined_text=str(check, 'utf-8') if check_bytes else None)
+        return cls(chain, originality=OriginalityFilter.from_bytes(check) if check_bytes else None)
+
+    @classmethod
+    def from_markovify(cls, text_model: markovify.Text) -> 'CompactText':
+        """Convert a markovify model; its corpus becomes an originality filter."""
+        chain = CompactChain.from_markovify(text_model.chain)
+        originality = None
+        if getattr(text_model, 'retain_original', False):
+            originality = OriginalityFilter.from_runs(text_model.parsed_sentences)
+        return cls(chain, originality=originality)
+
+
+class CompactTextBuilder:
+    """Accumulate transition counts run by run and build a :class:`CompactText`.
+
+    Counts are added the same way as ``markovify.Chain.build`` and every run is
+    added to the originality filter, so only the model itself (and never the
+    corpus) is held in memory while training. With *base* the counts and
+    filter of an existing model are extended (incremental training).
+    """
+
+    # 容量ヒントから Bloom filter の初期サイズを見積もるための 1 文あたりの窓数
+    _WINDOWS_PER_RUN = 16
+
+    def __init__(self, state_size: int = 2, base: Optional[CompactText] = None, expected_runs: int = 0):
+        if base is not None and base.state_size != state_size:
+            raise ValueError('Cannot extend a model with a different state size')
+        self.state_size = state_size
+        self.base = base
+        self.expected_runs = expected_runs
+        self.counts: Optional[dict] = None
+        self.originality: Optional[OriginalityFilter] = None
+        self.runs = 0
+
+    def _start(self) -> None:
+        # ベースモデルの展開は最初の文が来るまで遅らせる (新しい投稿がなければ不要)
+        if self.base is not None:
+            self.counts = self.base.chain.counts()
+            originality = self.base.with_originality_filter().originality
+            self.originality = originality.copy() if originality is not None else None
+        else:
+            self.counts = {}
+            self.originality = OriginalityFilter(capacity=self.expected_runs * self._WINDOWS_PER_RUN)
+
+    def add_run(self, run: List[str]) -> None:
+        """Add one sentence (list of words)."""
+        if self.counts is None:
+            self._start()
+        counts = self.counts
+        items = [BEGIN] * self.state_size + run + [END]
+        for i in range(len(run) + 1):
+            state = tuple(items[i:i + self.state_size])
+            follow = counts.get(state)
+            if follow is None:
+                follow = counts[state] = {}
+            token = items[i + self.state_size]
+            follow[token] = follow.get(token, 0) + 1
+        if self.originality is not None:
+            self.originality.add_run(run)
+        self.runs += 1
+
+    def add_runs(self, runs: Iterable[List[str]]) -> 'CompactTextBuilder':
+        for run in runs:
+            self.add_run(run)
+        return self
+
+    def build(self) -> CompactText:
+        """Return the model; raises ``ValueError`` if nothing was added.
+
+        With a base model and no new runs the base model itself is returned.
+        """
+        if not self.runs and self.base is not None:
+            return self.base
+        if not self.counts:
+            raise ValueError('No sentences to build a model from')
+        chain = CompactChain.from_counts(self.state_size, self.counts)
+        return CompactText(chain, originality=self.originality)
+
+
+def _compile_counts(offsets: array, counts: array) -> array:
+    """Turn version 1 per-edge counts into per-state cumulative weights."""
+    cumdist = _u32()
+    for lo, hi in zip(offsets, offsets[1:]):
+        cumdist.extend(accumulate(counts[lo:hi]))
+    return cumdist
+
+
+def is_compact(data: ModelData) -> bool:
+    """Return True if *data* is a serialised :class:`CompactText`."""
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def header_counts(data: ModelData) -> Tuple[int, int]:
+    """Return ``(vocab_count, state_count)`` read from a compact model header."""
+    if not is_compact(data):
+        raise ValueError('Not a compact model')
+    header = _HEADER.unpack_from(data)
+    return header[3], header[4]
+
+
+def model_counts(text_model: markovify.Text) -> Tuple[int, int]:
+    """Return ``(vocab_count, state_count)`` for a loaded model."""
+    chain = text_model.chain
+    if isinstance(chain, CompactChain):
+        return len(chain.vocab), len(chain.keys)
+    tokens = set()
+    for state, follow in chain.model.items():
+        tokens.update(state)
+        tokens.update(follow[0] if chain.compiled else follow)
+    return len(tokens), len(chain.model)
+
+
+def is_current(data: ModelData) -> bool:
+    """Return True if *data* is already in the latest compact format version."""
+    return is_compact(data) and _HEADER.unpack_from(data)[1] == FORMAT_VERSION
+
+
+def dump_model(text_model: markovify.Text) -> bytes:
+    """Serialise a markovify model to the compact binary format."""
+    return b''.join(dump_model_chunks(text_model))
+
+
+def dump_model_chunks(text_model: markovify.Text) -> Iterator[Union[bytes, memoryview]]:
+    """Like :func:`dump_model`, but yield the pieces instead of joining them.
+
+    The large arrays are passed as views of the loaded model, so writing
+    the model out needs no second copy of it in memory.
+    """
+    if not isinstance(text_model, CompactText):
+        text_model = CompactText.from_markovify(text_model)
+    return text_model.iter_bytes()
+
+
+def load_model(data: ModelData) -> markovify.Text:
+    """Load a model stored either in the compact format or as markovify JSON."""
+    if is_compact(data):
+        return CompactText.from_bytes(data)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode('utf-8')
+    return markovify.Text.from_json(data)
+
+
+def begin_words(text_model: markovify.Text) -> List[str]:
+    """Return the words that may start a sentence for any supported model."""
+    chain = text_model.chain
+    if isinstance(chain, CompactChain):
+        return chain.begin_words()
+    follow = chain.model[(BEGIN,) * chain.state_size]
+    words: Iterable[str] = follow[0] if chain.compiled else follow.keys()
+    return [w for w in words if w != END]
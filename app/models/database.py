@@ -1,75 +1,170 @@
+"""SQLite connections of the application.
+
+The database runs in WAL mode (set once by ``init-db.py`` /
+``migrate-db.py``; the mode is stored in the file), where readers never
+wait for the writer and the writer never waits for readers. To make use of
+that within one process:
+
+* reads check a connection out of a small pool (:func:`read_connection`,
+  at most ``DB_READ_POOL_SIZE``), so a generate request reading a model
+  blob never queues behind another thread's statement, and the connections
+  outlive the per-request threads of the development server;
+* all writes go through one dedicated writer connection
+  (:func:`write_transaction`), serialised by a lock in this process and by
+  ``BEGIN IMMEDIATE`` across processes.
+
+Connections are checked without a query: a connection opened by another
+process (after ``fork``) or before :func:`close_db` is simply replaced.
+PRAGMAs can be tuned with ``DB_MMAP_SIZE``, ``DB_CACHE_SIZE`` and
+``DB_SYNCHRONOUS``.
+"""
+
+import atexit
 import os
 import sqlite3
 import threading
-import atexit
-from app.utils.helpers import dict_factory
+import weakref
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from app.utils.helpers import dict_factory, get_setting
 
 __all__ = [
-    'db',
-    'get_db',
-    'get_db_connection',
+    'read_connection',
+    'write_transaction',
     'close_db',
 ]
 
 _db_path = os.environ.get('DB_PATH', 'markov.db')
-_db_lock = threading.Lock()
-
-# Single global connection reused across the app (equivalent to previous implementation)
-db = sqlite3.connect(_db_path, check_same_thread=False, timeout=30.0)
-# Return rows as dicts
-# The helper comes from app.utils.helpers
-db.row_factory = dict_factory
-
-# WALモードを有効にして同時アクセス時のパフォーマンスを改善
-try:
-    db.execute("PRAGMA journal_mode=WAL")
-    db.execute("PRAGMA synchronous=NORMAL")
-    db.execute("PRAGMA cache_size=10000")
-    db.execute("PRAGMA temp_store=MEMORY")
-except Exception as e:
-    print(f"[WARNING] Failed to set SQLite optimizations: {e}")
-
-def get_db():
-    """Return the shared SQLite connection used by the application."""
-    return db
-
-def get_db_connection():
-    """Get a thread-safe database connection."""
-    global db
-    with _db_lock:
+
+# 読み出し用はプールから貸し出し、書き込み用は 1 本だけ
+_pool_lock = threading.Lock()
+_pool_pid = 0
+_idle: List['_Connection'] = []
+_read_slots = None
+_write_lock = threading.Lock()
+_writer = None
+# close_db() で全部閉じるための一覧 (スレッド終了で消えた接続は自動で外れる)
+_connections = weakref.WeakSet()
+# close_db() のたびに増やし、古い接続を使い回さないようにする
+_generation = 0
+
+
+class _Connection(sqlite3.Connection):
+    """Connection remembering which process / generation opened it."""
+
+    pid = 0
+    generation = 0
+
+    def usable(self) -> bool:
+        return self.pid == os.getpid() and self.generation == _generation
+
+
+def _connect(read_only: bool) -> _Connection:
+    conn = sqlite3.connect(
+        _db_path,
+        timeout=30.0,
+        # 書き込み用は複数のスレッドから (ロックを取って) 使い、close_db() は別スレッドから閉じる
+        check_same_thread=False,
+        # トランザクションは write_transaction() で明示的に張る
+        isolation_level=None,
+        factory=_Connection,
+    )
+    conn.row_factory = dict_factory
+    conn.pid = os.getpid()
+    conn.generation = _generation
+    try:
+        conn.execute(f"PRAGMA synchronous={get_setting('DB_SYNCHRONOUS', 'NORMAL')}")
+        conn.execute(f"PRAGMA cache_size={get_setting('DB_CACHE_SIZE', 10000, int)}")
+        conn.execute(f"PRAGMA mmap_size={get_setting('DB_MMAP_SIZE', 256 * 1024 * 1024, int)}")
+        conn.execute('PRAGMA temp_store=MEMORY')
+        if read_only:
+            conn.execute('PRAGMA query_only=1')
+    except sqlite3.Error as e:
+        print(f"[WARNING] Failed to set SQLite optimizations: {e}")
+    _connections.add(conn)
+    return conn
+
+
+def _reader_slots() -> threading.BoundedSemaphore:
+    """Semaphore bounding this process' read connections (reset after ``fork``)."""
+    global _pool_pid, _read_slots
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # 親プロセスで貸し出し中だった分を引き継がないよう作り直す
+            _pool_pid = os.getpid()
+            _idle.clear()
+            _read_slots = threading.BoundedSemaphore(max(get_setting('DB_READ_POOL_SIZE', 8, int), 1))
+        return _read_slots
+
+
+@contextmanager
+def read_connection() -> Iterator[sqlite3.Connection]:
+    """Check a read-only connection out of the pool for the block.
+
+    Waits while ``DB_READ_POOL_SIZE`` connections are in use. Each statement
+    runs in autocommit mode and sees the latest committed data; use
+    :func:`write_transaction` for anything that writes. Do not keep the
+    connection (or its cursors) after the block.
+    """
+    slots = _reader_slots()
+    slots.acquire()
+    try:
+        with _pool_lock:
+            conn = _idle.pop() if _idle else None
+        if conn is None or not conn.usable():
+            conn = _connect(read_only=True)
         try:
-            # 接続が有効かチェック
-            db.execute("SELECT 1")
-            return db
-        except (sqlite3.OperationalError, sqlite3.InterfaceError):
-            # 接続が無効な場合は再接続
-            try:
-                db.close()
-            except:
-                pass
-            db = sqlite3.connect(_db_path, check_same_thread=False, timeout=30.0)
-            db.row_factory = dict_factory
-            
-            # WALモードを再設定
+            yield conn
+        finally:
+            # close_db() で閉じられた接続は戻さない
+            if conn.usable():
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                with _pool_lock:
+                    _idle.append(conn)
+    finally:
+        slots.release()
+
+
+@contextmanager
+def write_transaction() -> Iterator[sqlite3.Connection]:
+    """Run a write transaction on the writer connection.
+
+    Commits when the block ends and rolls back if it raises. Reads inside
+    the block see the transaction's own changes, so read-then-write
+    sequences (e.g. claiming a queued job) are atomic across threads and
+    processes.
+    """
+    global _writer
+    with _write_lock:
+        if _writer is None or not _writer.usable():
+            _writer = _connect(read_only=False)
+        conn = _writer
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def close_db():
+    """Close every connection of this process (they are reopened on next use)."""
+    global _writer, _generation
+    with _write_lock:
+        _generation += 1
+        _writer = None
+        with _pool_lock:
+            _idle.clear()
+        for conn in list(_connections):
             try:
-                db.execute("PRAGMA journal_mode=WAL")
-                db.execute("PRAGMA synchronous=NORMAL")
-                db.execute("PRAGMA cache_size=10000")
-                db.execute("PRAGMA temp_store=MEMORY")
+                conn.close()
             except Exception as e:
-                print(f"[WARNING] Failed to set SQLite optimizations on reconnect: {e}")
-            
-            return db
+                print(f"[WARNING] Error closing database: {e}")
+    print("[INFO] Database connection closed")
 
-def close_db():
-    """Close the database connection."""
-    global db
-    try:
-        if db:
-            db.close()
-            print("[INFO] Database connection closed")
-    except Exception as e:
-        print(f"[WARNING] Error closing database: {e}")
 
 # アプリケーション終了時にデータベース接続を閉じる
-atexit.register(close_db) 
+atexit.register(close_db)
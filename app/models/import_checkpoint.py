@@ -0,0 +1,107 @@
+"""On-disk checkpoints of running imports.
+
+A training job periodically saves how far it got: the importer's pagination
+cursor and counters plus the partially built model (in the compact model
+format, so counts and originality filter are kept). If the job dies, the next
+job for the same account with the same import settings resumes from there
+instead of fetching everything again.
+
+One file per account is kept in ``IMPORT_CHECKPOINT_DIR``. Files are written
+to a temporary name and moved into place with ``os.replace`` so a crash while
+saving never leaves a half-written checkpoint behind.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'save_checkpoint',
+    'load_checkpoint',
+    'delete_checkpoint',
+]
+
+MAGIC = b'MKCP'
+# magic, length of the JSON metadata that follows; the model data comes last
+_HEADER = struct.Struct('<4sI')
+
+
+def _checkpoint_dir() -> str:
+    db_path = os.environ.get('DB_PATH', 'markov.db')
+    return get_setting('IMPORT_CHECKPOINT_DIR', os.path.join(os.path.dirname(db_path), 'checkpoints'))
+
+
+def _checkpoint_path(acct: str) -> str:
+    # acct はファイル名に使えない文字を含むのでハッシュにする
+    name = hashlib.blake2b(acct.encode('utf-8'), digest_size=16).hexdigest()
+    return os.path.join(_checkpoint_dir(), f'{name}.ckpt')
+
+
+def save_checkpoint(acct: str, meta: Dict[str, Any], model_data: bytes) -> None:
+    """Atomically replace the checkpoint of *acct*."""
+    directory = _checkpoint_dir()
+    os.makedirs(directory, exist_ok=True)
+    meta_bytes = json.dumps(dict(meta, acct=acct, saved_at=time.time())).encode('utf-8')
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, len(meta_bytes)))
+            f.write(meta_bytes)
+            f.write(model_data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, _checkpoint_path(acct))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_checkpoint(acct: str) -> Optional[Tuple[Dict[str, Any], bytes]]:
+    """Return ``(meta, model_data)`` for *acct*, or ``None``.
+
+    Unreadable checkpoints and ones older than ``IMPORT_CHECKPOINT_MAX_AGE``
+    seconds are removed.
+    """
+    path = _checkpoint_path(acct)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        magic, meta_len = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not an import checkpoint')
+        start = _HEADER.size
+        meta = json.loads(data[start:start + meta_len].decode('utf-8'))
+        model_data = data[start + meta_len:]
+    except (struct.error, ValueError) as e:
+        print(f"[WARNING] Discarding broken import checkpoint for {acct}: {e!r}")
+        delete_checkpoint(acct)
+        return None
+
+    max_age = get_setting('IMPORT_CHECKPOINT_MAX_AGE', 24 * 60 * 60, float)
+    if meta.get('acct') != acct or time.time() - meta.get('saved_at', 0) > max_age:
+        delete_checkpoint(acct)
+        return None
+    return meta, model_data
+
+
+def delete_checkpoint(acct: str) -> None:
+    try:
+        os.remove(_checkpoint_path(acct))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,222 @@
+"""Backends for the progress / result status of training jobs.
+
+A status is a small JSON-compatible dict (``completed``, ``progress``,
+``progress_str``, ``error``, ``result`` ...). Entries expire on their own:
+``JOB_STATUS_TTL`` seconds after the write that completed the job, or a day
+after the last write for a job that never completed (its process died).
+
+``JOB_STATUS_BACKEND`` selects where they live:
+
+* ``sqlite`` (default) keeps them in the ``job_status`` table so every
+  server process (e.g. gunicorn workers) sees every job, and a job process
+  can write its progress directly;
+* ``memory`` keeps them in a dict of the current process, for running a
+  single process without touching the DB on every progress update.
+
+Partial updates are applied atomically (a single ``UPDATE`` with
+``json_patch`` for SQLite), so concurrent writers of different fields never
+lose each other's changes.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.models.database import read_connection, write_transaction
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'JobStatusStore',
+    'MemoryJobStatusStore',
+    'SQLiteJobStatusStore',
+    'create_job_status_store',
+]
+
+# 完了しないまま更新が途絶えたジョブ (プロセスが落ちた等) を保持する時間
+_ACTIVE_TTL = 24 * 60 * 60
+
+
+class JobStatusStore(ABC):
+    """Status of each job by job ID.
+
+    Reads return a copy, so changing the returned dict has no effect; use
+    :meth:`update` to change single fields. *on_change* is called with the
+    job ID after every write.
+    """
+
+    #: True if other processes see the same entries
+    shared = False
+
+    def __init__(self, on_change: Callable[[str], Any] = None):
+        self.ttl = get_setting('JOB_STATUS_TTL', 60 * 60, float)
+        self._on_change = on_change
+
+    def _expires_at(self, status: Dict[str, Any], now: float) -> float:
+        return now + (self.ttl if status.get('completed') else _ACTIVE_TTL)
+
+    def _changed(self, job_id: str) -> None:
+        if self._on_change is not None:
+            self._on_change(job_id)
+
+    @abstractmethod
+    def get(self, job_id: str, default: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Return the status of *job_id* (*default* if unknown or expired)."""
+
+    @abstractmethod
+    def set(self, job_id: str, status: Dict[str, Any]) -> None:
+        """Replace the status of *job_id*."""
+
+    @abstractmethod
+    def update(self, job_id: str, **fields: Any) -> bool:
+        """Atomically change some fields of an existing status; False if there is none.
+
+        A field set to ``None`` reads back as missing (``status.get()`` still
+        returns ``None``).
+        """
+
+    @abstractmethod
+    def pop(self, job_id: str, default: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Remove the status of *job_id* and return it."""
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """Delete expired entries; returns how many were deleted."""
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.get(job_id) is not None
+
+    def __getitem__(self, job_id: str) -> Dict[str, Any]:
+        status = self.get(job_id)
+        if status is None:
+            raise KeyError(job_id)
+        return status
+
+    def __setitem__(self, job_id: str, status: Dict[str, Any]) -> None:
+        self.set(job_id, status)
+
+
+class MemoryJobStatusStore(JobStatusStore):
+    """Statuses in a dict of this process (not visible to other processes)."""
+
+    def __init__(self, on_change: Callable[[str], Any] = None):
+        super().__init__(on_change)
+        self._entries: Dict[str, Tuple[Dict[str, Any], float]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, job_id: str, now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(job_id)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._entries[job_id]
+            return None
+        return entry[0]
+
+    def get(self, job_id, default=None):
+        with self._lock:
+            status = self._live(job_id, time.time())
+            return dict(status) if status is not None else default
+
+    def set(self, job_id, status):
+        now = time.time()
+        with self._lock:
+            self._entries[job_id] = (dict(status), self._expires_at(status, now))
+        self._changed(job_id)
+
+    def update(self, job_id, **fields):
+        now = time.time()
+        with self._lock:
+            status = self._live(job_id, now)
+            if status is None:
+                return False
+            status.update(fields)
+            self._entries[job_id] = (status, self._expires_at(status, now))
+        self._changed(job_id)
+        return True
+
+    def pop(self, job_id, default=None):
+        with self._lock:
+            status = self._live(job_id, time.time())
+            self._entries.pop(job_id, None)
+        return status if status is not None else default
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for job_id in expired:
+                del self._entries[job_id]
+        return len(expired)
+
+
+class SQLiteJobStatusStore(JobStatusStore):
+    """Statuses in the ``job_status`` table, shared by all processes using the DB."""
+
+    shared = True
+
+    def get(self, job_id, default=None):
+        with read_connection() as db:
+            row = db.execute(
+                'SELECT status FROM job_status WHERE job_id = ? AND expires_at > ?',
+                (job_id, time.time()),
+            ).fetchone()
+        return json.loads(row['status']) if row else default
+
+    def set(self, job_id, status):
+        now = time.time()
+        with write_transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO job_status(job_id, status, updated_at, expires_at) VALUES (?, ?, ?, ?)',
+                (job_id, json.dumps(status, ensure_ascii=False), now, self._expires_at(status, now)),
+            )
+        self._changed(job_id)
+
+    def update(self, job_id, **fields):
+        now = time.time()
+        patch = json.dumps(fields, ensure_ascii=False)
+        # 読み出しと書き込みを 1 文で行うので、他のプロセスの更新と混ざらない
+        with write_transaction() as db:
+            cur = db.execute(
+                'UPDATE job_status SET status = json_patch(status, :patch), updated_at = :now, '
+                'expires_at = :now + CASE WHEN json_extract(json_patch(status, :patch), \'$.completed\') '
+                'THEN :ttl ELSE :active_ttl END '
+                'WHERE job_id = :job_id AND expires_at > :now',
+                dict(patch=patch, now=now, ttl=self.ttl, active_ttl=_ACTIVE_TTL, job_id=job_id),
+            )
+        if not cur.rowcount:
+            return False
+        self._changed(job_id)
+        return True
+
+    def pop(self, job_id, default=None):
+        with write_transaction() as db:
+            row = db.execute(
+                'DELETE FROM job_status WHERE job_id = ? RETURNING status, expires_at',
+                (job_id,),
+            ).fetchone()
+        if row is None or row['expires_at'] <= time.time():
+            return default
+        return json.loads(row['status'])
+
+    def purge_expired(self):
+        with write_transaction() as db:
+            cur = db.execute('DELETE FROM job_status WHERE expires_at <= ?', (time.time(),))
+        return cur.rowcount
+
+
+_BACKENDS = {
+    'memory': MemoryJobStatusStore,
+    'sqlite': SQLiteJobStatusStore,
+}
+
+
+def create_job_status_store(on_change: Callable[[str], Any] = None) -> JobStatusStore:
+    """Create the backend selected by ``JOB_STATUS_BACKEND``."""
+    name = get_setting('JOB_STATUS_BACKEND', 'sqlite').lower()
+    if name not in _BACKENDS:
+        raise ValueError(f'Unknown JOB_STATUS_BACKEND: {name!r} (expected one of {", ".join(_BACKENDS)})')
+    return _BACKENDS[name](on_change)
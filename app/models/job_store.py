@@ -0,0 +1,151 @@
+"""Persistence of the training job queue.
+
+Jobs are rows of ``job_queue`` ordered by their autoincrement ``id`` (FIFO).
+A job moves ``queued`` -> ``running`` -> ``done`` / ``failed`` /
+``cancelled``. The payload (session data and access token) is only kept
+until the job finishes. Jobs submitted with the same ``dedup_key`` while
+one is still queued or running are merged into that one (a unique index
+over unfinished jobs backs this up). Running jobs are touched periodically
+(``heartbeat_at``) so jobs of a process that died can be put back into the
+queue at their original position.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from app.models.database import read_connection, write_transaction
+
+__all__ = [
+    'enqueue_job',
+    'claim_next_job',
+    'finish_job',
+    'cancel_queued_job',
+    'get_job_state',
+    'get_job_acct',
+    'queue_position',
+    'touch_jobs',
+    'requeue_stale_jobs',
+    'purge_finished_jobs',
+]
+
+
+def enqueue_job(job_id: str, kind: str, acct: str, payload: Dict[str, Any], dedup_key: Optional[str] = None) -> str:
+    """Append a job to the end of the queue and return its ID.
+
+    If a queued or running job has the same *dedup_key*, nothing is added
+    and that job's ID is returned instead.
+    """
+    with write_transaction() as db:
+        if dedup_key is not None:
+            row = db.execute(
+                "SELECT job_id FROM job_queue WHERE dedup_key = ? AND state IN ('queued', 'running')",
+                (dedup_key,),
+            ).fetchone()
+            if row is not None:
+                return row['job_id']
+        db.execute(
+            'INSERT INTO job_queue(job_id, kind, acct, payload, state, enqueued_at, dedup_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, acct, json.dumps(payload, default=str), 'queued', time.time(), dedup_key),
+        )
+    return job_id
+
+
+def claim_next_job() -> Optional[Dict[str, Any]]:
+    """Mark the oldest queued job as running and return it (``None`` if the queue is empty)."""
+    with write_transaction() as db:
+        # 書き込みトランザクション内なので、他のプロセスに同じジョブを取られることはない
+        row = db.execute(
+            "SELECT id, job_id, kind, acct, payload FROM job_queue WHERE state = 'queued' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        db.execute(
+            "UPDATE job_queue SET state = 'running', started_at = ?, heartbeat_at = ? WHERE id = ?",
+            (now, now, row['id']),
+        )
+    return dict(job_id=row['job_id'], kind=row['kind'], acct=row['acct'], payload=json.loads(row['payload']))
+
+
+def finish_job(job_id: str, state: str) -> None:
+    """Record the final state of a job and drop its payload."""
+    with write_transaction() as db:
+        db.execute(
+            'UPDATE job_queue SET state = ?, finished_at = ?, payload = NULL WHERE job_id = ?',
+            (state, time.time(), job_id),
+        )
+
+
+def cancel_queued_job(job_id: str) -> bool:
+    """Cancel a job that has not started yet; returns False if it is not queued."""
+    with write_transaction() as db:
+        cur = db.execute(
+            "UPDATE job_queue SET state = 'cancelled', finished_at = ?, payload = NULL WHERE job_id = ? AND state = 'queued'",
+            (time.time(), job_id),
+        )
+        return cur.rowcount > 0
+
+
+def get_job_state(job_id: str) -> Optional[str]:
+    with read_connection() as db:
+        row = db.execute('SELECT state FROM job_queue WHERE job_id = ?', (job_id,)).fetchone()
+    return row['state'] if row else None
+
+
+def get_job_acct(job_id: str) -> Optional[str]:
+    """Account that submitted *job_id* (``None`` if the job is unknown)."""
+    with read_connection() as db:
+        row = db.execute('SELECT acct FROM job_queue WHERE job_id = ?', (job_id,)).fetchone()
+    return row['acct'] if row else None
+
+
+def queue_position(job_id: str) -> Optional[int]:
+    """1-based position of a queued job (``None`` if it is not waiting)."""
+    with read_connection() as db:
+        row = db.execute(
+            "SELECT COUNT(*) AS position FROM job_queue WHERE state = 'queued' "
+            "AND id <= (SELECT id FROM job_queue WHERE job_id = ? AND state = 'queued')",
+            (job_id,),
+        ).fetchone()
+    return row['position'] or None
+
+
+def touch_jobs(job_ids: Iterable[str]) -> None:
+    """Refresh the heartbeat of running jobs owned by this process."""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return
+    with write_transaction() as db:
+        db.executemany(
+            "UPDATE job_queue SET heartbeat_at = ? WHERE job_id = ? AND state = 'running'",
+            ((time.time(), job_id) for job_id in job_ids),
+        )
+
+
+def requeue_stale_jobs(max_age: float) -> List[str]:
+    """Put running jobs without a heartbeat for *max_age* seconds back into the queue."""
+    with write_transaction() as db:
+        rows = db.execute(
+            "SELECT job_id FROM job_queue WHERE state = 'running' AND heartbeat_at < ?",
+            (time.time() - max_age,),
+        ).fetchall()
+        if not rows:
+            return []
+        # id はそのままなので、元の順番で再開される
+        db.executemany(
+            "UPDATE job_queue SET state = 'queued', started_at = NULL, heartbeat_at = NULL WHERE job_id = ?",
+            ((row['job_id'],) for row in rows),
+        )
+    return [row['job_id'] for row in rows]
+
+
+def purge_finished_jobs(max_age: float) -> None:
+    """Delete finished jobs older than *max_age* seconds."""
+    with write_transaction() as db:
+        db.execute(
+            "DELETE FROM job_queue WHERE state IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+            (time.time() - max_age,),
+        )
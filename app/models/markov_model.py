@@ -3,9 +3,20 @@ import MeCab
 import markovify
 import config
 import gc
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from app.models.compact_model import CompactText, CompactTextBuilder
+from app.models.token_cache import TokenCache
+from app.utils.helpers import get_setting
 
 __all__ = [
     'create_markov_model_by_multiline',
+    'mecab_fingerprint',
+    'open_token_cache',
+    'tokenize_lines',
 ]
 
 def _build_mecab_options() -> list[str]:
@@ -22,35 +33,213 @@ def _build_mecab_options() -> list[str]:
     return options
 
 
-def create_markov_model_by_multiline(lines: list[str]):
-    """Generate a Markov model (state_size=2) from a list of text lines."""
+class _SentenceParser(markovify.NewlineText):
+    """Only the corpus parsing half of :class:`markovify.NewlineText`.
+
+    ``generate_corpus`` (sentence split, ``test_sentence_input`` filter and
+    word split) is reused as is so streamed training sees exactly the runs
+    markovify would have built from the joined text.
+    """
+
+    def __init__(self):  # noqa: D107
+        self.well_formed = True
+
+
+class _Tokenizer:
+    """One MeCab tagger plus markovify's sentence parsing; returns runs per line."""
+
+    def __init__(self, mecab_options: list[str]):
+        self.tagger = MeCab.Tagger(' '.join(mecab_options))
+        self.parser = _SentenceParser()
+
+    def __call__(self, lines: list[str]) -> list[list[list[str]]]:
+        return [list(self.parser.generate_corpus(self.tagger.parse(line))) for line in lines]
+
+
+# ワーカープロセスごとに 1 つだけ持つ Tokenizer
+_worker_tokenizer = None
+
+
+def _init_worker(mecab_options: list[str]) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = _Tokenizer(mecab_options)
+
+
+def _tokenize_chunk(lines: list[str]) -> list[list[list[str]]]:
+    return _worker_tokenizer(lines)
+
+
+def _chunked(lines: Iterable, size: int) -> Iterator:
+    chunk: list[str] = []
+    for line in lines:
+        if not isinstance(line, str):
+            # マーカーはそれまでの行のチャンクを閉じてから単独で流す
+            if chunk:
+                yield chunk
+                chunk = []
+            yield line
+            continue
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def mecab_fingerprint(mecab_options: list[str] = None) -> str:
+    """Identify the tokenizer: MeCab options plus the loaded dictionaries."""
+    mecab_options = mecab_options if mecab_options is not None else _build_mecab_options()
+    parts = [' '.join(mecab_options)]
+    tagger = MeCab.Tagger(' '.join(mecab_options))
+    info = tagger.dictionary_info()
+    while info:
+        try:
+            mtime = os.stat(info.filename).st_mtime_ns
+        except OSError:
+            mtime = 0
+        parts.append(f'{info.filename}:{info.size}:{info.version}:{mtime}')
+        info = info.next
+    return '|'.join(parts)
+
 
-    # MeCab 形態素解析
+def open_token_cache() -> Optional[TokenCache]:
+    """Open the tokenization cache, or return ``None`` if it is disabled."""
+    max_bytes = get_setting('TOKEN_CACHE_MAX_BYTES', 512 * 1024 * 1024, int)
+    if max_bytes <= 0:
+        return None
+    return TokenCache(TokenCache.default_path(), mecab_fingerprint(), max_bytes)
+
+
+class _Chunk:
+    """Lines of one chunk with their cache hits and the pending MeCab result for the misses."""
+
+    __slots__ = ('lines', 'keys', 'hits', 'misses', 'future')
+
+    def __init__(self, lines, keys, hits, misses, future):
+        self.lines = lines
+        self.keys = keys
+        self.hits = hits
+        self.misses = misses
+        self.future = future
+
+
+def tokenize_lines(lines: Iterable, workers: int = None, cache: TokenCache = None) -> Iterator:
+    """MeCab-tokenize *lines* and yield runs (lists of words) in input order.
+
+    Items of *lines* that are not strings (markers) are yielded unchanged,
+    right after the runs of every line before them.
+
+    Lines are processed in chunks of ``TOKENIZE_CHUNK_LINES``. Each chunk is
+    first looked up in *cache* in bulk; only the misses are tokenized and
+    then stored back in bulk. Misses are tokenized in this process until
+    ``TOKENIZE_PARALLEL_MIN_LINES`` lines have needed MeCab; after that, with
+    more than one worker (``TOKENIZE_WORKERS``, default: 2) they go to a
+    process pool with at most two chunks per worker in flight, so the input
+    (usually an importer still fetching pages) is consumed lazily. Small
+    imports thus never pay for starting the pool, and each training job
+    adds at most ``TOKENIZE_WORKERS`` processes.
+    """
+    if workers is None:
+        workers = get_setting('TOKENIZE_WORKERS', min(2, os.cpu_count() or 1), int)
+    chunk_size = get_setting('TOKENIZE_CHUNK_LINES', 500, int)
+    min_parallel_lines = get_setting('TOKENIZE_PARALLEL_MIN_LINES', 20000, int)
     mecab_options = _build_mecab_options()
-    parsed_text: list[str] = []
-    
+
+    pool = None
+    local = None
+    # MeCab に渡した行数 (キャッシュにあった行は数えない)
+    tokenized_lines = 0
+
+    def start_pool() -> ProcessPoolExecutor:
+        # fork は学習スレッド以外のスレッドの状態まで複製してしまうので避ける
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(method),
+            initializer=_init_worker,
+            initargs=(mecab_options,),
+        )
+
+    def submit(chunk: list[str]) -> _Chunk:
+        nonlocal pool, local, tokenized_lines
+        keys = [cache.key(line) for line in chunk] if cache is not None else None
+        hits = cache.get_many(keys) if cache is not None else {}
+        misses = [i for i in range(len(chunk)) if keys is None or keys[i] not in hits]
+        miss_lines = [chunk[i] for i in misses]
+        if pool is None and workers > 1 and tokenized_lines >= min_parallel_lines:
+            # 大きな取り込みだけプロセスプールに切り替える (起動に 1 秒以上かかる)
+            pool = start_pool()
+            local = None
+        tokenized_lines += len(miss_lines)
+        if not miss_lines:
+            future = None
+        elif pool is not None:
+            future = pool.submit(_tokenize_chunk, miss_lines)
+        else:
+            if local is None:
+                local = _Tokenizer(mecab_options)
+            future = Future()
+            future.set_result(local(miss_lines))
+        return _Chunk(chunk, keys, hits, misses, future)
+
+    def collect(item) -> Iterator:
+        if not isinstance(item, _Chunk):
+            yield item
+            return
+        tokenized = dict(zip(item.misses, item.future.result())) if item.future is not None else {}
+        if cache is not None and tokenized:
+            cache.put_many([(item.keys[i], runs) for i, runs in tokenized.items()])
+        for i in range(len(item.lines)):
+            yield from tokenized[i] if i in tokenized else item.hits[item.keys[i]]
+
+    pending = deque()
     try:
-        tagger = MeCab.Tagger(' '.join(mecab_options))
-        
-        for line in lines:
-            parsed_text.append(tagger.parse(line))
-            
+        for chunk in _chunked(lines, chunk_size):
+            pending.append(submit(chunk) if isinstance(chunk, list) else chunk)
+            if len(pending) >= (workers * 2 if pool is not None else 1):
+                yield from collect(pending.popleft())
+        while pending:
+            yield from collect(pending.popleft())
     finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
         # MeCab Tagger のリソースを明示的に解放
-        if 'tagger' in locals():
-            del tagger
-        # ガベージコレクションを強制実行
+        local = None
         gc.collect()
 
+
+def create_markov_model_by_multiline(
+    lines: Iterable,
+    base: CompactText = None,
+    expected_runs: int = 0,
+    token_cache: TokenCache = None,
+):
+    """Generate a Markov model (state_size=2) from text lines.
+
+    *lines* may be any iterable (typically an importer generator): each line
+    is tokenized and counted as it arrives, so the corpus is never held in
+    memory. If *base* is given (incremental training) the new lines are
+    added to it. *expected_runs* is a size hint for the originality filter.
+    Lines found in *token_cache* skip MeCab.
+
+    Callables in *lines* are not tokenized: each is called with the builder
+    once every line before it has been counted (used for checkpoints).
+    """
+    builder = CompactTextBuilder(state_size=2, base=base, expected_runs=expected_runs)
+    for item in tokenize_lines(lines, cache=token_cache):
+        if isinstance(item, list):
+            builder.add_run(item)
+        else:
+            item(builder)
+
     # モデル作成
     try:
-        text_model = markovify.NewlineText('\n'.join(parsed_text), state_size=2)
-    except Exception:
+        return builder.build()
+    except ValueError:
         # 上位でキャッチして適切にハンドリングする想定
         raise Exception('<meta name="viewport" content="width=device-width">モデル作成に失敗しました。学習に必要な投稿数が不足している可能性があります。', 500)
     finally:
-        # 大きなリストを明示的に解放
-        del parsed_text
+        # 大きな辞書を明示的に解放
+        del builder
         gc.collect()
-
-    return text_model 
@@ -0,0 +1,310 @@
+"""Persistence of trained models.
+
+Model metadata (permission flag, size, version, counts) lives in the small
+``model_meta`` table so permission checks and cache lookups never touch the
+``model_data`` blob. The blob is only read on a model cache miss; it is
+stored compressed (``model_data.codec``, see :mod:`app.models.blob_codec`)
+and inflated while it is read from the blob handle. ``model_data`` rows are
+keyed by model version: a retrained model is first written to a row of its
+own in small chunks and then switched to by updating ``model_meta``, so
+readers keep the previous model until that moment.
+The sentence-start word index is kept in ``model_start_index`` so failed
+``startswith`` lookups never need the chain at all.
+``model_import_state`` remembers the newest imported post so the next
+training run can fetch only newer posts and merge them into the model.
+"""
+
+from __future__ import annotations
+
+import os
+import tempfile
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import markovify
+
+from app.models.blob_codec import RAW, compress_to_file, decompress_chunks
+from app.models.compact_model import begin_words, dump_model_chunks, model_counts
+from app.models.database import read_connection, write_transaction
+from app.models.start_index import StartWordIndex
+
+__all__ = [
+    'get_model_meta',
+    'get_model_data',
+    'get_start_index_data',
+    'get_import_state',
+    'get_model_storage',
+    'save_model',
+    'recompress_model',
+    'set_allow_generate_by_other',
+    'delete_model',
+]
+
+# blob ハンドルから一度に読んで展開する量 / 1 トランザクションで書き込む量
+_READ_CHUNK = 1024 * 1024
+_WRITE_CHUNK = 1024 * 1024
+# 保存するモデルをメモリ上に置く上限 (超えたら一時ファイルに書き出す)
+_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+# どのモデルからも参照されていない行は、書き込み途中の可能性があるのでこの秒数は残す
+_ORPHAN_MAX_AGE = 24 * 60 * 60
+
+
+def get_model_meta(acct: str) -> Optional[Dict[str, Any]]:
+    """Return the metadata row for *acct* (without the model blob)."""
+    with read_connection() as db:
+        return db.execute(
+            'SELECT acct, allow_generate_by_other, byte_size, version, created_at, vocab_count, state_count '
+            'FROM model_meta WHERE acct = ?',
+            (acct,),
+        ).fetchone()
+
+
+def get_model_data(acct: str):
+    """Return the serialised (decompressed) model for *acct* (``None`` if missing)."""
+    return _read_blob(
+        'SELECT d.rowid, d.codec FROM model_meta m JOIN model_data d ON d.version = m.version WHERE m.acct = ?',
+        (acct,),
+    )
+
+
+def _read_blob(query: str, args: tuple):
+    """Decompressed blob of the ``model_data`` row selected by *query* (``rowid``, ``codec``)."""
+    with read_connection() as db:
+        # rowid を引いてから blob を開くまでに保存し直されないよう、同じスナップショットで読む
+        db.execute('BEGIN')
+        try:
+            row = db.execute(query, args).fetchone()
+            if row is None:
+                return None
+            if row['codec'] is None or row['codec'] == RAW:
+                return db.execute('SELECT data FROM model_data WHERE rowid = ?', (row['rowid'],)).fetchone()['data']
+            with db.blobopen('model_data', 'data', row['rowid'], readonly=True) as blob:
+                return decompress_chunks(row['codec'], iter(lambda: blob.read(_READ_CHUNK), b''))
+        finally:
+            db.execute('COMMIT')
+
+
+def get_start_index_data(acct: str):
+    """Return the serialised start word index for *acct* (``None`` if missing)."""
+    with read_connection() as db:
+        row = db.execute('SELECT data FROM model_start_index WHERE acct = ?', (acct,)).fetchone()
+    return row['data'] if row else None
+
+
+def get_import_state(acct: str) -> Optional[Dict[str, Any]]:
+    """Return the import state (newest post id, visibility, post count) saved with the model."""
+    with read_connection() as db:
+        return db.execute(
+            'SELECT acct, newest_id, import_visibility, post_count, updated_at FROM model_import_state WHERE acct = ?',
+            (acct,),
+        ).fetchone()
+
+
+def get_model_storage(pending_for: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Stored vs. uncompressed size of every model.
+
+    With *pending_for* only models that still need converting to that codec
+    are returned: rows saved before compression existed, and rows in
+    another codec (``raw`` rows stay, as they did not compress well).
+    """
+    query = (
+        'SELECT d.acct, d.codec, length(d.data) AS stored_size, m.byte_size, m.version '
+        'FROM model_meta m JOIN model_data d ON d.version = m.version'
+    )
+    args: tuple = ()
+    if pending_for is not None:
+        query += ' WHERE d.codec IS NULL OR d.codec NOT IN (?, ?)'
+        args = (pending_for, RAW)
+    with read_connection() as db:
+        return db.execute(query + ' ORDER BY m.byte_size', args).fetchall()
+
+
+def save_model(
+    acct: str,
+    text_model: markovify.Text,
+    allow_generate_by_other: bool,
+    import_state: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Serialise and store *text_model*, replacing any previous model.
+
+    *import_state* (``newest_id``, ``import_visibility``, ``post_count``)
+    enables incremental training next time; without it any previous state is
+    dropped. Returns the new model version.
+
+    The model is serialised and compressed into a spooled temporary file
+    and copied into a new ``model_data`` row chunk by chunk. Only the final
+    switch of ``model_meta`` to the new version needs a longer write
+    transaction than one chunk, and it does not depend on the model size.
+    """
+    start_index = StartWordIndex.build(begin_words(text_model)).to_bytes()
+    vocab_count, state_count = model_counts(text_model)
+    version = uuid.uuid4().hex
+    now = time.time()
+
+    with tempfile.SpooledTemporaryFile(_SPOOL_MAX_MEMORY) as spool:
+        codec, byte_size = compress_to_file(lambda: dump_model_chunks(text_model), spool)
+        _stage_blob(acct, version, codec, now, spool)
+
+    with write_transaction() as db:
+        cur = db.cursor()
+        try:
+            cur.execute('SELECT version FROM model_meta WHERE acct = ?', (acct,))
+            previous = cur.fetchone()
+            cur.execute(
+                'INSERT INTO model_start_index(acct, data) VALUES (?, ?) '
+                'ON CONFLICT(acct) DO UPDATE SET data = excluded.data',
+                (acct, start_index),
+            )
+            cur.execute(
+                'INSERT INTO model_meta(acct, allow_generate_by_other, byte_size, version, created_at, vocab_count, state_count) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(acct) DO UPDATE SET allow_generate_by_other = excluded.allow_generate_by_other, '
+                'byte_size = excluded.byte_size, version = excluded.version, created_at = excluded.created_at, '
+                'vocab_count = excluded.vocab_count, state_count = excluded.state_count',
+                (acct, int(allow_generate_by_other), byte_size, version, now, vocab_count, state_count),
+            )
+            cur.execute('DELETE FROM model_import_state WHERE acct = ?', (acct,))
+            if import_state is not None and import_state.get('newest_id') is not None:
+                cur.execute(
+                    'INSERT INTO model_import_state(acct, newest_id, import_visibility, post_count, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (
+                        acct,
+                        str(import_state['newest_id']),
+                        import_state['import_visibility'],
+                        import_state['post_count'],
+                        time.time(),
+                    ),
+                )
+        finally:
+            cur.close()
+
+    _drop_unused_blobs(previous['version'] if previous else None)
+    return version
+
+
+def _stage_blob(acct: str, version: str, codec: str, created_at: float, src) -> None:
+    """Copy the file *src* into a new ``model_data`` row for *version*.
+
+    No ``model_meta`` row points at it yet, so readers do not see it; each
+    chunk is its own short write transaction.
+    """
+    size = src.seek(0, os.SEEK_END)
+    with write_transaction() as db:
+        rowid = db.execute(
+            'INSERT INTO model_data(version, acct, created_at, codec, data) VALUES (?, ?, ?, ?, zeroblob(?))',
+            (version, acct, created_at, codec, size),
+        ).lastrowid
+    _copy_into_blob(rowid, src)
+
+
+def _copy_into_blob(rowid: int, src) -> None:
+    """Write the file *src* into the (already sized) blob of ``model_data`` row *rowid*."""
+    src.seek(0)
+    offset = 0
+    while True:
+        chunk = src.read(_WRITE_CHUNK)
+        if not chunk:
+            break
+        with write_transaction() as db:
+            with db.blobopen('model_data', 'data', rowid) as blob:
+                blob.seek(offset)
+                blob.write(chunk)
+        offset += len(chunk)
+
+
+def _drop_unused_blobs(previous_version: Optional[str]) -> None:
+    """Delete the replaced model blob and rows left behind by failed saves."""
+    with write_transaction() as db:
+        db.execute(
+            'DELETE FROM model_data WHERE version = ? '
+            'OR (created_at < ? AND version NOT IN (SELECT version FROM model_meta))',
+            (previous_version, time.time() - _ORPHAN_MAX_AGE),
+        )
+
+
+def recompress_model(acct: str, version: str, codec: str) -> Optional[Tuple[str, int]]:
+    """Store the blob of model *version* of *acct* again with *codec*.
+
+    The model content does not change, but like a retrained model it is
+    written to a row of its own in small chunks and switched to under a new
+    version. The new row is claimed before any work is done, so of several
+    processes converting the same model only one does it. Returns the codec
+    actually used and the stored size, or ``None`` if the model was
+    retrained, deleted or converted by another process meanwhile.
+    """
+    # 同じ変換には同じバージョンを使い、その行の INSERT を変換の予約にする
+    new_version = uuid.uuid5(uuid.NAMESPACE_OID, f'{version}:{codec}').hex
+    with write_transaction() as db:
+        current = db.execute(
+            'SELECT d.codec FROM model_meta m JOIN model_data d ON d.version = m.version WHERE m.acct = ? AND m.version = ?',
+            (acct, version),
+        ).fetchone()
+        if current is None or current['codec'] == codec:
+            return None
+        # 予約したまま落ちたプロセスの行は _drop_unused_blobs が _ORPHAN_MAX_AGE 後に消す
+        cur = db.execute(
+            'INSERT OR IGNORE INTO model_data(version, acct, created_at, codec, data) VALUES (?, ?, ?, ?, zeroblob(0))',
+            (new_version, acct, time.time(), codec),
+        )
+        if not cur.rowcount:
+            return None
+        rowid = cur.lastrowid
+
+    try:
+        data = _read_blob('SELECT rowid, codec FROM model_data WHERE version = ?', (version,))
+        if data is None:
+            switched = False
+        else:
+            if isinstance(data, str):
+                # markovify JSON のまま残っているモデル
+                data = data.encode('utf-8')
+            with tempfile.SpooledTemporaryFile(_SPOOL_MAX_MEMORY) as spool:
+                used, _ = compress_to_file(lambda: (data,), spool, codec)
+                stored_size = spool.seek(0, os.SEEK_END)
+                with write_transaction() as db:
+                    db.execute('UPDATE model_data SET codec = ?, data = zeroblob(?) WHERE rowid = ?', (used, stored_size, rowid))
+                _copy_into_blob(rowid, spool)
+            with write_transaction() as db:
+                cur = db.execute('UPDATE model_meta SET version = ? WHERE acct = ? AND version = ?', (new_version, acct, version))
+                switched = cur.rowcount > 0
+    except BaseException:
+        _drop_blob(new_version)
+        raise
+    if not switched:
+        # 変換中に学習し直された / 削除された
+        _drop_blob(new_version)
+        return None
+    _drop_unused_blobs(version)
+    return used, stored_size
+
+
+def _drop_blob(version: str) -> None:
+    with write_transaction() as db:
+        db.execute('DELETE FROM model_data WHERE version = ?', (version,))
+
+
+def set_allow_generate_by_other(acct: str, allow_generate_by_other: bool) -> None:
+    """Update only the permission flag of an existing model."""
+    with write_transaction() as db:
+        db.execute(
+            'UPDATE model_meta SET allow_generate_by_other = ? WHERE acct = ?',
+            (int(allow_generate_by_other), acct),
+        )
+
+
+def delete_model(acct: str) -> bool:
+    """Delete the model for *acct*; returns False if there was none."""
+    with write_transaction() as db:
+        cur = db.cursor()
+        try:
+            cur.execute('DELETE FROM model_meta WHERE acct = ?', (acct,))
+            deleted = cur.rowcount > 0
+            cur.execute('DELETE FROM model_data WHERE acct = ?', (acct,))
+            deleted = deleted or cur.rowcount > 0
+            cur.execute('DELETE FROM model_start_index WHERE acct = ?', (acct,))
+            cur.execute('DELETE FROM model_import_state WHERE acct = ?', (acct,))
+        finally:
+            cur.close()
+    return deleted
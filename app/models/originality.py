@@ -0,0 +1,210 @@
+"""Originality check based on hashed word n-gram windows.
+
+markovify rejects a generated sentence when any run of ``overlap_max + 1``
+consecutive words (``overlap_max = min(15, round(0.7 * len(words)))``) occurs
+in the training corpus, which it finds with substring scans over the whole
+re-joined corpus kept inside the model. Here every corpus window of 4 to 6
+words is hashed into a (scalable) Bloom filter at training time instead, so
+the corpus no longer has to be stored and a check costs a few hash probes per
+window.
+
+* Windows shorter than 4 words need no lookup: with ``state_size=2`` every
+  three consecutive generated words were observed together in the corpus, so
+  such sentences are always rejected (as markovify does).
+* Longer windows count as seen when all of their 6-word sub-windows are.
+  Storing every length up to 16 would make the filter larger than the corpus
+  it replaces; the approximation can only reject more, never accept a copy.
+
+Matching is word-exact and per corpus sentence, whereas markovify's substring
+scan also matches partial words and across sentence boundaries. Bloom filter
+false positives likewise only ever reject an original sentence.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+import struct
+from typing import Iterable, List, Sequence, Union
+
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'MIN_WINDOW',
+    'MAX_WINDOW',
+    'OriginalityFilter',
+]
+
+MAGIC = b'MKOF'
+FORMAT_VERSION = 1
+
+MIN_WINDOW = 4
+MAX_WINDOW = 6
+
+_HEADER = struct.Struct('<4sHdI')
+_SEGMENT = struct.Struct('<QIQQ')
+
+# 新しいセグメントを追加するたびに容量は倍、誤判定率は半分にする (scalable Bloom filter)
+_GROWTH = 2
+_TIGHTENING = 0.5
+
+
+def _window_hash(words: Sequence[str]) -> int:
+    return int.from_bytes(hashlib.blake2b(' '.join(words).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def count_windows(lengths: Iterable[int]) -> int:
+    """Upper bound of the number of windows stored for runs of the given lengths."""
+    total = 0
+    for n in lengths:
+        for size in range(MIN_WINDOW, min(n, MAX_WINDOW) + 1):
+            total += n - size + 1
+    return total
+
+
+class _Segment:
+    __slots__ = ('bits', 'num_bits', 'num_hashes', 'capacity', 'count')
+
+    def __init__(self, num_bits: int, num_hashes: int, capacity: int, count: int = 0, bits: bytearray = None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.capacity = capacity
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, fp_rate: float) -> '_Segment':
+        capacity = max(capacity, 1024)
+        num_bits = max(8, math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes, capacity)
+
+    def add(self, h: int) -> bool:
+        """Set the bits for *h*; returns False if they were all set already."""
+        bits = self.bits
+        m = self.num_bits
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        new = False
+        for _ in range(self.num_hashes):
+            pos = h1 % m
+            byte = bits[pos >> 3]
+            bit = 1 << (pos & 7)
+            if not byte & bit:
+                bits[pos >> 3] = byte | bit
+                new = True
+            h1 += h2
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, h: int) -> bool:
+        bits = self.bits
+        m = self.num_bits
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        for _ in range(self.num_hashes):
+            pos = h1 % m
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+            h1 += h2
+        return True
+
+
+class OriginalityFilter:
+    """Scalable Bloom filter of hashed corpus word windows."""
+
+    def __init__(self, fp_rate: float = None, capacity: int = 0, segments: List[_Segment] = None):
+        self.fp_rate = fp_rate if fp_rate is not None else get_setting('ORIGINALITY_FP_RATE', 0.01, float)
+        if segments is not None:
+            self.segments = segments
+        else:
+            self.segments = [_Segment.for_capacity(capacity, self.fp_rate * (1 - _TIGHTENING))]
+
+    # -------------------- building --------------------
+    @classmethod
+    def from_runs(cls, runs: Sequence[Sequence[str]], fp_rate: float = None) -> 'OriginalityFilter':
+        """Build a filter sized for *runs* (a re-iterable list of word lists)."""
+        inst = cls(fp_rate, count_windows(len(run) for run in runs))
+        for run in runs:
+            inst.add_run(run)
+        return inst
+
+    def _add_hash(self, h: int) -> None:
+        # 重複は最新セグメントへの test-and-set で判定する (古いセグメントは見ない)
+        segment = self.segments[-1]
+        if segment.count >= segment.capacity:
+            fp = self.fp_rate * (1 - _TIGHTENING) * _TIGHTENING ** len(self.segments)
+            segment = _Segment.for_capacity(segment.capacity * _GROWTH, fp)
+            self.segments.append(segment)
+        segment.add(h)
+
+    def add_run(self, words: Sequence[str]) -> None:
+        """Add every window of MIN_WINDOW..MAX_WINDOW words of one run."""
+        n = len(words)
+        for start in range(n - MIN_WINDOW + 1):
+            for size in range(MIN_WINDOW, min(MAX_WINDOW, n - start) + 1):
+                self._add_hash(_window_hash(words[start:start + size]))
+
+    def copy(self) -> 'OriginalityFilter':
+        segments = [
+            _Segment(seg.num_bits, seg.num_hashes, seg.capacity, seg.count, bytearray(seg.bits))
+            for seg in self.segments
+        ]
+        return OriginalityFilter(self.fp_rate, segments=segments)
+
+    # -------------------- checking --------------------
+    def __contains__(self, h: int) -> bool:
+        return any(h in segment for segment in self.segments)
+
+    def _window_seen(self, window: Sequence[str]) -> bool:
+        if len(window) < MIN_WINDOW:
+            return True
+        if len(window) <= MAX_WINDOW:
+            return _window_hash(window) in self
+        # 保存していない長さの窓は、含まれる全ての最大長窓が既出なら既出とみなす
+        return all(
+            _window_hash(window[i:i + MAX_WINDOW]) in self
+            for i in range(len(window) - MAX_WINDOW + 1)
+        )
+
+    def is_original(self, words: Sequence[str], max_overlap_ratio: float, max_overlap_total: int) -> bool:
+        """Equivalent of ``markovify.Text.test_sentence_output``."""
+        overlap_ratio = round(max_overlap_ratio * len(words))
+        overlap_max = min(max_overlap_total, overlap_ratio)
+        overlap_over = overlap_max + 1
+        gram_count = max((len(words) - overlap_max), 1)
+        for i in range(gram_count):
+            if self._window_seen(words[i:i + overlap_over]):
+                return False
+        return True
+
+    def nbytes(self) -> int:
+        return sum(len(segment.bits) for segment in self.segments)
+
+    # -------------------- (de)serialisation --------------------
+    def to_bytes(self) -> bytes:
+        parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, self.fp_rate, len(self.segments))]
+        for segment in self.segments:
+            parts.append(_SEGMENT.pack(segment.num_bits, segment.num_hashes, segment.capacity, segment.count))
+            parts.append(bytes(segment.bits))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, bytearray, memoryview]) -> 'OriginalityFilter':
+        buf = memoryview(data)
+        magic, version, fp_rate, segment_count = _HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError('Not an originality filter')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported originality filter version: {version}')
+
+        pos = _HEADER.size
+        segments = []
+        for _ in range(segment_count):
+            num_bits, num_hashes, capacity, count = _SEGMENT.unpack_from(buf, pos)
+            pos += _SEGMENT.size
+            size = (num_bits + 7) // 8
+            segments.append(_Segment(num_bits, num_hashes, capacity, count, bytearray(buf[pos:pos + size])))
+            pos += size
+        return cls(fp_rate, segments=segments)
@@ -0,0 +1,165 @@
+"""Sentence-start word index stored next to each trained model.
+
+``make_sentence_with_start`` fails with a ``KeyError`` deep inside the chain
+when the requested word never starts a sentence, and building "did you mean"
+suggestions used to require decoding the whole chain. This index answers both
+questions from a small separate blob:
+
+* exact / prefix lookups via a sorted word list (``bisect``)
+* fuzzy lookups via a character n-gram inverted index; only words sharing
+  n-grams with the query are scored with ``Levenshtein.ratio``
+
+Layout (all integers little-endian)::
+
+    header    MAGIC, version, word_count, gram_count, posting_count,
+              words_bytes, grams_bytes
+    words     UTF-8 words joined by '\\n', sorted
+    grams     UTF-8 n-grams joined by '\\n'
+    offsets   uint32 * (gram_count + 1)
+    postings  uint32 * posting_count   (word indices per n-gram)
+"""
+
+from __future__ import annotations
+
+import bisect
+import re
+import struct
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Union
+
+import Levenshtein as levsh
+
+from app.models.compact_model import _array_bytes, _array_from, _u32
+
+__all__ = [
+    'StartWordIndex',
+]
+
+MAGIC = b'MKSI'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<4sHIIIII')
+
+# 曖昧検索で Levenshtein 距離を計算する候補数の上限
+_MAX_FUZZY_CANDIDATES = 200
+
+
+def _grams(word: str) -> set:
+    """Character unigrams plus boundary-padded bigrams of *word*."""
+    padded = f'\x02{word}\x03'
+    return set(word) | {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+class StartWordIndex:
+    """Sorted list of sentence-start words with an n-gram index for suggestions."""
+
+    def __init__(self, words: List[str], grams: List[str], offsets: array, postings: array):
+        self.words = words
+        self.grams = grams
+        self.offsets = offsets
+        self.postings = postings
+        self._gram_ids: Dict[str, int] = {g: i for i, g in enumerate(grams)}
+
+    @classmethod
+    def build(cls, words: Iterable[str]) -> 'StartWordIndex':
+        """Build the index from the words that may start a sentence."""
+        words = sorted(set(w for w in words if w and '\n' not in w))
+        inverted: Dict[str, List[int]] = {}
+        for i, word in enumerate(words):
+            for gram in _grams(word):
+                inverted.setdefault(gram, []).append(i)
+
+        grams = sorted(g for g in inverted if '\n' not in g)
+        offsets, postings = _u32(), _u32()
+        offsets.append(0)
+        for gram in grams:
+            postings.extend(inverted[gram])
+            offsets.append(len(postings))
+        return cls(words, grams, offsets, postings)
+
+    # -------------------- lookups --------------------
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __contains__(self, word: str) -> bool:
+        i = bisect.bisect_left(self.words, word)
+        return i < len(self.words) and self.words[i] == word
+
+    def can_start(self, beginning: str) -> bool:
+        """Return False if a sentence can certainly not begin with *beginning*.
+
+        Only single-word beginnings can be decided from the index; longer ones
+        name an arbitrary chain state and are left to the generator.
+        """
+        split = re.split(r'\s+', beginning.strip())
+        if len(split) != 1:
+            return True
+        return split[0] in self
+
+    def prefix(self, prefix: str, limit: int = 10) -> List[str]:
+        """Return up to *limit* words starting with *prefix*."""
+        result = []
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and len(result) < limit and self.words[i].startswith(prefix):
+            result.append(self.words[i])
+            i += 1
+        return result
+
+    def suggest(self, query: str, limit: int = 5) -> List[str]:
+        """Return the words closest to *query* (prefix matches first)."""
+        # 前方一致は二分探索で先に取り、足りない分だけ n-gram で探す
+        result = self.prefix(query, limit) if query else []
+        if len(result) >= limit:
+            return result
+
+        shared: Counter = Counter()
+        for gram in _grams(query):
+            gram_id = self._gram_ids.get(gram)
+            if gram_id is None:
+                continue
+            shared.update(self.postings[self.offsets[gram_id]:self.offsets[gram_id + 1]])
+
+        found = set(result)
+        candidates = [self.words[i] for i, _ in shared.most_common(_MAX_FUZZY_CANDIDATES) if self.words[i] not in found]
+        candidates.sort(key=lambda w: levsh.ratio(query, w), reverse=True)
+        return result + candidates[:limit - len(result)]
+
+    def nbytes(self) -> int:
+        """Rough in-memory footprint in bytes."""
+        strings = sum(len(w) * 2 + 58 for w in self.words) + sum(len(g) * 2 + 58 + 100 for g in self.grams)
+        return strings + self.offsets.itemsize * len(self.offsets) + self.postings.itemsize * len(self.postings)
+
+    # -------------------- (de)serialisation --------------------
+    def to_bytes(self) -> bytes:
+        words_blob = '\n'.join(self.words).encode('utf-8')
+        grams_blob = '\n'.join(self.grams).encode('utf-8')
+        header = _HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            len(self.words),
+            len(self.grams),
+            len(self.postings),
+            len(words_blob),
+            len(grams_blob),
+        )
+        return b''.join((header, words_blob, grams_blob, _array_bytes(self.offsets), _array_bytes(self.postings)))
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, bytearray, memoryview]) -> 'StartWordIndex':
+        buf = memoryview(data)
+        magic, version, word_count, gram_count, posting_count, words_bytes, grams_bytes = _HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError('Not a start word index')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported start word index version: {version}')
+
+        pos = _HEADER.size
+        words = str(buf[pos:pos + words_bytes], 'utf-8').split('\n') if word_count else []
+        pos += words_bytes
+        grams = str(buf[pos:pos + grams_bytes], 'utf-8').split('\n') if gram_count else []
+        pos += grams_bytes
+        offsets = _array_from(_u32(), buf[pos:pos + 4 * (gram_count + 1)])
+        pos += 4 * (gram_count + 1)
+        postings = _array_from(_u32(), buf[pos:pos + 4 * posting_count])
+        return cls(words, grams, offsets, postings)
@@ -0,0 +1,162 @@
+"""On-disk cache of MeCab tokenization results.
+
+Users retrain often and most of their posts were already tokenized by the
+previous run. Results are stored in a separate SQLite file, keyed by a hash
+of the tokenizer fingerprint (MeCab options + dictionary) and the line, so
+identical lines skip MeCab entirely. When the fingerprint changes (e.g. a
+dictionary update) the whole cache is dropped on open.
+
+Values are the runs produced for a line, encoded as words joined by ``' '``
+and runs joined by ``'\\n'`` (words never contain whitespace).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Sequence
+
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'TokenCache',
+]
+
+Runs = List[List[str]]
+
+# 上限を超えたらこの割合まで古いものから削除する
+_EVICT_TARGET = 0.9
+_EVICT_BATCH = 1000
+
+
+def _encode(runs: Runs) -> str:
+    return '\n'.join(' '.join(run) for run in runs)
+
+
+def _decode(value: str) -> Runs:
+    if not value:
+        return []
+    return [run.split(' ') for run in value.split('\n')]
+
+
+class TokenCache:
+    """Content-addressed ``line -> runs`` cache bounded by total value size.
+
+    One instance (and SQLite connection) is meant to be used by a single
+    training job; ``hits`` / ``misses`` count that job's lookups.
+    """
+
+    def __init__(self, path: str, fingerprint: str, max_bytes: int):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self._salt = fingerprint.encode('utf-8') + b'\0'
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db = sqlite3.connect(path, timeout=30.0)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS token_cache '
+            '(key BLOB NOT NULL PRIMARY KEY, runs TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS token_cache_accessed ON token_cache(accessed)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS token_cache_meta (name TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL)')
+        self._check_fingerprint()
+        self._total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM token_cache').fetchone()[0]
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def _check_fingerprint(self) -> None:
+        row = self.db.execute("SELECT value FROM token_cache_meta WHERE name = 'fingerprint'").fetchone()
+        if row is not None and row[0] == self.fingerprint:
+            return
+        # 辞書やオプションが変わったら古い結果は二度と使われないので消してしまう
+        with self.db:
+            self.db.execute('DELETE FROM token_cache')
+            self.db.execute(
+                "INSERT OR REPLACE INTO token_cache_meta(name, value) VALUES ('fingerprint', ?)",
+                (self.fingerprint,),
+            )
+
+    def key(self, line: str) -> bytes:
+        return hashlib.blake2b(self._salt + line.encode('utf-8'), digest_size=16).digest()
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, Runs]:
+        """Return the cached runs for the given keys (missing keys are left out)."""
+        if not keys:
+            return {}
+        unique = list(set(keys))
+        found: Dict[bytes, Runs] = {}
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            marks = ','.join('?' * len(batch))
+            for key, runs in self.db.execute(f'SELECT key, runs FROM token_cache WHERE key IN ({marks})', batch):
+                found[key] = _decode(runs)
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany('UPDATE token_cache SET accessed = ? WHERE key = ?', ((now, k) for k in found))
+
+        hits = sum(1 for k in keys if k in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, items: Sequence[tuple]) -> None:
+        """Store ``(key, runs)`` pairs and evict old entries if over budget."""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, runs in items:
+            value = _encode(runs)
+            rows.append((key, value, len(value), now))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO token_cache(key, runs, size, accessed) VALUES (?, ?, ?, ?)', rows)
+        self._total += sum(row[2] for row in rows)
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        # 他のジョブも書き込むので、実際の合計を取り直してから削除する
+        self._total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM token_cache').fetchone()[0]
+        target = self.max_bytes * _EVICT_TARGET
+        while self._total > target:
+            rows = self.db.execute(
+                'SELECT key, size FROM token_cache ORDER BY accessed LIMIT ?', (_EVICT_BATCH,)
+            ).fetchall()
+            if not rows:
+                break
+            with self.db:
+                self.db.executemany('DELETE FROM token_cache WHERE key = ?', ((k,) for k, _ in rows))
+            self._total -= sum(size for _, size in rows)
+            self.evictions += len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'bytes': self._total,
+            'max_bytes': self.max_bytes,
+        }
+
+    def close(self) -> None:
+        try:
+            self.db.close()
+        except sqlite3.Error:
+            pass
+
+    @staticmethod
+    def default_path() -> str:
+        """``token-cache.db`` next to the main database unless configured."""
+        db_path = os.environ.get('DB_PATH', 'markov.db')
+        return get_setting('TOKEN_CACHE_PATH', os.path.join(os.path.dirname(db_path), 'token-cache.db'))
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import time
+
+from flask import Blueprint, jsonify, request, session
+
+from app.models.model_store import get_model_meta
+from app.services.generator import REJECT_DEAD_END, GenerationResult, can_generate, default_budget_ms, generate_sentence, load_text_model, load_start_index
+
+api_bp = Blueprint('api', __name__, url_prefix='/api')
+
+MAX_COUNT = 50
+
+
+def _error(message: str, status: int):
+    return jsonify(error=message), status
+
+
+def _int_arg(name: str, default: int, lower: int, upper: int):
+    """Parse an integer query parameter clamped to [lower, upper] (None if invalid)."""
+    value = request.args.get(name)
+    if not value:
+        return default
+    if not value.isdigit():
+        return None
+    return max(lower, min(int(value), upper))
+
+
+@api_bp.route('/generate', methods=['GET'])
+def api_generate():
+    """Generate up to ``count`` sentences against a single model load.
+
+    Query parameters: ``acct`` (defaults to the logged-in account), ``count``
+    (1-50), ``min_words`` (1-50), ``startswith`` and ``budget_ms`` (time for
+    all sentences together, at most ``GENERATE_TIME_BUDGET_MS``) and ``seed``
+    (sentence *i* uses ``seed + i``, so the same request gives the same
+    sentences for one model version). The response reports the tries,
+    rejections by reason and whether the budget ran out.
+    """
+    count = _int_arg('count', 1, 1, MAX_COUNT)
+    if count is None:
+        return _error('count is invalid', 400)
+    min_words = _int_arg('min_words', 1, 1, 50)
+    if min_words is None:
+        return _error('min_words is invalid', 400)
+    startswith = request.args.get('startswith', '').strip()[:10]
+    max_budget = default_budget_ms()
+    budget_ms = _int_arg('budget_ms', int(max_budget), 1, int(max_budget) if max_budget > 0 else 60000)
+    if budget_ms is None:
+        return _error('budget_ms is invalid', 400)
+    seed = _int_arg('seed', None, 0, 2 ** 32 - 1)
+    if seed is None and request.args.get('seed'):
+        return _error('seed is invalid', 400)
+
+    if request.args.get('acct'):
+        acct = request.args['acct'].lstrip('@')
+    elif session.get('logged_in'):
+        acct = session['acct'].lstrip('@')
+    else:
+        return _error('acct is required', 400)
+
+    try:
+        meta = get_model_meta(acct)
+    except Exception as e:
+        print(f"[ERROR] Database error in api_generate: {e}")
+        return _error('database error', 500)
+
+    if not meta:
+        return _error(f'model for {acct} not found', 404)
+    if not can_generate(meta, session.get('acct')):
+        return _error('generation by other users is not allowed', 403)
+
+    st = time.perf_counter()
+    try:
+        start_index = load_start_index(acct, meta) if startswith else None
+        if start_index is not None and not start_index.can_start(startswith):
+            # 文頭に現れない単語ならチェーンを読み込まずに候補だけ返す
+            return jsonify(
+                acct=acct,
+                model_version=meta['version'],
+                count=count,
+                min_words=min_words,
+                startswith=startswith,
+                sentences=[],
+                failed=count,
+                suggestions=start_index.suggest(startswith),
+                load_time_ms=0.0,
+                total_time_ms=round((time.perf_counter() - st) * 1000, 3),
+            )
+        text_model = load_text_model(acct, meta)
+    except Exception as e:
+        print(f"[ERROR] Failed to load model in api_generate: {e}")
+        return _error('failed to load model', 500)
+    load_time = (time.perf_counter() - st) * 1000  # ms
+
+    sentences = []
+    failed = 0
+    # 全文で 1 つの予算を使う (0 なら上限なし)
+    deadline = time.perf_counter() + budget_ms / 1000 if budget_ms else None
+    total = GenerationResult()
+    for i in range(count):
+        remaining = (deadline - time.perf_counter()) * 1000 if deadline is not None else 0
+        if deadline is not None and remaining <= 0:
+            total.timed_out = True
+            failed = count - len(sentences)
+            break
+        outcome = generate_sentence(text_model, min_words, startswith, remaining, None if seed is None else seed + i)
+        total.tries += outcome.tries
+        for reason, n in outcome.rejections.items():
+            total.rejections[reason] = total.rejections.get(reason, 0) + n
+        total.timed_out = total.timed_out or outcome.timed_out
+        if not outcome.text:
+            failed += 1
+            if startswith and not sentences and outcome.rejections.get(REJECT_DEAD_END):
+                # 開始状態から先に進めない (何度試しても同じ) ので打ち切る (残りも失敗扱い)
+                # 短すぎる・重複・時間切れなら次の文は成功しうるので予算の残りで続ける
+                failed = count - len(sentences)
+                break
+            continue
+        sentences.append(dict(
+            text=outcome.text.replace(' ', ''),
+            words=outcome.text.split(' '),
+            proc_time_ms=round(outcome.elapsed_ms, 3),
+            tries=outcome.tries,
+            seed=outcome.seed,
+        ))
+    total.elapsed_ms = (time.perf_counter() - st) * 1000 - load_time
+
+    body = dict(
+        acct=acct,
+        model_version=meta['version'],
+        count=count,
+        min_words=min_words,
+        startswith=startswith,
+        sentences=sentences,
+        failed=failed,
+        generation=total.to_dict(),
+        load_time_ms=round(load_time, 3),
+        total_time_ms=round((time.perf_counter() - st) * 1000, 3),
+    )
+    if startswith and not sentences:
+        body['suggestions'] = start_index.suggest(startswith)
+    return jsonify(body)
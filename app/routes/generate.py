@@ -1,75 +1,39 @@
 from __future__ import annotations
 
+import hashlib
 import html
-import json
 import urllib.parse
 import time
 import gc
-import threading
-from typing import Dict, Any, Optional
+from typing import Dict, Any
 
 from flask import Blueprint, render_template, request, session, make_response
 
-import markovify
-import Levenshtein as levsh
-
-from app.utils.helpers import format_text, format_bytes, get_memory_usage
-from app.models.database import get_db_connection
+from app.utils.helpers import format_text, format_bytes, get_memory_usage, get_setting
+from app.models.model_store import get_model_meta, delete_model
 from app.services.http_client import USER_AGENT
+from app.services.model_cache import model_cache, response_cache, start_index_cache
+from app.services.generator import can_generate, generate_sentence, load_text_model, load_start_index, new_seed
+from app.services.sentence_pool import sentence_pool
 
 # Blueprint definition
 
 generate_bp = Blueprint('generate', __name__)
 
-# モデルキャッシュ（スレッドセーフ）
-_model_cache: Dict[str, Any] = {}
-_cache_lock = threading.Lock()
-MAX_CACHE_SIZE = 5  # 最大キャッシュ数
-CACHE_EXPIRY = 300  # キャッシュ有効期限（秒）
-
-
-def _cleanup_expired_cache():
-    """期限切れのキャッシュを削除する"""
-    current_time = time.time()
-    with _cache_lock:
-        expired_keys = [
-            key for key, value in _model_cache.items()
-            if current_time - value['timestamp'] > CACHE_EXPIRY
-        ]
-        for key in expired_keys:
-            del _model_cache[key]
-
-
-def _get_cached_model(acct: str, model_data: str) -> Optional[markovify.Text]:
-    """キャッシュからモデルを取得する"""
-    _cleanup_expired_cache()
-    with _cache_lock:
-        if acct in _model_cache:
-            return _model_cache[acct]['model']
-    return None
-
-
-def _cache_model(acct: str, model: markovify.Text, model_data: str):
-    """モデルをキャッシュに保存する"""
-    _cleanup_expired_cache()
-    with _cache_lock:
-        # キャッシュサイズを制限
-        if len(_model_cache) >= MAX_CACHE_SIZE:
-            # 最も古いエントリを削除
-            oldest_key = min(_model_cache.keys(), key=lambda k: _model_cache[k]['timestamp'])
-            del _model_cache[oldest_key]
-        
-        _model_cache[acct] = {
-            'model': model,
-            'data_hash': hash(model_data),
-            'timestamp': time.time()
-        }
+
+def _seeded_etag(acct: str, meta: Dict[str, Any], min_words: int, startswith: str, seed: int) -> str:
+    """ETag of a seeded generation: the page only depends on these (and the login state)."""
+    key = '\0'.join((acct, meta['version'], str(min_words), startswith, str(seed), str(bool(session.get('logged_in')))))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
 
-def _should_use_cache(acct: str, model_data: str) -> bool:
-    """キャッシュを使用すべきかどうかを判定する"""
-    # 大きなモデル（1MB以上）の場合のみキャッシュを使用
-    return len(model_data.encode()) > 1024 * 1024
+def _cacheable(response, etag: str, public: bool):
+    response.set_etag(etag)
+    # シード付きの生成結果をブラウザ・プロキシにキャッシュさせる秒数
+    max_age = get_setting('GENERATE_CACHE_MAX_AGE', 300, int)
+    # 他のユーザーに見せられないモデル・ログイン中の表示は共有キャッシュに載せない
+    response.headers['Cache-Control'] = f"{'public' if public else 'private'}, max-age={max_age}"
+    return response
 
 
 @generate_bp.route('/generate')
@@ -93,6 +57,11 @@ def generate_do():
     if query.get('startswith'):
         startswith = query['startswith'].strip()[:10]
 
+    # 共有リンクに埋め込まれるシード (同じモデル・条件なら同じ文になる)
+    seed = None
+    if query.get('seed') and query['seed'].isdigit() and len(query['seed']) <= 10:
+        seed = int(query['seed'])
+
     # ----- choose target account -----
     if not query.get('acct'):
         # own data
@@ -112,13 +81,9 @@ def generate_do():
     else:
         acct = query['acct'].lstrip('@')
 
-    # ----- fetch model data -----
+    # ----- fetch model metadata (the blob is read only on a cache miss) -----
     try:
-        db = get_db_connection()
-        cur = db.cursor()
-        cur.execute('SELECT allow_generate_by_other, data FROM model_data WHERE acct = ?', (acct,))
-        data = cur.fetchone()
-        cur.close()
+        meta = get_model_meta(acct)
     except Exception as e:
         print(f"[ERROR] Database error in generate_do: {e}")
         return render_template(
@@ -133,7 +98,7 @@ def generate_do():
             min_words=min_words,
         )
 
-    if not data:
+    if not meta:
         return render_template(
             'generate.html',
             page_type='feature',
@@ -147,7 +112,7 @@ def generate_do():
         )
 
     # permission check
-    if session.get('acct') != acct and not bool(data['allow_generate_by_other']):
+    if not can_generate(meta, session.get('acct')):
         return render_template(
             'generate.html',
             page_type='feature',
@@ -160,44 +125,57 @@ def generate_do():
             min_words=min_words,
         )
 
+    # ----- seeded requests are reproducible: answer from caches if possible -----
+    etag = None
+    public = False
+    cache_key = None
+    if seed is not None:
+        etag = _seeded_etag(acct, meta, min_words, startswith, seed)
+        public = bool(meta['allow_generate_by_other']) and not session.get('logged_in')
+        if etag in request.if_none_match:
+            return _cacheable(make_response('', 304), etag, public)
+        if public:
+            cache_key = f'{acct}\0{min_words}\0{startswith}\0{seed}'
+            body = response_cache.get(cache_key, meta['version'])
+            if body is not None:
+                return _cacheable(make_response(body), etag, public)
+
     # メモリ使用量をログ出力
     try:
         memory_info = get_memory_usage()
-        print(f"[GENERATE] START - RSS={memory_info['rss']}, VMS={memory_info['vms']}, Percent={memory_info['percent']:.1f}%")
+        print(f"[GENERATE] START - RSS={memory_info['rss']}, VMS={memory_info['vms']}, Percent={memory_info['percent']:.1f}% {model_cache!r}")
     except Exception:
         pass
 
     # ----- build markov model -----
     text_model = None
-    model_data = None
-    use_cache = _should_use_cache(acct, data['data'])
-    
-    try:
-        # キャッシュからモデルを取得を試行
-        if use_cache:
-            text_model = _get_cached_model(acct, data['data'])
-        
-        # キャッシュにない場合は新規作成
-        if text_model is None:
-            text_model = markovify.Text.from_json(data['data'])
-            if use_cache:
-                _cache_model(acct, text_model, data['data'])
-        
-        markov_params = dict(tries=100, min_words=min_words)
+    pooled = None
+    outcome = None
 
-        st = time.perf_counter()
+    try:
         sw_failed = False
+        start_index = load_start_index(acct, meta) if startswith else None
 
-        try:
-            if startswith:
-                gen_text = text_model.make_sentence_with_start(startswith, **markov_params)
-            else:
-                gen_text = text_model.make_sentence(**markov_params)
-            if not gen_text:
-                raise AttributeError
+        st = time.perf_counter()
+        # よく使われるモデルはバックグラウンドで作り置きした文から返す (シード指定時は除く)
+        pooled = None if startswith or seed is not None else sentence_pool.take(acct, meta, min_words)
+        if pooled is not None:
+            gen_text, seed = pooled
+        elif start_index is not None and not start_index.can_start(startswith):
+            # 文頭に現れない単語ならチェーンを読み込まずに失敗とする
+            gen_text = None
+        else:
+            text_model = load_text_model(acct, meta)
+            st = time.perf_counter()
+            # 生成にかける時間は GENERATE_TIME_BUDGET_MS まで
+            outcome = generate_sentence(text_model, min_words, startswith, seed=new_seed() if seed is None else seed)
+            gen_text = outcome.text
+            seed = outcome.seed
+
+        if gen_text:
             text = gen_text.replace(' ', '')
             splited_text = ['<span class="badge bg-info">' + html.escape(t) + '</span>' for t in gen_text.split(' ')]
-        except (AttributeError, markovify.text.ParamError, KeyError):
+        else:
             text = None
             if startswith:
                 sw_failed = True
@@ -207,16 +185,13 @@ def generate_do():
         # startswith failed suggestion
         sw_suggest = ''
         if sw_failed:
-            # JSON データを一度だけ解析
-            model_data = json.loads(data['data'])
-            chain = json.loads(model_data['chain'])
-            first_chains = list(chain[0][1].keys())
-            word_lv_ratios = [dict(word=c, ratio=levsh.ratio(startswith, c)) for c in first_chains]
-            word_lv_ratios.sort(key=lambda x: x['ratio'], reverse=True)
-            sw_suggest = ' '.join([f'「{x["word"]}」' for x in word_lv_ratios[:5]])
+            sw_suggest = ' '.join([f'「{w}」' for w in start_index.suggest(startswith)])
+
+        # 時間切れで失敗した結果は次に同じシードで試せば成功するかもしれないのでキャッシュしない
+        cacheable = etag is not None and not (outcome is not None and outcome.timed_out)
 
         if not text:
-            return render_template(
+            body = render_template(
                 'generate.html',
                 page_type='feature',
                 text='',
@@ -228,26 +203,41 @@ def generate_do():
                 proc_time=proc_time,
                 sw_failed=sw_failed,
                 sw_suggest=sw_suggest,
+                outcome=outcome,
+            )
+        else:
+            if seed is not None:
+                # シード付きのリンクは同じ文をそのまま表示する
+                share_url = f'{request.host_url}generate/do?acct={urllib.parse.quote(acct)}&min_words={min_words}&seed={seed}'
+            else:
+                share_url = f'{request.host_url}generate?preset={urllib.parse.quote(acct)}&min_words={min_words}'
+            share_text = (
+                f'{text}\n\n{acct}\n#markov-generator-fedi\n{share_url}'
+                + (f"&startswith={urllib.parse.quote(startswith)}" if startswith else '')
             )
 
-        share_text = (
-            f'{text}\n\n{acct}\n#markov-generator-fedi\n{request.host_url}generate'
-            f'?preset={urllib.parse.quote(acct)}&min_words={min_words}'
-            + (f"&startswith={urllib.parse.quote(startswith)}" if startswith else '')
-        )
+            body = render_template(
+                'generate.html',
+                page_type='feature',
+                text=text,
+                splited_text=splited_text,
+                acct=acct,
+                share_text=urllib.parse.quote(share_text),
+                min_words=min_words,
+                failed=False,
+                proc_time=proc_time,
+                model_data_size=format_bytes(meta['byte_size']),
+                outcome=outcome,
+                seed=seed,
+            )
 
-        return render_template(
-            'generate.html',
-            page_type='feature',
-            text=text,
-            splited_text=splited_text,
-            acct=acct,
-            share_text=urllib.parse.quote(share_text),
-            min_words=min_words,
-            failed=False,
-            proc_time=proc_time,
-            model_data_size=format_bytes(len(data['data'].encode())),
-        )
+        if not cacheable:
+            return body
+        # キャッシュの上限はバイト数なので、エンコード済みの本文を保存・送信する
+        encoded = body.encode('utf-8')
+        if cache_key is not None:
+            response_cache.put(cache_key, meta['version'], encoded, len(encoded))
+        return _cacheable(make_response(encoded), etag, public)
 
     except Exception as e:
         print(f"[ERROR] Exception in generate_do: {e}")
@@ -264,14 +254,9 @@ def generate_do():
         )
 
     finally:
-        # キャッシュを使用していない場合のみオブジェクトを解放
-        if not use_cache and text_model is not None:
-            del text_model
-        if model_data is not None:
-            del model_data
-        
-        # ガベージコレクションを強制実行
-        gc.collect()
+        # ガベージコレクションを強制実行 (作り置きの文を返しただけなら何も読み込んでいないので省く)
+        if pooled is None:
+            gc.collect()
         
         # メモリ使用量をログ出力
         try:
@@ -295,19 +280,11 @@ def my_delete_model_data():
         return 'Canceled.<br><a href="/">Top</a>'
 
     try:
-        db = get_db_connection()
-        cur = db.cursor()
-        cur.execute('SELECT COUNT(*) as cnt FROM model_data WHERE acct = ?', (session['acct'],))
-        res = cur.fetchone()
-        cur.close()
-
-        if not res or res['cnt'] == 0:
+        if not delete_model(session['acct']):
             return 'No data found<br><a href="/">Top</a>'
-
-        cur = db.cursor()
-        cur.execute('DELETE FROM model_data WHERE acct = ?', (session['acct'],))
-        cur.close()
-        db.commit()
+        model_cache.invalidate(session['acct'])
+        start_index_cache.invalidate(session['acct'])
+        sentence_pool.invalidate(session['acct'])
     except Exception as e:
         print(f"[ERROR] Database error in delete_model_data: {e}")
         return 'Database error occurred<br><a href="/">Top</a>'
@@ -1,11 +1,35 @@
 from __future__ import annotations
 
-from flask import Blueprint, render_template, request, make_response, session
+import json
+import time
+from typing import Optional
 
-from app.services.job_manager import job_status, cleanup_completed_jobs
+from flask import Blueprint, Response, redirect, render_template, request, make_response, session
+
+from app.services.job_manager import job_status, wait_job_changed
+from app.services.job_queue import job_queue
 
 job_bp = Blueprint('job', __name__)
 
+# SSE ストリームを一度閉じてブラウザに再接続させるまでの時間 (張りっぱなしの接続を残さない)
+_EVENT_STREAM_SECONDS = 300
+_EVENT_KEEPALIVE_SECONDS = 15
+
+
+def _current_job(job_id: str) -> Optional[dict]:
+    """Status of *job_id* (with its queue position while queued), or ``None`` if unknown."""
+    job_info = job_status.get(job_id)
+    if job_info is None:
+        # 再起動前に積まれたジョブなど (JOB_STATUS_BACKEND=memory では別プロセスの進捗は見えない)
+        state = job_queue.state(job_id)
+        if state not in ('queued', 'running'):
+            return None
+        job_info = dict(completed=False, progress=1, progress_str='処理中です', queued=state == 'queued')
+
+    if not job_info['completed'] and job_info.get('queued'):
+        job_info = dict(job_info, queue_position=job_queue.position(job_id))
+    return job_info
+
 
 @job_bp.route('/error_test')
 def error_test():
@@ -16,9 +40,6 @@ def error_test():
 @job_bp.route('/job_wait')
 def job_wait():
     """Poll the status of a background job and show progress / result."""
-    # 定期的にクリーンアップを実行
-    cleanup_completed_jobs()
-    
     job_id = "";
     try:
         job_id = request.args.get('job_id')
@@ -27,23 +48,85 @@ def job_wait():
     if not job_id:
         return make_response(render_template('job_error.html', page_type='job', message='ジョブIDが指定されていません'), 400)
 
-    if job_id not in job_status:
+    job_info = _current_job(job_id)
+    if job_info is None:
         return render_template('job_not_found.html', page_type='job')
 
-    # Thread may have crashed
-    job_info = job_status[job_id]
-
     if not job_info['completed']:
-        thread = job_info.get('thread')
-        if thread and not thread.is_alive():
-            return make_response(render_template('job_error.html', page_type='job', message='スレッドが異常終了しました'), 500)
-        return render_template('job_wait.html', page_type='job', d=job_info)
+        return render_template('job_wait.html', page_type='job', d=job_info, job_id=job_id)
 
     # Handle completed job
+    # 同じジョブを複数の画面が待っていることがあるので、結果は消さずに期限切れに任せる
+    if job_info.get('cancelled'):
+        return render_template('job_error.html', page_type='job', message=job_info['error'])
     if job_info.get('error'):
         return make_response(render_template('job_error.html', page_type='job', message=job_info['error']), 500)
 
-    # Success – remove job and show result
+    # Success – show result
     session['hasModelData'] = True
-    job = job_status.pop(job_id)
-    return render_template('job_result.html', page_type='job', job=job) 
+    return render_template('job_result.html', page_type='job', job=job_info)
+
+
+@job_bp.route('/job_events')
+def job_events():
+    """Stream progress of a job as Server-Sent Events.
+
+    An event is sent whenever ``progress`` / ``progress_str`` / queue
+    position change; the last one has ``completed: true``, after which the
+    page loads ``/job_wait`` once more to show the result.
+    """
+    job_id = request.args.get('job_id')
+    if not job_id:
+        return make_response('job_id is required', 400)
+    if _current_job(job_id) is None:
+        return make_response('job not found', 404)
+
+    def stream():
+        yield 'retry: 3000\n\n'
+        last = None
+        version = 0
+        started = last_sent = time.monotonic()
+        while True:
+            job_info = _current_job(job_id)
+            if job_info is None or job_info['completed']:
+                yield 'data: {"completed": true}\n\n'
+                return
+            event = dict(
+                completed=False,
+                progress=job_info.get('progress', 0),
+                progress_str=job_info.get('progress_str', ''),
+                queued=bool(job_info.get('queued')),
+                queue_position=job_info.get('queue_position'),
+            )
+            now = time.monotonic()
+            if event != last:
+                yield f'data: {json.dumps(event, ensure_ascii=False)}\n\n'
+                last = event
+                last_sent = now
+            elif now - last_sent >= _EVENT_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = now
+            if now - started >= _EVENT_STREAM_SECONDS:
+                return
+            version = wait_job_changed(job_id, version, timeout=1.0)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # リバースプロキシでバッファリングさせない
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@job_bp.route('/job_cancel', methods=['POST'])
+def job_cancel():
+    """Cancel a queued or running job of the logged-in account, then go back to its status page."""
+    job_id = request.form.get('job_id')
+    if not job_id:
+        return make_response(render_template('job_error.html', page_type='job', message='ジョブIDが指定されていません'), 400)
+    owner = job_queue.owner(job_id)
+    if owner is not None and owner != session.get('acct'):
+        # ジョブ ID を知っているだけの他人には止めさせない
+        return make_response(render_template('job_error.html', page_type='job', message='このジョブをキャンセルする権限がありません'), 403)
+    if owner is None or not job_queue.cancel(job_id):
+        return make_response(render_template('job_error.html', page_type='job', message='キャンセルできるジョブが見つかりませんでした'), 404)
+    return redirect('/job_wait?job_id=' + job_id)
@@ -20,6 +20,7 @@ class MastodonAuthProvider(AuthProvider):
         session['type'] = 'mastodon'
         session['importVisibility'] = form_data.get('importVisibility', 'public_only')
         session['allowGenerateByOther'] = form_data.get('allowGenerateByOther', False)
+        session['incrementalImport'] = form_data.get('incrementalImport', False)
 
         # create app
         options = {
@@ -25,6 +25,7 @@ class MisskeyAuthProvider(AuthProvider):
         # Save import options
         session['importVisibility'] = form_data.get('importVisibility', 'public_only')
         session['allowGenerateByOther'] = form_data.get('allowGenerateByOther', False)
+        session['incrementalImport'] = form_data.get('incrementalImport', False)
 
         # Detect if instance supports MiAuth
         try:
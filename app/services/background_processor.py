@@ -3,19 +3,24 @@ from __future__ import annotations
 import math
 from datetime import datetime
 from datetime import timedelta
+import functools
+import json
+import time
 import uuid
-import threading
 import traceback
 import re
 import gc
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 import mastodon as mastodon_lib  # rename to avoid name clash
 from misskey import Misskey
-from app.services.job_manager import job_status, cleanup_completed_jobs
-from app.utils.helpers import format_text, get_memory_usage
-from app.models.markov_model import create_markov_model_by_multiline
-from app.models.database import get_db_connection
+from app.services.job_manager import job_status
+from app.services.job_queue import job_queue
+from app.utils.helpers import format_text, get_memory_usage, get_setting
+from app.models.compact_model import is_compact, load_model
+from app.models.import_checkpoint import delete_checkpoint, load_checkpoint, save_checkpoint
+from app.models.markov_model import create_markov_model_by_multiline, open_token_cache
+from app.models.model_store import get_import_state, get_model_data, get_model_meta, save_model, set_allow_generate_by_other
 from app.services.data_import.misskey import MisskeyDataImporter
 from app.services.data_import.mastodon import MastodonDataImporter
 
@@ -38,12 +43,180 @@ def _log_memory_usage(stage: str, job_id: str):
         print(f"[MEMORY] Failed to get memory usage: {e}")
 
 
+def _incremental_base(session_data: Dict[str, Any], acct: str):
+    """Return ``(model, import_state)`` to extend, or ``(None, None)`` for a full import.
+
+    Incremental training needs the previous model in the compact format and
+    an import state recorded with the same visibility setting.
+    """
+    if session_data.get('incrementalImport') != 'true':
+        return None, None
+    state = get_import_state(acct)
+    if state is None or state['import_visibility'] != session_data.get('importVisibility', 'public_only'):
+        return None, None
+    data = get_model_data(acct)
+    if data is None or not is_compact(data):
+        return None, None
+    return load_model(data), state
+
+
+def _import_params(platform: str, session_data: Dict[str, Any], data: Dict[str, Any], since_id) -> Dict[str, Any]:
+    """Import settings a checkpoint is only valid for."""
+    return dict(
+        platform=platform,
+        import_visibility=session_data.get('importVisibility', 'public_only'),
+        import_size=int(data['import_size']),
+        since_id=since_id,
+    )
+
+
+def _resume(importer, acct: str, params: Dict[str, Any]):
+    """Restore *importer* from a matching checkpoint and return the partial model (or ``None``)."""
+    found = load_checkpoint(acct)
+    if found is None:
+        return None
+    meta, model_data = found
+    if meta.get('params') != params:
+        # 設定の違う取得の途中経過は使えない
+        delete_checkpoint(acct)
+        return None
+    try:
+        model = load_model(model_data)
+    except Exception as e:
+        print(f"[WARNING] Discarding unreadable import checkpoint for {acct}: {e!r}")
+        delete_checkpoint(acct)
+        return None
+    importer.restore(meta['importer'])
+    return model
+
+
+def _save_checkpoint(acct: str, params: Dict[str, Any], state: Dict[str, Any], builder) -> None:
+    """Checkpoint marker body: save *state* together with the counts built so far."""
+    try:
+        model = builder.build()
+    except ValueError:
+        # まだ何も集計されていない
+        return
+    try:
+        save_checkpoint(acct, dict(params=params, importer=state), model.to_bytes())
+    except Exception as e:
+        # 保存できなくても学習自体は続ける
+        print(f"[WARNING] Failed to save import checkpoint for {acct}: {e!r}")
+
+
+def _fetch_stage(importer, since_id, job_id: str, checkpoint: Optional[Tuple[str, Dict[str, Any]]] = None):
+    """Yield the importer's lines and switch the job progress once fetching is done.
+
+    Stops with :class:`JobCancelled` when the job is cancelled.
+
+    With *checkpoint* (``(acct, params)``) a checkpoint marker for
+    :func:`create_markov_model_by_multiline` is inserted at the first page
+    boundary every ``IMPORT_CHECKPOINT_INTERVAL`` seconds.
+    """
+    interval = get_setting('IMPORT_CHECKPOINT_INTERVAL', 120.0, float)
+    seen = importer.resume_state
+    last_saved = time.monotonic()
+    for line in importer.iter_lines(since_id=since_id):
+        job_queue.check_cancelled(job_id)
+        state = importer.resume_state
+        if state is not seen:
+            # ここまでに流した行はすべて state の時点までに取得したページのもの
+            seen = state
+            if checkpoint is not None and interval > 0 and time.monotonic() - last_saved >= interval:
+                yield functools.partial(_save_checkpoint, *checkpoint, state)
+                last_saved = time.monotonic()
+        yield line
+    _log_memory_usage("AFTER_FETCH", job_id)
+    job_status.update(
+        job_id,
+        progress=80,
+        progress_str=f'投稿取得完了 ({importer.imported_count}件) - モデルを作成しています...',
+    )
+
+
+def _open_token_cache():
+    try:
+        return open_token_cache()
+    except Exception as e:
+        # キャッシュが使えなくても学習はできる
+        print(f"[WARNING] Token cache unavailable: {e!r}")
+        return None
+
+
+def _token_cache_summary(cache) -> str:
+    """Hit rate line for the job result ('' if the cache was not used)."""
+    if cache is None:
+        return ''
+    st = cache.stats()
+    lookups = st['hits'] + st['misses']
+    if not lookups:
+        return ''
+    return f'<br>形態素解析キャッシュ: ヒット率 {st["hit_rate"]:.0%} ({st["hits"]}/{lookups}行)'
+
+
+def _dedup_key(platform: str, session_data: Dict[str, Any]) -> str:
+    """Jobs with the same key would build the same model, so only one of them runs."""
+    return json.dumps([
+        platform,
+        session_data['acct'],
+        session_data.get('importVisibility', 'public_only'),
+        str(session_data['import_size']),
+        session_data.get('incrementalImport') == 'true',
+        session_data.get('allowGenerateByOther') == 'true',
+    ])
+
+
+def _reuse_recent_model(job_id: str, session_data: Dict[str, Any]) -> bool:
+    """Complete *job_id* at once if the account's model is younger than ``MODEL_REUSE_MAX_AGE``.
+
+    The model must have been trained with the same visibility setting; the
+    requested import size is not compared.
+    """
+    max_age = get_setting('MODEL_REUSE_MAX_AGE', 0.0, float)
+    if max_age <= 0:
+        return False
+    acct = session_data['acct']
+    meta = get_model_meta(acct)
+    import_state = get_import_state(acct)
+    if meta is None or import_state is None:
+        return False
+    age = time.time() - meta['created_at']
+    if age > max_age or import_state['import_visibility'] != session_data.get('importVisibility', 'public_only'):
+        return False
+
+    set_allow_generate_by_other(acct, session_data.get('allowGenerateByOther') == 'true')
+    job_status[job_id] = dict(
+        completed=True,
+        error=None,
+        progress=100,
+        progress_str='完了',
+        result=(
+            f'{max(age / 60, 1):.0f} 分前に学習したモデルをそのまま使います。'
+            f'<br>取り込み済投稿数: {import_state["post_count"]}件'
+        ),
+    )
+    return True
+
+
+def _finish_unchanged(job_id: str, st: datetime, acct: str, allow_by_other: bool):
+    """Complete an incremental job that found no new posts (the model is kept as is)."""
+    set_allow_generate_by_other(acct, allow_by_other)
+    delete_checkpoint(acct)
+    job_status[job_id] = dict(
+        completed=True,
+        error=None,
+        progress=100,
+        progress_str='完了',
+        result=f'前回の学習以降の新しい投稿はありませんでした。<br>処理時間: {format_time(datetime.now() - st)}',
+    )
+
+
 # ---------------------------------------------------------------------------
 # Misskey
 # ---------------------------------------------------------------------------
 
 def start_misskey_job(session_data: Dict[str, Any], token: str) -> str:
-    """Spin up a background job that trains a Markov model using Misskey notes.
+    """Queue a background job that trains a Markov model using Misskey notes.
 
     Parameters
     ----------
@@ -55,119 +228,132 @@ def start_misskey_job(session_data: Dict[str, Any], token: str) -> str:
     Returns
     -------
     str
-        The generated job_id.
+        The job_id to follow. A job still queued / running for the same
+        account and settings is reused instead of starting another one.
     """
-    thread_id = _new_thread_id()
-
-    # Initialise job status
-    job_status[thread_id] = dict(
-        completed=False,
-        error=None,
-        progress=1,
-        progress_str='初期化中です',
+    job_id = _new_thread_id()
+    if _reuse_recent_model(job_id, session_data):
+        return job_id
+    return job_queue.submit(
+        job_id,
+        'misskey',
+        session_data['acct'],
+        dict(session_data=dict(session_data), token=token),
+        dedup_key=_dedup_key('misskey', session_data),
     )
 
+
+def _misskey_proc(job_id: str, payload: Dict[str, Any]):  # noqa: C901 – legacy complexity
+    """Queue handler for :func:`start_misskey_job`."""
+    session_data = payload['session_data']
+    token = payload['token']
     import_visibility = session_data.get('importVisibility', 'public_only')
     allow_by_other = session_data.get('allowGenerateByOther', False)
+    data = dict(
+        hostname=session_data['hostname'],
+        user_id=session_data['user_id'],
+        acct=session_data['acct'],
+        import_size=session_data['import_size'],
+    )
+
+    st = datetime.now()
+    _log_memory_usage("START", job_id)
+
+    job_status.update(job_id, progress=10, progress_str='投稿を取得しています...')
+
+    try:
+        base_model, import_state = _incremental_base(session_data, data['acct'])
+        since_id = import_state['newest_id'] if import_state else None
+        importer = MisskeyDataImporter(session_data, token, job_id)
+        checkpoint = (data['acct'], _import_params('misskey', session_data, data, since_id))
+        partial_model = _resume(importer, *checkpoint)
+    except Exception as e:
+        job_status[job_id] = dict(
+            completed=True,
+            error=str(e)
+        )
+        return
 
-    def proc(job_id: str, data: Dict[str, Any]):  # noqa: C901 – legacy complexity
-        st = datetime.now()
-        _log_memory_usage("START", job_id)
-
-        job_status[job_id]['progress'] = 10
-        job_status[job_id]['progress_str'] = '投稿を取得しています...'
-
-        try:
-            importer = MisskeyDataImporter(session_data, token, job_id)
-            lines, imported_notes, total_notes = importer.fetch_lines()
-            _log_memory_usage("AFTER_FETCH", job_id)
-        except Exception as e:
-            job_status[job_id] = dict(
-                completed=True,
-                error=str(e),
-                completed_at=datetime.now()
-            )
-            return
-
-        job_status[job_id]['progress_str'] = f'投稿取得完了 ({imported_notes}件) - モデルを作成しています'
-        job_status[job_id]['progress'] = 80
-
-        try:
-            job_status[job_id]['progress_str'] = f'投稿取得完了 ({imported_notes}件) - モデルを作成しています...'
-            text_model = create_markov_model_by_multiline(lines)
-            _log_memory_usage("AFTER_MODEL_CREATION", job_id)
-        except Exception as e:
-            job_status[job_id] = dict(
-                completed=True,
-                error=str(e),
-                completed_at=datetime.now()
-            )
-            return
-        finally:
-            # 大きなリストを明示的に解放
-            del lines
-            gc.collect()
-            _log_memory_usage("AFTER_LINES_CLEANUP", job_id)
-
-        job_status[job_id]['progress_str'] = f'投稿取得完了 ({imported_notes}件) - データベースに書き込み中です'
-        job_status[job_id]['progress'] = 90
-
-        try:
-            db = get_db_connection()
-            cur = db.cursor()
-            cur.execute('DELETE FROM model_data WHERE acct = ?', (data['acct'],))
-            cur.execute(
-                'INSERT INTO model_data(acct, data, allow_generate_by_other) VALUES (?, ?, ?)',
-                (data['acct'], text_model.to_json(), int(allow_by_other == 'true')),
-            )
-            cur.close()
-            db.commit()
-        except Exception as e:
-            print(f"[ERROR] Database error in misskey job: {e}")
-            traceback.print_exc()
-            job_status[job_id] = dict(
-                completed=True,
-                error='Failed to save model: ' + str(e),
-                completed_at=datetime.now()
-            )
-            return
-        finally:
-            # モデルオブジェクトを明示的に解放
-            del text_model
-            gc.collect()
-            _log_memory_usage("AFTER_MODEL_CLEANUP", job_id)
+    resumed_count = importer.imported_count
+    if partial_model is not None:
+        job_status.update(job_id, progress_str=f'中断した取得を再開しています... (取得済み: {resumed_count}件)')
 
+    # 取得したページから順に形態素解析・集計する (取得済み投稿をリストに溜めない)
+    token_cache = _open_token_cache()
+    try:
+        text_model = create_markov_model_by_multiline(
+            _fetch_stage(importer, since_id, job_id, checkpoint),
+            # 再開時は途中までの集計 (差分学習ならベースモデルを含む) に追加する
+            base=partial_model if partial_model is not None else base_model,
+            expected_runs=0 if base_model is not None or partial_model is not None else int(data['import_size']),
+            token_cache=token_cache,
+        )
+        imported_notes = importer.imported_count
+        _log_memory_usage("AFTER_MODEL_CREATION", job_id)
+    except Exception as e:
         job_status[job_id] = dict(
             completed=True,
-            error=None,
-            progress=100,
-            progress_str='完了',
-            result=f'学習完了！<br>取り込み済投稿数: {imported_notes}件<br>処理時間: {format_time(datetime.now() - st)}',
-            completed_at=datetime.now(),
+            error=str(e)
         )
+        return
+    finally:
+        cache_summary = _token_cache_summary(token_cache)
+        if token_cache is not None:
+            token_cache.close()
+        gc.collect()
+
+    if base_model is not None and imported_notes == 0:
+        _finish_unchanged(job_id, st, data['acct'], allow_by_other == 'true')
+        return
+
+    job_status.update(
+        job_id,
+        progress=90,
+        progress_str=f'投稿取得完了 ({imported_notes}件) - データベースに書き込み中です',
+    )
 
-        _log_memory_usage("COMPLETED", job_id)
-
-    thread = threading.Thread(
-        target=proc,
-        args=(
-            thread_id,
-            dict(
-                hostname=session_data['hostname'],
-                user_id=session_data['user_id'],
-                acct=session_data['acct'],
-                import_size=session_data['import_size'],
+    try:
+        post_count = imported_notes + (import_state['post_count'] if import_state else 0)
+        save_model(
+            data['acct'],
+            text_model,
+            allow_by_other == 'true',
+            import_state=dict(
+                newest_id=importer.newest_id or since_id,
+                import_visibility=import_visibility,
+                post_count=post_count,
             ),
+        )
+    except Exception as e:
+        print(f"[ERROR] Database error in misskey job: {e}")
+        traceback.print_exc()
+        job_status[job_id] = dict(
+            completed=True,
+            error='Failed to save model: ' + str(e)
+        )
+        return
+    finally:
+        # モデルオブジェクトを明示的に解放
+        del text_model
+        gc.collect()
+        _log_memory_usage("AFTER_MODEL_CLEANUP", job_id)
+
+    delete_checkpoint(data['acct'])
+    job_status[job_id] = dict(
+        completed=True,
+        error=None,
+        progress=100,
+        progress_str='完了',
+        result=(
+            f'学習完了！<br>取り込み済投稿数: {imported_notes}件'
+            + (f' (差分学習、累計: {post_count}件)' if base_model is not None else '')
+            + (f'<br>中断した取得を {resumed_count}件目から再開しました' if partial_model is not None else '')
+            + cache_summary
+            + f'<br>処理時間: {format_time(datetime.now() - st)}'
         ),
-        name=thread_id,
     )
-    thread.start()
-    job_status[thread_id]['thread'] = thread
 
-    # 定期的にクリーンアップを実行
-    cleanup_completed_jobs()
-
-    return thread_id
+    _log_memory_usage("COMPLETED", job_id)
 
 
 # ---------------------------------------------------------------------------
@@ -179,117 +365,134 @@ def start_mastodon_job(
     token: str,
     account: dict,
 ) -> str:
-    """Background job for Mastodon accounts."""
-    thread_id = _new_thread_id()
-    job_status[thread_id] = dict(
-        completed=False,
-        error=None,
-        progress=1,
-        progress_str='初期化中です',
+    """Background job for Mastodon accounts (see :func:`start_misskey_job`)."""
+    job_id = _new_thread_id()
+    if _reuse_recent_model(job_id, session_data):
+        return job_id
+    return job_queue.submit(
+        job_id,
+        'mastodon',
+        session_data['acct'],
+        # アカウント情報は ID しか使わない (datetime などを含むので丸ごとは保存しない)
+        dict(session_data=dict(session_data), token=token, account=dict(id=account['id'])),
+        dedup_key=_dedup_key('mastodon', session_data),
     )
 
+
+def _mastodon_proc(job_id: str, payload: Dict[str, Any]):  # noqa: C901 – legacy complexity
+    """Queue handler for :func:`start_mastodon_job`."""
+    session_data = payload['session_data']
+    token = payload['token']
+    account = payload['account']
     import_visibility = session_data.get('importVisibility', 'public_only')
     allow_by_other = session_data.get('allowGenerateByOther', False)
+    data = dict(
+        hostname=session_data['hostname'],
+        mstdn_app_key=session_data['mstdn_app_key'],
+        mstdn_app_secret=session_data['mstdn_app_secret'],
+        acct=session_data['acct'],
+        import_size=session_data['import_size'],
+    )
+
+    st = datetime.now()
+    _log_memory_usage("START", job_id)
 
-    def proc(job_id: str, data: Dict[str, Any]):  # noqa: C901 – legacy complexity
-        st = datetime.now()
-        _log_memory_usage("START", job_id)
-
-        job_status[job_id]['progress'] = 10
-        job_status[job_id]['progress_str'] = '投稿を取得しています...'
-
-        try:
-            importer = MastodonDataImporter(session_data, token, account, job_id)
-            lines, imported_toots, total_toots = importer.fetch_lines()
-            _log_memory_usage("AFTER_FETCH", job_id)
-        except Exception as e:
-            job_status[job_id] = dict(
-                completed=True,
-                error='Failed to fetch data: ' + str(e),
-                completed_at=datetime.now()
-            )
-            return
-
-        job_status[job_id]['progress_str'] = f'投稿取得完了 ({imported_toots}件) - モデルを作成しています'
-        job_status[job_id]['progress'] = 80
-
-        try:
-            job_status[job_id]['progress_str'] = f'投稿取得完了 ({imported_toots}件) - モデルを作成しています...'
-            text_model = create_markov_model_by_multiline(lines)
-            _log_memory_usage("AFTER_MODEL_CREATION", job_id)
-        except Exception as e:
-            job_status[job_id] = dict(
-                completed=True,
-                error='Failed to create model: ' + str(e),
-                completed_at=datetime.now()
-            )
-            return
-        finally:
-            # 大きなリストを明示的に解放
-            del lines
-            gc.collect()
-            _log_memory_usage("AFTER_LINES_CLEANUP", job_id)
-
-        job_status[job_id]['progress_str'] = f'投稿取得完了 ({imported_toots}件) - データベースに書き込み中です'
-        job_status[job_id]['progress'] = 90
-
-        try:
-            db = get_db_connection()
-            cur = db.cursor()
-            cur.execute('DELETE FROM model_data WHERE acct = ?', (data['acct'],))
-            cur.execute(
-                'INSERT INTO model_data(acct, data, allow_generate_by_other) VALUES (?, ?, ?)',
-                (data['acct'], text_model.to_json(), int(allow_by_other == 'true')),
-            )
-            cur.close()
-            db.commit()
-        except Exception as e:
-            print(f"[ERROR] Database error in mastodon job: {e}")
-            traceback.print_exc()
-            job_status[job_id] = dict(
-                completed=True,
-                error='Failed to save model to database: ' + str(e),
-                completed_at=datetime.now()
-            )
-            return
-        finally:
-            # モデルオブジェクトを明示的に解放
-            del text_model
-            gc.collect()
-            _log_memory_usage("AFTER_MODEL_CLEANUP", job_id)
+    job_status.update(job_id, progress=10, progress_str='投稿を取得しています...')
 
+    try:
+        base_model, import_state = _incremental_base(session_data, data['acct'])
+        since_id = import_state['newest_id'] if import_state else None
+        importer = MastodonDataImporter(session_data, token, account, job_id)
+        checkpoint = (data['acct'], _import_params('mastodon', session_data, data, since_id))
+        partial_model = _resume(importer, *checkpoint)
+    except Exception as e:
+        job_status[job_id] = dict(
+            completed=True,
+            error='Failed to fetch data: ' + str(e)
+        )
+        return
+
+    resumed_count = importer.imported_count
+    if partial_model is not None:
+        job_status.update(job_id, progress_str=f'中断した取得を再開しています... (取得済み: {resumed_count}件)')
+
+    # 取得したページから順に形態素解析・集計する (取得済み投稿をリストに溜めない)
+    token_cache = _open_token_cache()
+    try:
+        text_model = create_markov_model_by_multiline(
+            _fetch_stage(importer, since_id, job_id, checkpoint),
+            # 再開時は途中までの集計 (差分学習ならベースモデルを含む) に追加する
+            base=partial_model if partial_model is not None else base_model,
+            expected_runs=0 if base_model is not None or partial_model is not None else int(data['import_size']),
+            token_cache=token_cache,
+        )
+        imported_toots = importer.imported_count
+        _log_memory_usage("AFTER_MODEL_CREATION", job_id)
+    except Exception as e:
         job_status[job_id] = dict(
             completed=True,
-            error=None,
-            progress=100,
-            progress_str='完了',
-            result=f'学習完了！<br>取り込み済投稿数: {imported_toots}件<br>処理時間: {format_time(datetime.now() - st)}',
-            completed_at=datetime.now(),
+            error=('Failed to create model: ' if importer.finished else 'Failed to fetch data: ') + str(e)
         )
+        return
+    finally:
+        cache_summary = _token_cache_summary(token_cache)
+        if token_cache is not None:
+            token_cache.close()
+        gc.collect()
+
+    if base_model is not None and imported_toots == 0:
+        _finish_unchanged(job_id, st, data['acct'], allow_by_other == 'true')
+        return
+
+    job_status.update(
+        job_id,
+        progress=90,
+        progress_str=f'投稿取得完了 ({imported_toots}件) - データベースに書き込み中です',
+    )
 
-        _log_memory_usage("COMPLETED", job_id)
-
-    thread = threading.Thread(
-        target=proc,
-        args=(
-            thread_id,
-            dict(
-                hostname=session_data['hostname'],
-                mstdn_app_key=session_data['mstdn_app_key'],
-                mstdn_app_secret=session_data['mstdn_app_secret'],
-                acct=session_data['acct'],
-                import_size=session_data['import_size'],
+    try:
+        post_count = imported_toots + (import_state['post_count'] if import_state else 0)
+        save_model(
+            data['acct'],
+            text_model,
+            allow_by_other == 'true',
+            import_state=dict(
+                newest_id=importer.newest_id or since_id,
+                import_visibility=import_visibility,
+                post_count=post_count,
             ),
+        )
+    except Exception as e:
+        print(f"[ERROR] Database error in mastodon job: {e}")
+        traceback.print_exc()
+        job_status[job_id] = dict(
+            completed=True,
+            error='Failed to save model to database: ' + str(e)
+        )
+        return
+    finally:
+        # モデルオブジェクトを明示的に解放
+        del text_model
+        gc.collect()
+        _log_memory_usage("AFTER_MODEL_CLEANUP", job_id)
+
+    delete_checkpoint(data['acct'])
+    job_status[job_id] = dict(
+        completed=True,
+        error=None,
+        progress=100,
+        progress_str='完了',
+        result=(
+            f'学習完了！<br>取り込み済投稿数: {imported_toots}件'
+            + (f' (差分学習、累計: {post_count}件)' if base_model is not None else '')
+            + (f'<br>中断した取得を {resumed_count}件目から再開しました' if partial_model is not None else '')
+            + cache_summary
+            + f'<br>処理時間: {format_time(datetime.now() - st)}'
         ),
-        name=thread_id,
     )
-    thread.start()
-    job_status[thread_id]['thread'] = thread
 
-    # 定期的にクリーンアップを実行
-    cleanup_completed_jobs()
+    _log_memory_usage("COMPLETED", job_id)
 
-    return thread_id
 
 def format_time(delta: timedelta) -> str:
     total_seconds = delta.total_seconds()
@@ -302,3 +505,7 @@ def format_time(delta: timedelta) -> str:
     string += f'{seconds:.2f} 秒'
 
     return string
+
+
+job_queue.register('misskey', _misskey_proc)
+job_queue.register('mastodon', _mastodon_proc)
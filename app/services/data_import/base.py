@@ -1,23 +1,78 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Dict, Any
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.services.job_manager import job_status  # type: ignore
 
 
 class DataImporter(ABC):
     """Abstract base class for platform-specific data importers."""
 
-    def __init__(self, session_data: Dict[str, Any]):
+    def __init__(self, session_data: Dict[str, Any], job_id: Optional[str] = None):
         self.session_data = session_data
+        self.job_id = job_id
+        # Filled in while iter_lines() runs
+        self.newest_id: Optional[str] = None
+        self.imported_count = 0
+        self.total_count = 0
+        self.finished = False
+        # Pagination position to start from (set by restore()) and the state
+        # after the last page whose lines were all yielded (for checkpoints)
+        self.cursor: Dict[str, Any] = {}
+        self.resume_state: Optional[Dict[str, Any]] = None
 
     @abstractmethod
-    def fetch_lines(self) -> Tuple[List[str], int]:
-        """Fetch user's posts and return pre-processed text lines.
+    def iter_lines(self, since_id: Optional[str] = None) -> Iterator[str]:
+        """Fetch user's posts page by page and yield pre-processed text lines.
+
+        ``imported_count`` / ``total_count`` / ``newest_id`` are updated as
+        pages arrive and ``finished`` is set once the last page was read.
+
+        Parameters
+        ----------
+        since_id: str, optional
+            Only fetch posts newer than this ID (incremental training).
+        """
+
+    def fetch_lines(self, since_id: Optional[str] = None) -> Tuple[List[str], int, int]:
+        """Fetch all lines at once.
 
         Returns
         -------
-        Tuple[List[str], int]
-            A tuple of (list of processed lines, original post count imported)"""
+        Tuple[List[str], int, int]
+            A tuple of (list of processed lines, post count imported, total post count)"""
+        lines = list(self.iter_lines(since_id))
+        return lines, self.imported_count, self.total_count
+
+    def restore(self, state: Dict[str, Any]) -> None:
+        """Continue from a ``resume_state`` saved by an interrupted import."""
+        self.cursor = dict(state['cursor'])
+        self.newest_id = state['newest_id']
+        self.imported_count = state['imported_count']
+        self.resume_state = state
+
+    def _page_done(self, cursor: Dict[str, Any]) -> None:
+        """Record that every line of the page ending at *cursor* was yielded."""
+        # 毎回新しい dict にするので、呼び出し側は同一性で更新を検出できる
+        self.resume_state = dict(cursor=cursor, newest_id=self.newest_id, imported_count=self.imported_count)
+
+    @staticmethod
+    def _id_order(post_id: Any) -> Tuple[int, str]:
+        """Sort key that orders post IDs by age."""
+        post_id = str(post_id)
+        # Mastodon の ID は桁数の異なる数値、Misskey の ID は固定長なので (長さ, 文字列) で比較できる
+        return len(post_id), post_id
+
+    def _track_newest(self, post_id: Any) -> None:
+        """Remember *post_id* if it is newer than any ID seen so far."""
+        if self.newest_id is None or self._id_order(post_id) > self._id_order(self.newest_id):
+            self.newest_id = str(post_id)
+
+    def _report_pacing(self, message: str) -> None:
+        """Show a fetch pacing decision (rate-limit wait, retry) in the job progress."""
+        if self.job_id:
+            job_status.update(self.job_id, progress_str=f'投稿を取得しています... (取得済み: {self.imported_count}件) - {message}')
 
     # Utility helper that subclasses can use
     def _format_visibility_filter(self, visibility: str) -> bool:
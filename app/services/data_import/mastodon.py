@@ -1,13 +1,14 @@
 from __future__ import annotations
 
 import re
-import gc
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import mastodon as mastodon_lib
 
 from app.utils.helpers import format_text
 from .base import DataImporter
+from .pipeline import prefetch
+from .rate_limit import FetchController
 from app.services.job_manager import job_status  # type: ignore
 
 __all__ = ['MastodonDataImporter']
@@ -15,54 +16,82 @@ __all__ = ['MastodonDataImporter']
 
 class MastodonDataImporter(DataImporter):
     def __init__(self, session_data, token: str, account: dict, job_id: str = None):
-        super().__init__(session_data)
+        super().__init__(session_data, job_id)
         self.token = token
         self.account = account
-        self.job_id = job_id
+        self.fetcher = FetchController(max_page_size=40, report=self._report_pacing)
+        # レート制限の待機・再試行は FetchController が行う
         self.mstdn = mastodon_lib.Mastodon(
             client_id=session_data['mstdn_app_key'],
             client_secret=session_data['mstdn_app_secret'],
             access_token=token,
             api_base_url=f"https://{session_data['hostname']}",
+            ratelimit_method='throw',
+            session=self.fetcher.session,
         )
 
-    def fetch_lines(self) -> Tuple[List[str], int, int]:
-        lines: List[str] = []
-        imported = 0
-        last_id = None
+    def _pages(self, since_id: Optional[str] = None) -> Iterator[Tuple[List[dict], dict]]:
+        """Request pages of statuses (newest first), following ``max_id``.
+
+        Yields ``(page, cursor after the page)``, starting from :attr:`cursor`.
+        Page size and request timing are decided by :attr:`fetcher`.
+        """
+        last_id = self.cursor.get('max_id')
+        fetched = self.cursor.get('fetched', 0)
+        import_size = int(self.session_data['import_size'])
+        while fetched <= import_size:
+            block = self.fetcher.request(lambda limit: self.mstdn.account_statuses(
+                self.account['id'], limit=limit, max_id=last_id, since_id=since_id, exclude_reblogs=True,
+            ))
+            if not block:
+                break
+            fetched += len(block)
+            last_id = block[-1]['id']
+            yield block, dict(max_id=last_id, fetched=fetched)
+
+    def iter_lines(self, since_id: Optional[str] = None) -> Iterator[str]:
+        imported = self.imported_count
         target_size = int(self.session_data['import_size'])
+        self.total_count = target_size
         
         # 進捗更新のための初期設定
-        if self.job_id and self.job_id in job_status:
-            job_status[self.job_id]['progress'] = 15
-            job_status[self.job_id]['progress_str'] = f'投稿を取得しています... (取得済み: 0件)'
+        if self.job_id:
+            job_status.update(
+                self.job_id,
+                progress=15,
+                progress_str=f'投稿を取得しています... (取得済み: {imported}件)',
+            )
         
-        for i in range(int(self.session_data['import_size'] / 40) + 1):
-            block = self.mstdn.account_statuses(self.account['id'], limit=40, max_id=last_id, exclude_reblogs=True)
-            if not block:
-                break
-            
-            # 各ブロックを即座に処理してメモリを解放
-            for toot in block:
-                if not self._format_visibility_filter(toot['visibility']):
-                    continue
+        # 次のページの取得は別スレッドで先行させ、ここでは取得済みのページを処理する
+        pages = prefetch(self._pages(since_id))
+        try:
+            for block, cursor in pages:
+                # 新しい順に返るので先頭が最新
+                self._track_newest(block[0]['id'])
                 
-                if toot['content'] and len(toot['content']) > 2:
-                    for l in toot['content'].splitlines():
-                        tx = re.sub(r'<[^>]*>', '', l)
-                        lines.append(format_text(tx))
-                    imported += 1
-            
-            # 進捗を更新
-            if self.job_id and self.job_id in job_status:
-                progress_percent = min(15 + int((imported / target_size) * 65), 80) if target_size > 0 else min(15 + imported, 80)
-                job_status[self.job_id]['progress'] = progress_percent
-                job_status[self.job_id]['progress_str'] = f'投稿を取得しています... (取得済み: {imported}件)'
-            
-            last_id = block[-1]
-            
-            # ブロック処理後にメモリを解放
-            del block
-            gc.collect()
-            
-        return lines, imported, target_size 
+                for toot in block:
+                    if not self._format_visibility_filter(toot['visibility']):
+                        continue
+                    
+                    if toot['content'] and len(toot['content']) > 2:
+                        for l in toot['content'].splitlines():
+                            tx = re.sub(r'<[^>]*>', '', l)
+                            yield format_text(tx)
+                        imported += 1
+                self.imported_count = imported
+                
+                # 進捗を更新
+                if self.job_id:
+                    progress_percent = min(15 + int((imported / target_size) * 65), 80) if target_size > 0 else min(15 + imported, 80)
+                    job_status.update(
+                        self.job_id,
+                        progress=progress_percent,
+                        progress_str=f'投稿を取得しています... (取得済み: {imported}件)',
+                    )
+                self._page_done(cursor)
+        finally:
+            # レート制限の待機中でも先読みスレッドをすぐ止める
+            self.fetcher.cancel()
+            pages.close()
+
+        self.finished = True
@@ -2,12 +2,13 @@ from __future__ import annotations
 
 import math
 import time
-import gc
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 from misskey import Misskey
 from app.utils.helpers import format_text
 from .base import DataImporter
+from .pipeline import prefetch
+from .rate_limit import FetchController
 from app.services.job_manager import job_status  # type: ignore
 
 __all__ = ['MisskeyDataImporter']
@@ -15,61 +16,102 @@ __all__ = ['MisskeyDataImporter']
 
 class MisskeyDataImporter(DataImporter):
     def __init__(self, session_data, token: str, job_id: str = None):
-        super().__init__(session_data)
+        super().__init__(session_data, job_id)
         self.token = token
-        self.mi = Misskey(address=session_data['hostname'], i=token)
-        self.job_id = job_id
+        self.fetcher = FetchController(max_page_size=100, report=self._report_pacing)
+        self.mi = Misskey(address=session_data['hostname'], i=token, session=self.fetcher.session)
 
-    def fetch_lines(self) -> Tuple[List[str], int, int]:
-        # NOTE: progress updating is optional; handled by background_processor
-        lines: List[str] = []
-        imported_count = 0
-        kwargs = {}
-        with_files = False
-
-        # fetch user meta for total count
-        user_block = self.mi.users_show(user_id=self.session_data['user_id'])
-        total = int(user_block.get('notesCount', 0))
+    def _pages(self, since_id: Optional[str] = None) -> Iterator[Tuple[List[dict], dict]]:
+        """Request pages of notes from the newest backwards, following ``until_id``.
 
-        # 進捗更新のための初期設定
-        if self.job_id and self.job_id in job_status:
-            job_status[self.job_id]['progress'] = 15
-            job_status[self.job_id]['progress_str'] = f'投稿を取得しています... (取得済み: 0件)'
+        When *since_id* is given (incremental) only notes newer than it are
+        yielded and paging stops once a page reaches it. Yields ``(page,
+        cursor after the page)``, starting from :attr:`cursor`. Page size and
+        request timing are decided by :attr:`fetcher`.
+        """
+        # sinceId だけを渡すとサーバーによって古い順・新しい順が異なり、新しい順だと
+        # 間の投稿を取りこぼすので、差分取り込みでも untilId で新しい方から遡る
+        kwargs = {}
+        until_id = self.cursor.get('params', {}).get('until_id')
+        if until_id is not None:
+            kwargs['until_id'] = until_id
+        with_files = self.cursor.get('with_files', False)
 
-        for i in range(int(self.session_data['import_size'] / 100) + 1):
-            notes_block = self.mi.users_notes(
+        fetched = self.cursor.get('fetched', 0)
+        import_size = int(self.session_data['import_size'])
+        while fetched <= import_size:
+            notes_block = self.fetcher.request(lambda limit: self.mi.users_notes(
                 self.session_data['user_id'],
                 include_replies=False,
                 include_my_renotes=False,
                 with_files=with_files,
-                limit=100,
+                limit=limit,
                 **kwargs,
-            )
+            ))
             if not notes_block:
-                if not with_files:
+                if not with_files and since_id is None:
                     with_files = True
                     continue
                 break
-            kwargs['until_id'] = notes_block[-1]['id']
-            
-            # 各ブロックを即座に処理してメモリを解放
-            for note in notes_block:
-                if not self._format_visibility_filter(note['visibility']):
-                    continue
+            # ページ内の並び順に依存しないよう最も古い ID を次の untilId にする
+            kwargs['until_id'] = min((note['id'] for note in notes_block), key=self._id_order)
+            reached = False
+            if since_id is not None:
+                newer = [note for note in notes_block if self._id_order(note['id']) > self._id_order(since_id)]
+                reached = len(newer) < len(notes_block)
+                notes_block = newer
+            if notes_block:
+                fetched += len(notes_block)
+                yield notes_block, dict(params=dict(kwargs), with_files=with_files, fetched=fetched)
+            if reached:
+                break
+
+    def iter_lines(self, since_id: Optional[str] = None) -> Iterator[str]:
+        # NOTE: progress updating is optional; handled by background_processor
+        imported_count = self.imported_count
+
+        # fetch user meta for total count
+        user_block = self.fetcher.request(lambda limit: self.mi.users_show(user_id=self.session_data['user_id']))
+        total = int(user_block.get('notesCount', 0))
+        self.total_count = total
+
+        # 進捗更新のための初期設定
+        if self.job_id:
+            job_status.update(
+                self.job_id,
+                progress=15,
+                progress_str=f'投稿を取得しています... (取得済み: {imported_count}件)',
+            )
+
+        # 次のページの取得は別スレッドで先行させ、ここでは取得済みのページを処理する
+        pages = prefetch(self._pages(since_id))
+        try:
+            for notes_block, cursor in pages:
+                for note in notes_block:
+                    self._track_newest(note['id'])
+
+                for note in notes_block:
+                    if not self._format_visibility_filter(note['visibility']):
+                        continue
+                    
+                    if note.get('text') and len(note['text']) > 2:
+                        for l in note['text'].splitlines():
+                            yield format_text(l)
+                        imported_count += 1
+                self.imported_count = imported_count
                 
-                if note.get('text') and len(note['text']) > 2:
-                    for l in note['text'].splitlines():
-                        lines.append(format_text(l))
-                    imported_count += 1
-            
-            # 進捗を更新
-            if self.job_id and self.job_id in job_status:
-                progress_percent = min(15 + int((imported_count / total) * 65), 80) if total > 0 else min(15 + imported_count, 80)
-                job_status[self.job_id]['progress'] = progress_percent
-                job_status[self.job_id]['progress_str'] = f'投稿を取得しています... (取得済み: {imported_count}件)'
-            
-            # ブロック処理後にメモリを解放
-            del notes_block
-            gc.collect()
+                # 進捗を更新
+                if self.job_id:
+                    progress_percent = min(15 + int((imported_count / total) * 65), 80) if total > 0 else min(15 + imported_count, 80)
+                    job_status.update(
+                        self.job_id,
+                        progress=progress_percent,
+                        progress_str=f'投稿を取得しています... (取得済み: {imported_count}件)',
+                    )
+                self._page_done(cursor)
+        finally:
+            # レート制限の待機中でも先読みスレッドをすぐ止める
+            self.fetcher.cancel()
+            pages.close()
 
-        return lines, imported_count, total 
+        self.finished = True
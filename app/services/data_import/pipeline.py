@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
+
+from app.utils.helpers import get_setting
+
+__all__ = ['prefetch']
+
+T = TypeVar('T')
+
+_DONE = object()
+
+
+class _Failure:
+    __slots__ = ('error',)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(pages: Iterable[T], depth: int = None) -> Iterator[T]:
+    """Iterate *pages* on a background thread, keeping up to *depth* items ready.
+
+    The page generator (network requests + cursor handling) runs ahead of the
+    consumer (filtering / normalisation / tokenisation); the bounded queue
+    stops it from running arbitrarily far ahead. Exceptions raised by the
+    producer are re-raised in the consumer. Closing the returned generator
+    early stops the producer after its current request.
+    """
+    if depth is None:
+        depth = get_setting('IMPORT_PREFETCH_PAGES', 4, int)
+    buffer: queue.Queue = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+        except BaseException as e:  # noqa: B902 – forwarded to the consumer
+            put(_Failure(e))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, name=f'{threading.current_thread().name}-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,259 @@
+"""Adaptive pacing for importer page requests.
+
+Both importers fetch a user's posts page by page from a server that limits
+the request rate per token. :class:`FetchController` owns the
+``requests.Session`` handed to the API client, reads the rate-limit headers
+of every response through a response hook and decides before each request
+how long to wait:
+
+* while more than half of the budget is left requests are sent back to back;
+* below that the remaining budget (minus a reserve left for the user's own
+  clients, which share the same limit) is spread evenly until the reset;
+* with the reserve exhausted it waits for the reset.
+
+429 / 5xx responses and network errors are retried with jittered
+exponential backoff (``Retry-After`` / the reset time is honoured when
+given), and server errors halve the page size until requests succeed again.
+
+Clock, sleep and random source are injectable so the behaviour can be
+checked against a local server without real waiting.
+"""
+
+from __future__ import annotations
+
+import email.utils
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional, Tuple, TypeVar
+
+import requests
+
+from app.services.http_client import USER_AGENT
+from app.utils.helpers import get_setting
+
+__all__ = ['FetchController']
+
+T = TypeVar('T')
+
+# 残りがこの割合を下回ったら均等に間隔を空け始める
+_PACE_BELOW = 0.5
+# 利用者自身のクライアント用に残しておく割合
+_RESERVE_RATIO = 0.1
+# これより短い待機は進捗に表示しない
+_REPORT_MIN_WAIT = 1.0
+# 連続でこの回数成功したらページサイズを戻す
+_GROW_AFTER = 3
+
+
+def _parse_header_time(value: str) -> Optional[float]:
+    """Parse an ISO 8601 / HTTP date into a UNIX timestamp."""
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            parsed = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _seconds_until(value: Optional[str], server_now: float) -> Optional[float]:
+    """Seconds until the time in a reset / ``Retry-After`` header.
+
+    Accepts a delay in seconds, a UNIX timestamp or an ISO 8601 / HTTP date
+    (Mastodon sends ISO 8601). Absolute times are compared with the server's
+    ``Date`` so clock skew does not matter.
+    """
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        stamp = _parse_header_time(value)
+        return None if stamp is None else max(stamp - server_now, 0.0)
+    if number > 1e9:
+        return max(number - server_now, 0.0)
+    return max(number, 0.0)
+
+
+def _header_int(headers, *names: str) -> Optional[int]:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return int(float(value))
+            except ValueError:
+                return None
+    return None
+
+
+class FetchController:
+    """Paces and retries page requests against one server.
+
+    Create one per import and pass :attr:`session` to the API client. Each
+    page request goes through :meth:`request`, which calls
+    ``fetch(page_size)`` once it is allowed to and returns its result.
+    Pacing decisions are passed to *report* as short messages for the job
+    progress.
+    """
+
+    def __init__(
+        self,
+        max_page_size: int,
+        min_page_size: int = 10,
+        report: Callable[[str], Any] = None,
+        clock: Callable[[], float] = time.monotonic,
+        wall_clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], Any] = None,
+        rng: random.Random = None,
+    ):
+        self.max_page_size = max_page_size
+        self.min_page_size = min(min_page_size, max_page_size)
+        self.page_size = max_page_size
+        self.max_retries = get_setting('IMPORT_MAX_RETRIES', 5, int)
+        self.backoff_base = get_setting('IMPORT_BACKOFF_BASE', 1.0, float)
+        self.backoff_max = get_setting('IMPORT_BACKOFF_MAX', 60.0, float)
+
+        self._report = report
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._cancelled = threading.Event()
+        self._sleep = sleep if sleep is not None else self._cancelled.wait
+        self._rng = rng if rng is not None else random.Random()
+
+        # 直近のレスポンスから読み取ったレート制限の状態 (時刻は clock 基準)
+        self._limit: Optional[int] = None
+        self._remaining: Optional[int] = None
+        self._reset_at: Optional[float] = None
+        self._retry_after: Optional[float] = None
+        self._last_status: Optional[int] = None
+        self._last_request_at: Optional[float] = None
+        self._successes = 0
+
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        self.session.hooks['response'].append(self._observe)
+
+    # ------------------------------------------------------------------
+    # Response hook
+    # ------------------------------------------------------------------
+    def _observe(self, response: requests.Response, *args, **kwargs) -> None:
+        headers = response.headers
+        now = self._clock()
+        server_now = self._wall_clock()
+        if headers.get('Date'):
+            server_now = _parse_header_time(headers['Date']) or server_now
+
+        self._last_status = response.status_code
+        self._retry_after = _seconds_until(headers.get('Retry-After'), server_now)
+
+        remaining = _header_int(headers, 'X-RateLimit-Remaining', 'RateLimit-Remaining')
+        reset_in = _seconds_until(headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset'), server_now)
+        if remaining is not None and reset_in is not None:
+            self._remaining = remaining
+            self._reset_at = now + reset_in
+            self._limit = _header_int(headers, 'X-RateLimit-Limit', 'RateLimit-Limit') or self._limit
+
+    # ------------------------------------------------------------------
+    # Pacing
+    # ------------------------------------------------------------------
+    def _pace_delay(self, now: float) -> Tuple[float, Optional[str]]:
+        """How long to wait before the next request, and why."""
+        if self._remaining is None or self._reset_at is None:
+            return 0.0, None
+        window = self._reset_at - now
+        if window <= 0:
+            # リセット済み: 次のレスポンスで新しい値が分かる
+            self._remaining = None
+            return 0.0, None
+
+        limit = max(self._limit or 0, self._remaining, 1)
+        reserve = max(1, int(limit * _RESERVE_RATIO))
+        usable = self._remaining - reserve
+        if usable <= 0:
+            return window, f'レート制限の上限に達したため {window:.0f} 秒待機しています'
+        if self._remaining >= limit * _PACE_BELOW or self._last_request_at is None:
+            return 0.0, None
+        interval = window / usable
+        delay = max(self._last_request_at + interval - now, 0.0)
+        return delay, f'レート制限に合わせて {interval:.1f} 秒間隔で取得しています (残り {self._remaining}/{limit} 回)'
+
+    def _wait(self, seconds: float, message: str = None) -> None:
+        if seconds <= 0:
+            return
+        if message and seconds >= _REPORT_MIN_WAIT:
+            self._notify(message)
+        self._sleep(seconds)
+        if self._cancelled.is_set():
+            raise InterruptedError('import cancelled')
+
+    def _notify(self, message: str) -> None:
+        if self._report is not None:
+            self._report(message)
+
+    def _backoff(self, attempt: int) -> float:
+        """Delay before retry *attempt* (0-based) after a failed request."""
+        if self._retry_after is not None:
+            return self._retry_after + self._rng.uniform(0, self.backoff_base)
+        if self._last_status == 429 and self._reset_at is not None:
+            until_reset = self._reset_at - self._clock()
+            if until_reset > 0:
+                return until_reset + self._rng.uniform(0, self.backoff_base)
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        # equal jitter: 同時に失敗した他のジョブと再試行が揃わないようにする
+        return ceiling / 2 + self._rng.uniform(0, ceiling / 2)
+
+    def _retryable(self, error: Exception) -> bool:
+        status = self._last_status
+        if status is not None:
+            return status == 429 or 500 <= status < 600
+        # レスポンスが無い = 接続エラー / タイムアウト (requests / Mastodon.py とも OSError 系)
+        return isinstance(error, OSError)
+
+    def request(self, fetch: Callable[[int], T]) -> T:
+        """Call ``fetch(page_size)`` after pacing, retrying transient failures."""
+        attempt = 0
+        while True:
+            delay, message = self._pace_delay(self._clock())
+            self._wait(delay, message)
+
+            self._last_status = None
+            self._retry_after = None
+            self._last_request_at = self._clock()
+            try:
+                result = fetch(self.page_size)
+            except Exception as e:
+                if attempt >= self.max_retries or not self._retryable(e):
+                    raise
+                status = self._last_status
+                if status is None or status >= 500:
+                    # 重いページでタイムアウトしている可能性があるので小さくして取り直す
+                    self.page_size = max(self.min_page_size, self.page_size // 2)
+                self._successes = 0
+                delay = self._backoff(attempt)
+                attempt += 1
+                if status == 429:
+                    reason = 'レート制限に達しました'
+                elif status is not None:
+                    reason = f'サーバーエラー (HTTP {status})'
+                else:
+                    reason = '通信エラー'
+                message = f'{reason}: {delay:.0f} 秒後に再試行します ({attempt}/{self.max_retries}、1 回 {self.page_size} 件)'
+                # 再試行は待ち時間が短くても表示する
+                self._notify(message)
+                self._wait(delay)
+                continue
+
+            self._successes += 1
+            if self.page_size < self.max_page_size and self._successes >= _GROW_AFTER:
+                self.page_size = min(self.max_page_size, self.page_size * 2)
+                self._successes = 0
+            return result
+
+    def cancel(self) -> None:
+        """Abort any wait in progress; the pending :meth:`request` raises ``InterruptedError``."""
+        self._cancelled.set()
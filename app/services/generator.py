@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import markovify
+from markovify.chain import BEGIN
+from markovify.text import DEFAULT_MAX_OVERLAP_RATIO, DEFAULT_MAX_OVERLAP_TOTAL
+
+from app.models.compact_model import CompactChain, load_model, begin_words
+from app.models.model_store import get_model_data, get_start_index_data
+from app.models.start_index import StartWordIndex
+from app.services.model_cache import model_cache, start_index_cache, estimate_model_bytes
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'DEFAULT_TRIES',
+    'REJECT_DEAD_END',
+    'GenerationResult',
+    'can_generate',
+    'default_budget_ms',
+    'generate_sentence',
+    'load_text_model',
+    'load_start_index',
+    'make_sentence',
+    'new_seed',
+]
+
+DEFAULT_TRIES = 100
+
+# 生成を打ち切った理由
+REJECT_TOO_SHORT = 'too_short'
+REJECT_OVERLAP = 'overlap'
+REJECT_DEAD_END = 'dead_end'
+
+# 文の途中でも時間切れを確認する間隔 (単語数)
+_DEADLINE_CHECK_WORDS = 32
+
+
+@dataclass
+class GenerationResult:
+    """Outcome of :func:`generate_sentence`.
+
+    ``rejections`` counts discarded walks by reason: ``too_short`` (fewer
+    than ``min_words``), ``overlap`` (too close to the training posts) and
+    ``dead_end`` (the chain has no way to continue from the start state).
+    """
+
+    text: Optional[str] = None
+    # 再現できる生成だった場合のシード (markovify JSON のモデルでは None)
+    seed: Optional[int] = None
+    tries: int = 0
+    rejections: Dict[str, int] = field(default_factory=dict)
+    elapsed_ms: float = 0.0
+    timed_out: bool = False
+
+    def reject(self, reason: str) -> None:
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            tries=self.tries,
+            rejections=dict(self.rejections),
+            elapsed_ms=round(self.elapsed_ms, 3),
+            timed_out=self.timed_out,
+        )
+
+
+def new_seed() -> int:
+    """Random seed for :func:`generate_sentence` (what share links embed)."""
+    return random.getrandbits(32)
+
+
+def default_budget_ms() -> float:
+    """Server-wide time budget of one generation (``GENERATE_TIME_BUDGET_MS``, 0: unlimited)."""
+    return get_setting('GENERATE_TIME_BUDGET_MS', 250, float)
+
+
+def can_generate(meta: Dict[str, Any], session_acct: Optional[str]) -> bool:
+    """Return True if *session_acct* may generate from the model described by *meta*."""
+    return session_acct == meta['acct'] or bool(meta['allow_generate_by_other'])
+
+
+def load_text_model(acct: str, meta: Dict[str, Any]) -> markovify.Text:
+    """Return the model for *acct*, reading the blob only on a cache miss."""
+
+    def _load():
+        data = get_model_data(acct)
+        if data is None:
+            raise LookupError(f'model data for {acct} is missing')
+        model = load_model(data)
+        return model, estimate_model_bytes(model, meta['byte_size'])
+
+    # キャッシュ (モデルのバージョンが一致する場合のみ) から取得、なければ読み込む
+    return model_cache.get_or_load(acct, meta['version'], _load)
+
+
+def make_sentence(text_model: markovify.Text, min_words: int = 1, startswith: str = '') -> Optional[str]:
+    """Generate one space-separated sentence, or ``None`` if generation failed."""
+    return generate_sentence(text_model, min_words, startswith).text
+
+
+def generate_sentence(
+    text_model: markovify.Text,
+    min_words: int = 1,
+    startswith: str = '',
+    budget_ms: Optional[float] = None,
+    seed: Optional[int] = None,
+) -> GenerationResult:
+    """Generate one space-separated sentence within *budget_ms* milliseconds.
+
+    Works like markovify's ``make_sentence`` / ``make_sentence_with_start``
+    (strict) with ``DEFAULT_TRIES`` tries, but stops as soon as the budget
+    (``default_budget_ms()`` if omitted, 0 for no limit) runs out, also in
+    the middle of a walk.
+
+    With *seed*, the same model version and parameters always give the same
+    result (unless the budget runs out first). Legacy markovify models
+    ignore the seed; ``result.seed`` tells whether it was used.
+    """
+    started = time.perf_counter()
+    if budget_ms is None:
+        budget_ms = default_budget_ms()
+    deadline = started + budget_ms / 1000 if budget_ms > 0 else None
+    result = GenerationResult()
+    rng = None
+    if seed is not None and isinstance(text_model.chain, CompactChain):
+        rng = random.Random(seed)
+        result.seed = seed
+
+    init_state = _start_state(text_model, startswith) if startswith else None
+    if startswith and init_state is None:
+        result.reject(REJECT_DEAD_END)
+    else:
+        _sample(text_model, init_state, min_words, deadline, rng, result)
+
+    result.elapsed_ms = (time.perf_counter() - started) * 1000
+    return result
+
+
+def _start_state(text_model: markovify.Text, startswith: str) -> Optional[Tuple[str, ...]]:
+    # make_sentence_with_start(strict=True) と同じ開始状態
+    words = tuple(text_model.word_split(startswith))
+    if not 0 < len(words) <= text_model.state_size:
+        return None
+    return (BEGIN,) * (text_model.state_size - len(words)) + words
+
+
+def _sample(
+    text_model: markovify.Text,
+    init_state: Optional[Tuple[str, ...]],
+    min_words: int,
+    deadline: Optional[float],
+    rng: Optional[random.Random],
+    result: GenerationResult,
+) -> None:
+    prefix = [w for w in init_state if w != BEGIN] if init_state else []
+    # markovify は元の文を残している場合だけ、CompactText は独自性フィルタがある場合も重複を確認する
+    test_output = getattr(text_model, 'originality', None) is not None or hasattr(text_model, 'rejoined_text')
+
+    while result.tries < DEFAULT_TRIES:
+        if deadline is not None and time.perf_counter() >= deadline:
+            result.timed_out = True
+            return
+        result.tries += 1
+        try:
+            words = _walk(text_model.chain, init_state, prefix, deadline, rng)
+        except KeyError:
+            # 開始状態から先に進めない (何度試しても同じ)
+            result.reject(REJECT_DEAD_END)
+            return
+        if words is None:
+            result.timed_out = True
+            return
+        if len(words) < min_words:
+            result.reject(REJECT_TOO_SHORT)
+            continue
+        if test_output and not text_model.test_sentence_output(words, DEFAULT_MAX_OVERLAP_RATIO, DEFAULT_MAX_OVERLAP_TOTAL):
+            result.reject(REJECT_OVERLAP)
+            continue
+        result.text = text_model.word_join(words)
+        return
+
+
+def _walk(chain, init_state, prefix: List[str], deadline: Optional[float], rng) -> Optional[List[str]]:
+    """One run of the chain, or ``None`` if the deadline passed meanwhile."""
+    words = list(prefix)
+    for word in chain.gen(init_state, rng) if rng is not None else chain.gen(init_state):
+        words.append(word)
+        if deadline is not None and len(words) % _DEADLINE_CHECK_WORDS == 0 and time.perf_counter() >= deadline:
+            return None
+    return words
+
+
+def load_start_index(acct: str, meta: Dict[str, Any]) -> StartWordIndex:
+    """Return the sentence-start word index for *acct* without touching the chain.
+
+    Models saved before the index existed get one built from the loaded model
+    (once; the result is cached like a stored index).
+    """
+
+    def _load():
+        data = get_start_index_data(acct)
+        if data is not None:
+            index = StartWordIndex.from_bytes(data)
+        else:
+            index = StartWordIndex.build(begin_words(load_text_model(acct, meta)))
+        return index, index.nbytes()
+
+    return start_index_cache.get_or_load(acct, meta['version'], _load)
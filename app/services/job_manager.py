@@ -1,49 +1,82 @@
 import threading
 import traceback
-from datetime import datetime
-from datetime import timedelta
-from typing import Dict, Any
+from typing import Dict
+
+from app.models.job_status_store import create_job_status_store
 
 __all__ = [
     'job_status',
-    'cleanup_completed_jobs',
+    'crashed_job_status',
+    'expire_job_statuses',
+    'notify_job_changed',
+    'wait_job_changed',
 ]
 
-# Shared job status dictionary (previously global in web.py)
-job_status: dict[str, dict] = {}
-
-# ジョブの最大保持時間（秒）
-MAX_JOB_AGE = timedelta(hours=1)  # 1時間
+# 進捗が更新されたジョブを待っている SSE ストリームを起こすためのカウンタ
+_job_versions: Dict[str, int] = {}
+_job_changed = threading.Condition()
 
 
-def _proc_error_hook(args):  # type: ignore[param-type]
-    """Threading exception hook that records unexpected thread errors."""
-    print(''.join(traceback.format_exception(args.exc_type, args.exc_value, args.exc_traceback)))
-    job_status[args.thread.name] = {
+def crashed_job_status(exc_type, exc_value) -> dict:
+    """Status recorded for a job that died with an unexpected exception."""
+    return {
         'completed': True,
         'error': (
             'スレッドが異常終了しました<br>'
-            f'<strong>{args.exc_type.__name__}</strong>'
-            f'<div>{str(args.exc_value)}</div>'
+            f'<strong>{exc_type.__name__}</strong>'
+            f'<div>{str(exc_value)}</div>'
         ),
-        'completed_at': datetime.now(),
     }
 
 
-def cleanup_completed_jobs():
-    """完了したジョブを一定時間後に削除する"""
-    current_time = datetime.now()
-    jobs_to_remove = []
+def notify_job_changed(job_id: str) -> None:
+    """Wake up streams waiting for *job_id* after its status was replaced / updated."""
+    with _job_changed:
+        _job_versions[job_id] = _job_versions.get(job_id, 0) + 1
+        _job_changed.notify_all()
+
+
+def wait_job_changed(job_id: str, version: int, timeout: float) -> int:
+    """Wait until *job_id* changes from *version* (or *timeout*); return the current version.
+
+    Only writes made by this process notify (other processes sharing the
+    SQLite backend do not), so callers should compare the status itself
+    after a timeout.
+    """
+    with _job_changed:
+        _job_changed.wait_for(lambda: _job_versions.get(job_id, 0) != version, timeout)
+        return _job_versions.get(job_id, 0)
+
+
+def _proc_error_hook(args):  # type: ignore[param-type]
+    """Threading exception hook that logs unexpected thread errors.
+
+    If the thread was running a job, that job is marked as crashed.
+    """
+    print(''.join(traceback.format_exception(args.exc_type, args.exc_value, args.exc_traceback)))
+    from app.services.job_queue import job_queue  # noqa: WPS433
+
+    # スレッド名はジョブ ID ではないので、ジョブキューに実行中のジョブを尋ねる
+    job_id = job_queue.crashed_job(args.thread) if args.thread is not None else None
+    if job_id is not None:
+        job_status[job_id] = crashed_job_status(args.exc_type, args.exc_value)
+
 
-    for job_id, job_info in job_status.items():
-        if job_info.get('completed'):
-            completed_at = job_info.get('completed_at', 0)
-            if current_time - completed_at > MAX_JOB_AGE:
-                jobs_to_remove.append(job_id)
+def expire_job_statuses() -> None:
+    """Drop expired job statuses (``JOB_STATUS_TTL``) and their change counters."""
+    job_status.purge_expired()
+    with _job_changed:
+        job_ids = list(_job_versions)
+    gone = [job_id for job_id in job_ids if job_id not in job_status]
+    with _job_changed:
+        for job_id in gone:
+            _job_versions.pop(job_id, None)
+        # 待っているストリームに消えたことを知らせる
+        _job_changed.notify_all()
 
-    for job_id in jobs_to_remove:
-        job_status.pop(job_id, None)
 
+# Shared job status store (previously a dict global in web.py)
+job_status = create_job_status_store(on_change=notify_job_changed)
 
 # Register as default exception hook for all new threads
 threading.excepthook = _proc_error_hook
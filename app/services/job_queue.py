@@ -0,0 +1,305 @@
+"""Bounded worker pool draining the persistent training job queue.
+
+Logins enqueue a job (see :mod:`app.models.job_store`) instead of starting
+a thread of their own; ``JOB_WORKERS`` threads take jobs in FIFO order, so a
+burst of logins waits in the queue rather than running dozens of MeCab /
+chain builds at once. Because the queue lives in SQLite, jobs survive a
+restart: a maintenance thread keeps the heartbeat of this process' running
+jobs fresh and puts jobs whose heartbeat stopped (the process died) back into
+the queue, where they resume from their import checkpoint.
+
+Each job runs in a child process of its own (``JOB_SUBPROCESS``), so
+training never holds the web process' GIL and all of its memory is returned
+to the OS when the child exits. With a shared ``job_status`` backend the
+child writes its progress there directly; otherwise it sends its entry back
+over a pipe whenever it changes.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional
+
+from app.models.job_store import (
+    cancel_queued_job,
+    claim_next_job,
+    enqueue_job,
+    finish_job,
+    get_job_acct,
+    get_job_state,
+    purge_finished_jobs,
+    queue_position,
+    requeue_stale_jobs,
+    touch_jobs,
+)
+from app.services.job_manager import crashed_job_status, expire_job_statuses, job_status
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'JobCancelled',
+    'JobQueue',
+    'job_queue',
+]
+
+Handler = Callable[[str, Dict[str, Any]], None]
+
+# 空のキューを見に行く間隔 (他プロセスが積んだジョブにも気付けるように)
+_POLL_SECONDS = 5.0
+_HEARTBEAT_SECONDS = 15.0
+# 終了したジョブの行を残しておく時間
+_FINISHED_MAX_AGE = 24 * 60 * 60
+# 子プロセスが進捗を送る間隔
+_REPORT_SECONDS = 0.5
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once its cancellation was requested."""
+
+
+def _queued_status() -> dict:
+    return dict(completed=False, error=None, progress=0, progress_str='順番待ちです', queued=True)
+
+
+def _cancelled_status() -> dict:
+    return dict(completed=True, error='ジョブはキャンセルされました', cancelled=True)
+
+
+def _mp_context():
+    # fork は Web プロセスのスレッドや SQLite 接続まで複製してしまうので避ける
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+def _child_main(handler: Handler, job_id: str, payload: Dict[str, Any], status: dict, conn, cancel) -> None:
+    """Entry point of a job process: run *handler* and stream ``job_status[job_id]`` to *conn*.
+
+    With a shared ``job_status`` backend the parent reads the status from
+    there, and nothing is sent.
+    """
+    job_queue._running[job_id] = cancel
+    job_queue._threads[threading.get_ident()] = job_id
+    streamed = not job_status.shared
+    if streamed:
+        job_status[job_id] = status
+    stop = threading.Event()
+
+    def report():
+        last = None
+        while not stop.wait(_REPORT_SECONDS):
+            current = job_status.get(job_id)
+            if current is not None and current != last:
+                last = dict(current)
+                conn.send(last)
+
+    reporter = threading.Thread(target=report, name=f'{job_id}-report', daemon=True)
+    if streamed:
+        reporter.start()
+    try:
+        handler(job_id, payload)
+    except JobCancelled:
+        pass
+    except Exception as e:
+        traceback.print_exc()
+        job_status[job_id] = crashed_job_status(type(e), e)
+    finally:
+        stop.set()
+        if streamed:
+            reporter.join()
+            conn.send(job_status.get(job_id, {}))
+        conn.close()
+
+
+class JobQueue:
+    """Runs queued jobs on a fixed number of worker threads.
+
+    Handlers are registered per job kind and called as
+    ``handler(job_id, payload)``; they report progress through
+    ``job_status`` as before. Workers are started on first use.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self._wakeup = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._started = False
+        # このプロセスで実行中のジョブとキャンセル要求
+        self._running: Dict[str, threading.Event] = {}
+        # ジョブを実行中のスレッド (ident) とそのジョブ ID
+        self._threads: Dict[int, str] = {}
+
+    def register(self, kind: str, handler: Handler) -> None:
+        self._handlers[kind] = handler
+
+    def start(self) -> None:
+        """Start the worker and maintenance threads (once)."""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        workers = max(get_setting('JOB_WORKERS', 2, int), 1)
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True).start()
+        threading.Thread(target=self._maintain, name='job-maintenance', daemon=True).start()
+
+    def submit(self, job_id: str, kind: str, acct: str, payload: Dict[str, Any], dedup_key: str = None) -> str:
+        """Queue a job; its status shows the queue position until a worker takes it.
+
+        Returns the ID to follow: *job_id*, or that of a queued / running job
+        submitted with the same *dedup_key*, in which case nothing is queued.
+        """
+        job_status[job_id] = _queued_status()
+        queued_id = enqueue_job(job_id, kind, acct, payload, dedup_key)
+        if queued_id != job_id:
+            job_status.pop(job_id)
+            return queued_id
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def position(self, job_id: str) -> Optional[int]:
+        return queue_position(job_id)
+
+    def state(self, job_id: str) -> Optional[str]:
+        return get_job_state(job_id)
+
+    def owner(self, job_id: str) -> Optional[str]:
+        return get_job_acct(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued job, or ask a running one to stop; False if neither."""
+        if cancel_queued_job(job_id):
+            job_status[job_id] = _cancelled_status()
+            return True
+        event = self._running.get(job_id)
+        if event is not None:
+            event.set()
+        elif not (job_status.shared and get_job_state(job_id) == 'running'):
+            return False
+        # 他のプロセスで実行中なら、そのプロセスの保守スレッドがこれを見て止める
+        job_status.update(job_id, cancel_requested=True, progress_str='キャンセルしています...')
+        return True
+
+    def crashed_job(self, thread: threading.Thread) -> Optional[str]:
+        """Return (and forget) the job *thread* was running when it died, if any."""
+        return self._threads.pop(thread.ident, None)
+
+    def check_cancelled(self, job_id: str) -> None:
+        """Raise :class:`JobCancelled` if cancelling *job_id* was requested."""
+        event = self._running.get(job_id)
+        if event is not None and event.is_set():
+            raise JobCancelled('ジョブはキャンセルされました')
+
+    # ------------------------------------------------------------------
+    # Threads
+    # ------------------------------------------------------------------
+    def _work(self) -> None:
+        while True:
+            try:
+                job = claim_next_job()
+            except Exception as e:
+                print(f"[ERROR] Failed to read job queue: {e!r}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=_POLL_SECONDS)
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job['job_id']
+        # 例外で抜けた場合は excepthook が crashed_job() で引けるよう残しておく
+        self._threads[threading.get_ident()] = job_id
+        isolated = get_setting('JOB_SUBPROCESS', True, bool)
+        cancel = self._running[job_id] = _mp_context().Event() if isolated else threading.Event()
+        starting = dict(queued=False, progress=1, progress_str='初期化中です')
+        if not job_status.update(job_id, **starting):
+            job_status[job_id] = dict(_queued_status(), **starting)
+
+        state = 'done'
+        try:
+            if isolated:
+                self._run_process(self._handlers[job['kind']], job_id, job['payload'], cancel)
+            else:
+                self._handlers[job['kind']](job_id, job['payload'])
+            if job_status.get(job_id, {}).get('error'):
+                state = 'failed'
+        except JobCancelled:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            job_status[job_id] = crashed_job_status(type(e), e)
+            state = 'failed'
+        finally:
+            self._running.pop(job_id, None)
+
+        if cancel.is_set():
+            job_status[job_id] = _cancelled_status()
+            state = 'cancelled'
+        try:
+            finish_job(job_id, state)
+        except Exception as e:
+            print(f"[ERROR] Failed to record job {job_id} as {state}: {e!r}")
+        self._threads.pop(threading.get_ident(), None)
+
+    def _run_process(self, handler: Handler, job_id: str, payload: Dict[str, Any], cancel) -> None:
+        """Run one job in a fresh child process, copying its status updates into ``job_status``."""
+        ctx = _mp_context()
+        receiver, sender = ctx.Pipe(duplex=False)
+        process = ctx.Process(
+            target=_child_main,
+            args=(handler, job_id, payload, job_status.get(job_id), sender, cancel),
+            name=f'job-{job_id}',
+        )
+        process.start()
+        sender.close()
+        try:
+            while True:
+                if not receiver.poll(1.0):
+                    self._check_cancel_request(job_id, cancel)
+                    continue
+                try:
+                    job_status[job_id] = receiver.recv()
+                except EOFError:
+                    break
+        finally:
+            receiver.close()
+            process.join()
+
+        if process.exitcode != 0 and not job_status.get(job_id, {}).get('completed'):
+            # MeCab のクラッシュやメモリ不足で強制終了された場合など
+            job_status[job_id] = dict(
+                completed=True,
+                error=f'学習プロセスが異常終了しました (終了コード: {process.exitcode})',
+            )
+
+    def _check_cancel_request(self, job_id: str, event) -> None:
+        """Stop a local job whose cancellation was requested through another process."""
+        if job_status.shared and not event.is_set() and job_status.get(job_id, {}).get('cancel_requested'):
+            event.set()
+
+    def _maintain(self) -> None:
+        stale_after = get_setting('JOB_STALE_SECONDS', 120.0, float)
+        while True:
+            try:
+                touch_jobs(list(self._running))
+                # 子プロセスを使わない場合はここでしか気付けない
+                for job_id, event in list(self._running.items()):
+                    self._check_cancel_request(job_id, event)
+                requeued = requeue_stale_jobs(stale_after)
+                if requeued:
+                    print(f"[INFO] Requeued {len(requeued)} interrupted job(s)")
+                    with self._wakeup:
+                        self._wakeup.notify_all()
+                purge_finished_jobs(_FINISHED_MAX_AGE)
+                expire_job_statuses()
+            except Exception as e:
+                print(f"[WARNING] Job queue maintenance failed: {e!r}")
+            time.sleep(_HEARTBEAT_SECONDS)
+
+
+# Shared queue for the whole process
+job_queue = JobQueue()
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.utils.helpers import format_bytes, get_setting
+
+__all__ = [
+    'ModelCache',
+    'estimate_model_bytes',
+    'model_cache',
+    'response_cache',
+    'start_index_cache',
+]
+
+# markovify JSON から復元したモデルは保存サイズの数倍のメモリを使う
+_LEGACY_MEMORY_FACTOR = 4
+
+
+def estimate_model_bytes(model: Any, stored_size: int = 0) -> int:
+    """Estimate the in-memory size of a loaded model.
+
+    Compact models report their own footprint; legacy markovify models fall
+    back to a multiple of the stored (serialised) size.
+    """
+    nbytes = getattr(model, 'nbytes', None)
+    if callable(nbytes):
+        return nbytes()
+    return stored_size * _LEGACY_MEMORY_FACTOR
+
+
+@dataclass
+class _Entry:
+    model: Any
+    version: str
+    size: int
+    last_access: float
+
+
+class ModelCache:
+    """LRU cache of loaded models bounded by estimated memory usage.
+
+    Entries are keyed by ``acct`` and tagged with the model version written by
+    the training job; a lookup with a different version drops the stale entry.
+    Entries that have not been accessed for ``idle_expiry`` seconds expire.
+    """
+
+    def __init__(self, max_bytes: int, idle_expiry: float):
+        self.max_bytes = max_bytes
+        self.idle_expiry = idle_expiry
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: Dict[Tuple[str, str], threading.Lock] = {}
+        self._current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # -------------------- internal helpers (lock held) --------------------
+    def _remove(self, acct: str) -> None:
+        entry = self._entries.pop(acct)
+        self._current_bytes -= entry.size
+
+    def _expire(self, now: float) -> None:
+        # OrderedDict は最終アクセス順なので先頭から期限切れを取り除けばよい
+        while self._entries:
+            acct, entry = next(iter(self._entries.items()))
+            if now - entry.last_access <= self.idle_expiry:
+                break
+            self._remove(acct)
+            self.expirations += 1
+
+    def _evict_for(self, size: int) -> None:
+        while self._entries and self._current_bytes + size > self.max_bytes:
+            acct = next(iter(self._entries))
+            self._remove(acct)
+            self.evictions += 1
+
+    # -------------------- public API --------------------
+    def get(self, acct: str, version: str) -> Optional[Any]:
+        """Return the cached model for *acct* if it matches *version*."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(acct)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.version != version:
+                self._remove(acct)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            entry.last_access = now
+            self._entries.move_to_end(acct)
+            self.hits += 1
+            return entry.model
+
+    def put(self, acct: str, version: str, model: Any, size: int) -> bool:
+        """Store *model*; returns False if it is larger than the whole budget."""
+        if size > self.max_bytes:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if acct in self._entries:
+                self._remove(acct)
+            self._evict_for(size)
+            self._entries[acct] = _Entry(model=model, version=version, size=size, last_access=now)
+            self._current_bytes += size
+        return True
+
+    def get_or_load(self, acct: str, version: str, loader: Callable[[], Tuple[Any, int]]) -> Any:
+        """Return the cached model or call *loader* (once per key) to load it.
+
+        ``loader`` returns ``(model, estimated_bytes)``. Concurrent misses for
+        the same ``(acct, version)`` wait for a single load instead of
+        deserialising the same blob in parallel.
+        """
+        model = self.get(acct, version)
+        if model is not None:
+            return model
+
+        key = (acct, version)
+        with self._lock:
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        try:
+            with load_lock:
+                with self._lock:
+                    entry = self._entries.get(acct)
+                    if entry is not None and entry.version == version:
+                        entry.last_access = time.monotonic()
+                        self._entries.move_to_end(acct)
+                        return entry.model
+                model, size = loader()
+                self.put(acct, version, model, size)
+                return model
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def invalidate(self, acct: str) -> None:
+        """Drop any cached model for *acct* (e.g. after deletion)."""
+        with self._lock:
+            if acct in self._entries:
+                self._remove(acct)
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters and current usage."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def __repr__(self) -> str:
+        st = self.stats()
+        return (
+            f"ModelCache(entries={st['entries']}, bytes={format_bytes(st['bytes'])}/{format_bytes(st['max_bytes'])}, "
+            f"hits={st['hits']}, misses={st['misses']}, evictions={st['evictions']})"
+        )
+
+
+# Shared process-wide cache
+model_cache = ModelCache(
+    max_bytes=get_setting('MODEL_CACHE_MAX_BYTES', 256 * 1024 * 1024, int),
+    idle_expiry=get_setting('MODEL_CACHE_IDLE_EXPIRY', 1800, float),
+)
+
+# Start word indexes are small, so they get their own budget and survive
+# eviction of the (much larger) models they belong to.
+start_index_cache = ModelCache(
+    max_bytes=get_setting('START_INDEX_CACHE_MAX_BYTES', 32 * 1024 * 1024, int),
+    idle_expiry=get_setting('MODEL_CACHE_IDLE_EXPIRY', 1800, float),
+)
+
+# Rendered /generate/do pages of seeded requests (reproducible, so repeat
+# visitors of a shared link are served without touching the chain), stored
+# UTF-8 encoded so the budget counts bytes. Keys combine the account and
+# parameters; entries are tagged with the model version like the models
+# themselves.
+response_cache = ModelCache(
+    max_bytes=get_setting('GENERATE_CACHE_MAX_BYTES', 16 * 1024 * 1024, int),
+    idle_expiry=get_setting('MODEL_CACHE_IDLE_EXPIRY', 1800, float),
+)
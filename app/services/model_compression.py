@@ -0,0 +1,84 @@
+"""Background recompression of stored models.
+
+Models saved before compression existed (or with another ``MODEL_CODEC``)
+are rewritten one at a time by a low-priority thread of the web process,
+so no maintenance window is needed. Every server process runs the thread,
+but each model is claimed by the first one to get to it (see
+:func:`~app.models.model_store.recompress_model`). Each conversion is
+logged with the size ratio and the load time before / after, which shows
+the trade-off per model size; a summary follows at the end.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+from app.models.blob_codec import default_codec
+from app.models.model_store import get_model_data, get_model_storage, recompress_model
+from app.utils.helpers import format_bytes, get_setting
+
+__all__ = [
+    'start_model_compression',
+]
+
+# 書き込み用接続を学習ジョブや他のリクエストに譲るため、1 件ごとに空ける時間
+_PAUSE_SECONDS = 1.0
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def _timed_load(acct: str) -> float:
+    started = time.perf_counter()
+    get_model_data(acct)
+    return time.perf_counter() - started
+
+
+def _compress_stored_models() -> None:
+    codec = default_codec()
+    pending = get_model_storage(codec)
+    if not pending:
+        return
+    print(f"[INFO] Recompressing {len(pending)} stored model(s) with {codec}")
+
+    raw_total = stored_total = 0
+    for row in pending:
+        try:
+            before = _timed_load(row['acct'])
+            result = recompress_model(row['acct'], row['version'], codec)
+            if result is None:
+                # 学習し直された / 他のプロセスが変換中か変換済み
+                continue
+            used, stored_size = result
+            after = _timed_load(row['acct'])
+        except Exception as e:
+            print(f"[WARNING] Failed to recompress model of {row['acct']}: {e!r}")
+            continue
+
+        raw_total += row['byte_size']
+        stored_total += stored_size
+        print(
+            f"[INFO] Model {row['acct']} ({format_bytes(row['byte_size'])}): "
+            f"{row['codec'] or 'uncompressed'} {format_bytes(row['stored_size'])} -> {used} {format_bytes(stored_size)} "
+            f"({stored_size / max(row['byte_size'], 1):.0%}), load {before * 1000:.1f} ms -> {after * 1000:.1f} ms"
+        )
+        time.sleep(_PAUSE_SECONDS)
+
+    if raw_total:
+        print(
+            f"[INFO] Recompressed models: {format_bytes(raw_total)} -> {format_bytes(stored_total)} "
+            f"({stored_total / raw_total:.0%})"
+        )
+
+
+def start_model_compression() -> None:
+    """Start recompressing stored models in the background (once per process)."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    if not get_setting('MODEL_COMPRESS_EXISTING', True, bool):
+        return
+    threading.Thread(target=_compress_stored_models, name='model-compression', daemon=True).start()
@@ -0,0 +1,230 @@
+"""Pre-generated sentences for frequently requested models.
+
+``/generate/do`` normally samples the chain (with up to ``DEFAULT_TRIES``
+rejections) on the request thread. For hot ``(acct, min_words)`` pairs a
+background thread keeps a ring buffer of sentences that already passed the
+same checks, so a request only pops one. A pair becomes hot after
+``SENTENCE_POOL_HOT_HITS`` requests within ``SENTENCE_POOL_HOT_WINDOW``
+seconds (accounts in ``SENTENCE_POOL_ACCOUNTS`` are hot from the first
+request); everything else, including ``startswith`` requests, is generated
+live as before.
+
+Each sentence is served once, together with the seed it was generated
+with, so its share link reproduces it. Pools are tagged with the model
+version, so a retrained model never serves sentences of the previous one.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from app.services.generator import generate_sentence, load_text_model, new_seed
+from app.utils.helpers import get_setting
+
+__all__ = [
+    'SentencePool',
+    'sentence_pool',
+]
+
+_Key = Tuple[str, int]
+
+# 人気の判定のために覚えておく (acct, min_words) の数
+_MAX_TRACKED = 4096
+
+
+@dataclass
+class _Pool:
+    meta: Dict[str, Any]
+    # (文, シード)
+    sentences: Deque[Tuple[str, Optional[int]]]
+    last_access: float
+    refilling: bool = False
+    # 生成に失敗し続けた回数 (min_words が大きすぎるモデルなどで空回りしないように)
+    failures: int = 0
+
+
+@dataclass
+class _Recent:
+    window_start: float
+    count: int = 0
+
+
+class SentencePool:
+    """Ring buffers of pre-generated sentences per hot ``(acct, min_words)``.
+
+    Buffers below ``low_watermark`` are refilled by one background thread
+    per process. At most ``max_keys`` buffers are kept (least recently used
+    first out) and buffers not used for ``idle_expiry`` seconds are dropped.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        low_watermark: int,
+        max_keys: int,
+        hot_hits: int,
+        hot_window: float,
+        idle_expiry: float,
+        accounts: Iterable[str] = (),
+    ):
+        self.size = size
+        self.low_watermark = min(low_watermark, size)
+        self.max_keys = max_keys
+        self.hot_hits = hot_hits
+        self.hot_window = hot_window
+        self.idle_expiry = idle_expiry
+        self.accounts = {acct.lstrip('@') for acct in accounts}
+        self._pools: 'OrderedDict[_Key, _Pool]' = OrderedDict()
+        self._recent: 'OrderedDict[_Key, _Recent]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue: 'queue.Queue[Tuple[_Key, _Pool]]' = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.empty = 0
+        self.generated = 0
+
+    # -------------------- internal helpers (lock held) --------------------
+    def _is_hot(self, key: _Key, now: float) -> bool:
+        if key[0] in self.accounts:
+            return True
+        recent = self._recent.get(key)
+        if recent is None or now - recent.window_start > self.hot_window:
+            recent = self._recent[key] = _Recent(window_start=now)
+        recent.count += 1
+        self._recent.move_to_end(key)
+        while len(self._recent) > _MAX_TRACKED:
+            self._recent.popitem(last=False)
+        return recent.count >= self.hot_hits
+
+    def _expire(self, now: float) -> None:
+        while self._pools:
+            key, pool = next(iter(self._pools.items()))
+            if now - pool.last_access <= self.idle_expiry:
+                break
+            del self._pools[key]
+
+    def _schedule(self, key: _Key, pool: _Pool) -> None:
+        if pool.refilling or len(pool.sentences) >= self.low_watermark:
+            return
+        pool.refilling = True
+        self._queue.put((key, pool))
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._refill_loop, name='sentence-pool', daemon=True)
+            self._worker.start()
+
+    # -------------------- background refill --------------------
+    def _refill_loop(self) -> None:
+        while True:
+            key, pool = self._queue.get()
+            try:
+                self._refill(key, pool)
+            except Exception as e:
+                print(f"[WARNING] Failed to refill sentence pool for {key[0]} (min_words={key[1]}): {e!r}")
+            finally:
+                pool.refilling = False
+
+    def _refill(self, key: _Key, pool: _Pool) -> None:
+        acct, min_words = key
+        text_model = load_text_model(acct, pool.meta)
+        while len(pool.sentences) < self.size and pool.failures < self.size:
+            with self._lock:
+                if self._pools.get(key) is not pool:
+                    # 期限切れ・再学習で差し替えられた
+                    return
+            result = generate_sentence(text_model, min_words, seed=new_seed())
+            if result.text is None:
+                pool.failures += 1
+                continue
+            pool.failures = 0
+            pool.sentences.append((result.text, result.seed))
+            self.generated += 1
+            # リクエストを処理するスレッドに GIL を譲る
+            time.sleep(0)
+
+    # -------------------- public API --------------------
+    def take(self, acct: str, meta: Dict[str, Any], min_words: int) -> Optional[Tuple[str, Optional[int]]]:
+        """Pop a pre-generated ``(sentence, seed)``, or return ``None`` to generate live.
+
+        *meta* is the current ``model_meta`` row of *acct*; the caller has
+        already checked that the model may be used.
+        """
+        if self.size <= 0:
+            return None
+        key = (acct, min_words)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            pool = self._pools.get(key)
+            if pool is not None and pool.meta['version'] != meta['version']:
+                del self._pools[key]
+                pool = None
+            if pool is None:
+                if not self._is_hot(key, now):
+                    self.misses += 1
+                    return None
+                pool = self._pools[key] = _Pool(meta=meta, sentences=deque(maxlen=self.size), last_access=now)
+                while len(self._pools) > self.max_keys:
+                    self._pools.popitem(last=False)
+            pool.last_access = now
+            self._pools.move_to_end(key)
+
+            item = pool.sentences.popleft() if pool.sentences else None
+            if item is None:
+                self.empty += 1
+            else:
+                self.hits += 1
+            self._schedule(key, pool)
+            return item
+
+    def invalidate(self, acct: str) -> None:
+        """Drop every pool of *acct* (e.g. after deletion)."""
+        with self._lock:
+            for key in [key for key in self._pools if key[0] == acct]:
+                del self._pools[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters and current usage."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.empty
+            return {
+                'pools': len(self._pools),
+                'sentences': sum(len(pool.sentences) for pool in self._pools.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'empty': self.empty,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'generated': self.generated,
+            }
+
+    def __repr__(self) -> str:
+        st = self.stats()
+        return (
+            f"SentencePool(pools={st['pools']}, sentences={st['sentences']}, "
+            f"hits={st['hits']}, misses={st['misses']}, empty={st['empty']})"
+        )
+
+
+def _accounts(value: Any) -> List[str]:
+    # 環境変数ではカンマ区切り、config.py ではリストでも書ける
+    if isinstance(value, str):
+        return [acct.strip() for acct in value.split(',') if acct.strip()]
+    return list(value or ())
+
+
+# Shared process-wide pool
+sentence_pool = SentencePool(
+    size=get_setting('SENTENCE_POOL_SIZE', 32, int),
+    low_watermark=get_setting('SENTENCE_POOL_LOW_WATERMARK', 8, int),
+    max_keys=get_setting('SENTENCE_POOL_MAX_KEYS', 64, int),
+    hot_hits=get_setting('SENTENCE_POOL_HOT_HITS', 3, int),
+    hot_window=get_setting('SENTENCE_POOL_HOT_WINDOW', 60, float),
+    idle_expiry=get_setting('SENTENCE_POOL_IDLE_EXPIRY', 600, float),
+    accounts=get_setting('SENTENCE_POOL_ACCOUNTS', (), _accounts),
+)
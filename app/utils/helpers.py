@@ -3,12 +3,14 @@ import math
 import html
 import psutil
 import os
+from typing import Any, Callable
 
 __all__ = [
     'format_bytes',
     'dict_factory',
     'format_text',
     'get_memory_usage',
+    'get_setting',
 ]
 
 
@@ -24,6 +26,32 @@ def format_bytes(bytes_value: int) -> str:
     return f"{bytes_value:.1f} {size_names[i]}"
 
 
+def get_setting(name: str, default: Any = None, cast: Callable[[Any], Any] = str) -> Any:
+    """Resolve a setting with env vars > config.py > *default* precedence.
+
+    ``cast`` is applied to values coming from the environment or config.py;
+    ``bool`` understands the usual ``true`` / ``1`` / ``yes`` strings.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        try:
+            import config  # noqa: WPS433
+
+            value = getattr(config, name, None)
+        except ModuleNotFoundError:
+            value = None
+    if value is None:
+        return default
+
+    if cast is bool and isinstance(value, str):
+        return value.lower() in ('true', '1', 'yes')
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        print(f"[WARNING] Invalid value for {name}: {value!r}, using default {default!r}")
+        return default
+
+
 def dict_factory(cursor, row):
     """Convert SQLite rows to dicts keyed by column name."""
     d = {}
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Docker用のエントリーポイントスクリプト
-1. DBファイルが存在しない場合は自動作成
+1. DBファイルが存在しない場合は自動作成 (存在する場合は migrate-db.py でスキーマを更新)
 2. web.pyを読み込んで127.0.0.1を0.0.0.0に変更してから実行
 """
 
@@ -25,7 +25,10 @@ if not os.path.exists(db_path):
     subprocess.run(['python3', 'init-db.py'], env=env, check=True)
     print('Database initialized successfully!')
 else:
-    print('Database found.')
+    print('Database found. Applying migrations...')
+    env = os.environ.copy()
+    env['DB_PATH'] = db_path
+    subprocess.run(['python3', 'migrate-db.py'], env=env, check=True)
 
 # DB_PATH環境変数を設定
 os.environ['DB_PATH'] = db_path
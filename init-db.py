@@ -15,10 +15,28 @@ db = sqlite3.connect(db_path)
 print('Initalizing database...', end='')
 
 cur = db.cursor()
-cur.execute('CREATE TABLE IF NOT EXISTS model_data (acct TEXT NOT NULL PRIMARY KEY UNIQUE, data TEXT NOT NULL, allow_generate_by_other INTEGER NOT NULL)')
+# Small metadata rows (permission / size / version) are kept apart from the model blob
+cur.execute('CREATE TABLE IF NOT EXISTS model_meta (acct TEXT NOT NULL PRIMARY KEY UNIQUE, allow_generate_by_other INTEGER NOT NULL, byte_size INTEGER NOT NULL, version TEXT NOT NULL, created_at REAL NOT NULL, vocab_count INTEGER NOT NULL DEFAULT 0, state_count INTEGER NOT NULL DEFAULT 0)')
+# One row per model version; model_meta.version selects the current one (a retrained model is written before it is switched to)
+# codec: how data is compressed (app.models.blob_codec; NULL = saved before compression existed)
+cur.execute('CREATE TABLE IF NOT EXISTS model_data (version TEXT NOT NULL PRIMARY KEY, acct TEXT NOT NULL, created_at REAL NOT NULL, codec TEXT, data BLOB NOT NULL)')
+cur.execute('CREATE INDEX IF NOT EXISTS model_data_acct ON model_data(acct)')
+cur.execute('CREATE TABLE IF NOT EXISTS model_start_index (acct TEXT NOT NULL PRIMARY KEY UNIQUE, data BLOB NOT NULL)')
+# Newest imported post per model, used for incremental training
+cur.execute('CREATE TABLE IF NOT EXISTS model_import_state (acct TEXT NOT NULL PRIMARY KEY UNIQUE, newest_id TEXT NOT NULL, import_visibility TEXT NOT NULL, post_count INTEGER NOT NULL, updated_at REAL NOT NULL)')
+# Training jobs waiting for / running on the worker pool (FIFO by id)
+cur.execute('CREATE TABLE IF NOT EXISTS job_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, acct TEXT NOT NULL, payload TEXT, state TEXT NOT NULL, enqueued_at REAL NOT NULL, started_at REAL, heartbeat_at REAL, finished_at REAL, dedup_key TEXT)')
+cur.execute('CREATE INDEX IF NOT EXISTS job_queue_state ON job_queue(state, id)')
+# At most one unfinished job per account + import settings (duplicate submissions attach to it)
+cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS job_queue_dedup ON job_queue(dedup_key) WHERE state IN ('queued', 'running')")
+# Progress / result of jobs, shared by all server processes (JOB_STATUS_BACKEND=sqlite)
+cur.execute('CREATE TABLE IF NOT EXISTS job_status (job_id TEXT NOT NULL PRIMARY KEY, status TEXT NOT NULL, updated_at REAL NOT NULL, expires_at REAL NOT NULL)')
+cur.execute('CREATE INDEX IF NOT EXISTS job_status_expires ON job_status(expires_at)')
 cur.close()
 
 db.commit()
+# WAL mode is stored in the database file, so connections need not set it again
+db.execute('PRAGMA journal_mode=WAL')
 db.close()
 
 print('OK')
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""Bring an existing database up to date with the current schema / model format.
+
+Usage: python migrate-db.py
+
+Steps are idempotent, so running the script again is harmless.
+"""
+
+import os
+import sqlite3
+import time
+import uuid
+
+from app.models.blob_codec import compress_blob, decompress_blob
+from app.models.compact_model import begin_words, dump_model, header_counts, is_compact, is_current, load_model, model_counts
+from app.models.start_index import StartWordIndex
+
+db_path = os.environ.get('DB_PATH', 'markov.db')
+
+
+def _columns(db, table):
+    return [row[1] for row in db.execute(f'PRAGMA table_info({table})')]
+
+
+def migrate_schema(db):
+    """Add columns introduced after the initial schema (legacy single-table layout)."""
+    print('Updating schema...', end='')
+    columns = _columns(db, 'model_data')
+    if 'allow_generate_by_other' in columns:
+        if 'version' not in columns:
+            db.execute("ALTER TABLE model_data ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+        db.execute("UPDATE model_data SET version = lower(hex(randomblob(16))) WHERE version = ''")
+        db.commit()
+    print('OK')
+
+
+def split_model_meta(db):
+    """Move per-model metadata out of model_data into model_meta. Return whether tables were rebuilt."""
+    print('Splitting model metadata...', end='')
+    if 'allow_generate_by_other' not in _columns(db, 'model_data'):
+        print('already done')
+        return False
+
+    db.execute('CREATE TABLE IF NOT EXISTS model_meta (acct TEXT NOT NULL PRIMARY KEY UNIQUE, allow_generate_by_other INTEGER NOT NULL, byte_size INTEGER NOT NULL, version TEXT NOT NULL, created_at REAL NOT NULL, vocab_count INTEGER NOT NULL DEFAULT 0, state_count INTEGER NOT NULL DEFAULT 0)')
+
+    cur = db.cursor()
+    cur.execute('SELECT acct, allow_generate_by_other, version, data FROM model_data')
+    now = time.time()
+    for acct, allow, version, data in cur:
+        vocab_count, state_count = header_counts(data) if is_compact(data) else (0, 0)
+        size = len(data.encode()) if isinstance(data, str) else len(data)
+        db.execute(
+            'INSERT OR REPLACE INTO model_meta(acct, allow_generate_by_other, byte_size, version, created_at, vocab_count, state_count) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (acct, allow, size, version, now, vocab_count, state_count),
+        )
+    cur.close()
+
+    db.execute('CREATE TABLE model_data_new (acct TEXT NOT NULL PRIMARY KEY UNIQUE, data BLOB NOT NULL)')
+    db.execute('INSERT INTO model_data_new(acct, data) SELECT acct, data FROM model_data')
+    db.execute('DROP TABLE model_data')
+    db.execute('ALTER TABLE model_data_new RENAME TO model_data')
+    db.commit()
+    print('OK')
+    return True
+
+
+def add_model_codec(db):
+    """Record how each model blob is compressed (NULL: existing, uncompressed rows)."""
+    print('Adding model codec column...', end='')
+    if 'codec' in _columns(db, 'model_data'):
+        print('already done')
+        return
+    db.execute('ALTER TABLE model_data ADD COLUMN codec TEXT')
+    db.commit()
+    print('OK (rows are compressed in the background by the web server)')
+
+
+def key_model_data_by_version(db):
+    """Key model blobs by model version, so a retrained model gets a row of its own.
+
+    Return whether the table was rebuilt.
+    """
+    print('Keying model data by version...', end='')
+    if 'version' in _columns(db, 'model_data'):
+        print('already done')
+        return False
+    db.execute('CREATE TABLE model_data_new (version TEXT NOT NULL PRIMARY KEY, acct TEXT NOT NULL, created_at REAL NOT NULL, codec TEXT, data BLOB NOT NULL)')
+    db.execute(
+        'INSERT INTO model_data_new(version, acct, created_at, codec, data) '
+        'SELECT m.version, d.acct, m.created_at, d.codec, d.data FROM model_data d JOIN model_meta m ON m.acct = d.acct'
+    )
+    db.execute('DROP TABLE model_data')
+    db.execute('ALTER TABLE model_data_new RENAME TO model_data')
+    db.execute('CREATE INDEX model_data_acct ON model_data(acct)')
+    db.commit()
+    print('OK')
+    return True
+
+
+def convert_models(db):
+    """Convert markovify JSON / older compact rows to the current compact format.
+
+    Return whether any row was rewritten.
+    """
+    print('Converting models to the current compact format...')
+
+    cur = db.cursor()
+    cur.execute('SELECT acct, version FROM model_meta')
+    accts = cur.fetchall()
+    cur.close()
+
+    converted = 0
+    before_total = 0
+    after_total = 0
+    for acct, version in accts:
+        cur = db.cursor()
+        cur.execute('SELECT data, codec FROM model_data WHERE version = ?', (version,))
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            continue
+        old_data = decompress_blob(row[1], row[0])
+        if is_current(old_data):
+            continue
+
+        try:
+            text_model = load_model(old_data)
+            vocab_count, state_count = model_counts(text_model)
+            data = dump_model(text_model)
+        except Exception as e:
+            print(f'  {acct}: failed ({e!r})')
+            continue
+
+        before = len(old_data.encode()) if isinstance(old_data, str) else len(old_data)
+        before_total += before
+        after_total += len(data)
+
+        codec, stored = compress_blob(data)
+        new_version = uuid.uuid4().hex
+        db.execute('UPDATE model_data SET data = ?, codec = ?, version = ? WHERE version = ?', (stored, codec, new_version, version))
+        db.execute(
+            'UPDATE model_meta SET byte_size = ?, version = ?, vocab_count = ?, state_count = ? WHERE acct = ?',
+            (len(data), new_version, vocab_count, state_count, acct),
+        )
+        db.commit()
+        converted += 1
+        print(f'  {acct}: {before} -> {len(data)} bytes')
+
+    print(f'OK ({converted}/{len(accts)} converted, {before_total} -> {after_total} bytes)')
+    return converted > 0
+
+
+def build_start_indexes(db):
+    """Build the sentence-start word index for models saved without one."""
+    print('Building start word indexes...', end='')
+    db.execute('CREATE TABLE IF NOT EXISTS model_start_index (acct TEXT NOT NULL PRIMARY KEY UNIQUE, data BLOB NOT NULL)')
+
+    cur = db.cursor()
+    cur.execute('SELECT acct FROM model_meta WHERE acct NOT IN (SELECT acct FROM model_start_index)')
+    accts = [row[0] for row in cur.fetchall()]
+    cur.close()
+
+    for acct in accts:
+        cur = db.cursor()
+        cur.execute(
+            'SELECT d.data, d.codec FROM model_meta m JOIN model_data d ON d.version = m.version WHERE m.acct = ?',
+            (acct,),
+        )
+        data, codec = cur.fetchone()
+        cur.close()
+        data = decompress_blob(codec, data)
+        try:
+            index = StartWordIndex.build(begin_words(load_model(data)))
+        except Exception as e:
+            print(f'\n  {acct}: failed ({e!r})', end='')
+            continue
+        db.execute('INSERT INTO model_start_index(acct, data) VALUES (?, ?)', (acct, index.to_bytes()))
+        db.commit()
+    print(f'OK ({len(accts)} built)')
+
+
+def create_import_state(db):
+    """Create the table used for incremental training."""
+    print('Creating import state table...', end='')
+    db.execute('CREATE TABLE IF NOT EXISTS model_import_state (acct TEXT NOT NULL PRIMARY KEY UNIQUE, newest_id TEXT NOT NULL, import_visibility TEXT NOT NULL, post_count INTEGER NOT NULL, updated_at REAL NOT NULL)')
+    db.commit()
+    print('OK')
+
+
+def create_job_queue(db):
+    """Create the persistent training job queue."""
+    print('Creating job queue table...', end='')
+    db.execute('CREATE TABLE IF NOT EXISTS job_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, acct TEXT NOT NULL, payload TEXT, state TEXT NOT NULL, enqueued_at REAL NOT NULL, started_at REAL, heartbeat_at REAL, finished_at REAL, dedup_key TEXT)')
+    db.execute('CREATE INDEX IF NOT EXISTS job_queue_state ON job_queue(state, id)')
+    if 'dedup_key' not in _columns(db, 'job_queue'):
+        db.execute('ALTER TABLE job_queue ADD COLUMN dedup_key TEXT')
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS job_queue_dedup ON job_queue(dedup_key) WHERE state IN ('queued', 'running')")
+    db.commit()
+    print('OK')
+
+
+def create_job_status(db):
+    """Create the job status table shared by all server processes."""
+    print('Creating job status table...', end='')
+    db.execute('CREATE TABLE IF NOT EXISTS job_status (job_id TEXT NOT NULL PRIMARY KEY, status TEXT NOT NULL, updated_at REAL NOT NULL, expires_at REAL NOT NULL)')
+    db.execute('CREATE INDEX IF NOT EXISTS job_status_expires ON job_status(expires_at)')
+    db.commit()
+    print('OK')
+
+
+def enable_wal(db):
+    """Switch the database to WAL mode (stored in the file, so the server does not set it)."""
+    print('Enabling WAL mode...', end='')
+    mode = db.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    print('OK' if mode == 'wal' else f'failed ({mode})')
+
+
+if __name__ == '__main__':
+    db = sqlite3.connect(db_path)
+    migrate_schema(db)
+    # 起動のたびに実行されるので、大きく書き換えたときだけ VACUUM する
+    rewritten = split_model_meta(db)
+    add_model_codec(db)
+    rewritten = key_model_data_by_version(db) or rewritten
+    rewritten = convert_models(db) or rewritten
+    build_start_indexes(db)
+    create_import_state(db)
+    create_job_queue(db)
+    create_job_status(db)
+    if rewritten:
+        print('Vacuuming...', end='')
+        db.execute('VACUUM')
+        print('OK')
+    enable_wal(db)
+    db.close()
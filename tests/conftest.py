@@ -1 +1,50 @@
- 
\ No newline at end of file
+"""Shared fixtures: a throwaway database, the app factory and its test client."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.models.database はインポート時に DB_PATH を読むので、アプリより先に設定する
+_tmp_dir = tempfile.mkdtemp(prefix='markov-test-')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'markov.db')
+# 手元の config.py の内容に左右されないよう空の config を使う (設定は環境変数で与える)
+sys.modules['config'] = types.ModuleType('config')
+# 保存済みモデルを裏で圧縮し直すスレッドを動かさない
+os.environ['MODEL_COMPRESS_EXISTING'] = 'false'
+
+
+@pytest.fixture(scope='session')
+def db():
+    """Path of a freshly initialised database, shared by the whole session."""
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'init-db.py')],
+        cwd=ROOT, env=os.environ, check=True, capture_output=True,
+    )
+    yield os.environ['DB_PATH']
+    from app.models.database import close_db
+    close_db()
+    shutil.rmtree(_tmp_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def app(db, monkeypatch):
+    """Flask app whose job queue workers are not started (tests drive the queue themselves)."""
+    from app.services.job_queue import job_queue
+    monkeypatch.setattr(job_queue, 'start', lambda: None)
+
+    from app import create_app
+    flask_app = create_app()
+    flask_app.config.update(TESTING=True)
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
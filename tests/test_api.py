@@ -0,0 +1,55 @@
+import uuid
+
+import pytest
+
+from app.models.compact_model import CompactTextBuilder
+from app.models.model_store import save_model
+from app.routes import api
+from app.services.generator import REJECT_DEAD_END, REJECT_TOO_SHORT, GenerationResult
+
+
+@pytest.fixture
+def acct(db):
+    acct = f'{uuid.uuid4().hex}@example.com'
+    save_model(acct, CompactTextBuilder().add_runs([['w0', 'w1', 'w2', 'w3']] * 5).build(), True)
+    return acct
+
+
+def _scripted(monkeypatch, outcomes):
+    calls = []
+
+    def generate_sentence(*args):
+        calls.append(args)
+        return outcomes[len(calls) - 1]
+
+    monkeypatch.setattr(api, 'generate_sentence', generate_sentence)
+    return calls
+
+
+def test_startswith_retries_after_recoverable_failure(client, acct, monkeypatch):
+    short = GenerationResult(tries=100, rejections={REJECT_TOO_SHORT: 100})
+    calls = _scripted(monkeypatch, [short, GenerationResult(text='w0 w1 w2'), GenerationResult(text='w0 w1')])
+
+    body = client.get(f'/api/generate?acct={acct}&count=3&startswith=w0').get_json()
+    assert len(calls) == 3
+    assert [s['text'] for s in body['sentences']] == ['w0w1w2', 'w0w1']
+    assert body['failed'] == 1
+
+
+def test_startswith_stops_at_dead_end(client, acct, monkeypatch):
+    dead_end = GenerationResult(tries=1, rejections={REJECT_DEAD_END: 1})
+    calls = _scripted(monkeypatch, [dead_end] * 3)
+
+    body = client.get(f'/api/generate?acct={acct}&count=3&startswith=w0').get_json()
+    assert len(calls) == 1
+    assert body['sentences'] == []
+    assert body['failed'] == 3
+
+
+def test_unknown_start_word_returns_suggestions(client, acct, monkeypatch):
+    calls = _scripted(monkeypatch, [])
+
+    body = client.get(f'/api/generate?acct={acct}&count=3&startswith=zz').get_json()
+    assert calls == []
+    assert body['failed'] == 3
+    assert 'suggestions' in body
@@ -0,0 +1,76 @@
+import io
+import os
+import zlib
+
+import pytest
+
+from app.models.blob_codec import (
+    RAW,
+    compress_blob,
+    compress_to_file,
+    decompress_blob,
+    decompress_chunks,
+    register_codec,
+)
+
+DATA = b''.join(f'state {i} -> token {i % 97}\n'.encode() for i in range(20000))
+NOISE = os.urandom(64 * 1024)
+
+
+def _pieces(data, size=4096):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_compress_blob_round_trip():
+    codec, payload = compress_blob(DATA, 'zlib')
+
+    assert codec == 'zlib'
+    assert len(payload) < len(DATA) / 5
+    assert decompress_blob(codec, payload) == DATA
+    assert decompress_chunks(codec, _pieces(payload, 1000)) == DATA
+
+
+def test_incompressible_data_is_stored_raw():
+    assert compress_blob(NOISE, 'zlib') == (RAW, NOISE)
+    assert decompress_blob(RAW, NOISE) == NOISE
+    # 圧縮が導入される前の行 (codec が NULL)
+    assert decompress_blob(None, NOISE) == NOISE
+    assert decompress_chunks(None, _pieces(NOISE)) == NOISE
+
+
+@pytest.mark.parametrize('data, expected_codec', [(DATA, 'zlib'), (NOISE, RAW)])
+def test_compress_to_file_round_trip(data, expected_codec):
+    out = io.BytesIO()
+    out.write(b'header')
+
+    codec, raw_size = compress_to_file(lambda: _pieces(data), out, 'zlib')
+    assert (codec, raw_size) == (expected_codec, len(data))
+    # 書き始めた位置より前は触らない
+    assert out.getvalue()[:6] == b'header'
+    payload = out.getvalue()[6:]
+    assert decompress_blob(codec, payload) == data
+    assert compress_blob(data, 'zlib') == (codec, payload)
+
+
+def test_registered_codec():
+    register_codec('gzip', lambda: zlib.compressobj(9, zlib.DEFLATED, 31), lambda: zlib.decompressobj(31))
+
+    codec, payload = compress_blob(DATA, 'gzip')
+    assert codec == 'gzip'
+    assert payload[:2] == b'\x1f\x8b'
+    assert decompress_chunks('gzip', _pieces(payload, 1000)) == DATA
+
+
+def test_default_codec_from_setting(monkeypatch):
+    monkeypatch.setenv('MODEL_CODEC', 'raw')
+    assert compress_blob(DATA) == (RAW, DATA)
+
+    monkeypatch.setenv('MODEL_CODEC', 'zlib')
+    assert compress_blob(DATA)[0] == 'zlib'
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compress_blob(DATA, 'lz77')
+    with pytest.raises(ValueError):
+        decompress_blob('lz77', b'')
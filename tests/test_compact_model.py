@@ -0,0 +1,74 @@
+import markovify
+import pytest
+
+from app.models.compact_model import (
+    CompactText,
+    dump_model,
+    header_counts,
+    is_compact,
+    is_current,
+    load_model,
+    model_counts,
+)
+
+CORPUS = '\n'.join([
+    'きょう は 晴れ です',
+    'きょう は 雨 です',
+    'あした は 晴れ でしょう',
+    'あした も 雨 でしょう ね',
+    'きのう は 雪 でした',
+    '晴れ の 日 は 散歩 です',
+])
+
+
+def _counts(chain: markovify.Chain) -> dict:
+    # compile() 済みなら累積和から出現回数に戻す
+    if not chain.compiled:
+        return {state: dict(follow) for state, follow in chain.model.items()}
+    model = {}
+    for state, (choices, cumdist) in chain.model.items():
+        prev = 0
+        model[state] = {}
+        for token, total in zip(choices, cumdist):
+            model[state][token] = total - prev
+            prev = total
+    return model
+
+
+@pytest.fixture
+def text_model():
+    return markovify.NewlineText(CORPUS, state_size=2)
+
+
+@pytest.mark.parametrize('compile_chain', [False, True])
+def test_round_trip_keeps_counts(text_model, compile_chain):
+    if compile_chain:
+        text_model = text_model.compile()
+    data = dump_model(text_model)
+
+    assert is_compact(data)
+    assert is_current(data)
+    loaded = load_model(data)
+    assert isinstance(loaded, CompactText)
+    assert loaded.chain.counts() == _counts(text_model.chain)
+    assert header_counts(data) == model_counts(text_model) == model_counts(loaded)
+
+
+def test_dump_is_stable(text_model):
+    data = dump_model(text_model)
+
+    assert dump_model(load_model(data)) == data
+
+
+def test_loads_markovify_json(text_model):
+    loaded = load_model(text_model.to_json())
+
+    assert not is_compact(text_model.to_json())
+    assert _counts(loaded.chain) == _counts(text_model.chain)
+    assert load_model(dump_model(loaded)).chain.counts() == _counts(text_model.chain)
+
+
+def test_begin_words(text_model):
+    loaded = load_model(dump_model(text_model))
+
+    assert sorted(loaded.chain.begin_words()) == ['あした', 'きのう', 'きょう', '晴れ']
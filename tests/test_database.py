@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from app.models import database
+from app.models.database import close_db, read_connection
+
+
+def _checkout_in_thread():
+    result = []
+
+    def run():
+        with read_connection() as db:
+            db.execute('SELECT 1').fetchone()
+            result.append(db)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_read_connections_outlive_threads(db):
+    # リクエストごとに新しいスレッドでも、接続は開き直さずに使い回す
+    assert _checkout_in_thread() is _checkout_in_thread()
+
+
+@pytest.fixture
+def pool_size(db, monkeypatch):
+    """Rebuild the pool with ``DB_READ_POOL_SIZE`` = the requested size (and back afterwards)."""
+    def resize(size):
+        monkeypatch.setenv('DB_READ_POOL_SIZE', str(size))
+        database._pool_pid = 0
+
+    yield resize
+    monkeypatch.delenv('DB_READ_POOL_SIZE')
+    database._pool_pid = 0
+
+
+def test_pool_is_bounded(pool_size):
+    pool_size(1)
+    waiting = threading.Event()
+    done = threading.Event()
+
+    def other():
+        waiting.set()
+        with read_connection():
+            done.set()
+
+    thread = threading.Thread(target=other)
+    with read_connection():
+        thread.start()
+        waiting.wait()
+        # 1 本しかないので返すまで待たされる
+        assert not done.wait(0.2)
+    assert done.wait(5)
+    thread.join()
+
+
+def test_close_db_drops_idle_connections(db):
+    with read_connection() as before:
+        pass
+    close_db()
+
+    with read_connection() as after:
+        assert after is not before
+        assert after.execute('SELECT 1 AS one').fetchone() == dict(one=1)
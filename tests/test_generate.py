@@ -0,0 +1,126 @@
+import re
+import uuid
+
+import pytest
+
+from app.models.compact_model import CompactTextBuilder
+from app.models.model_store import get_model_meta, save_model, set_allow_generate_by_other
+from app.services.generator import generate_sentence, load_text_model
+from app.services.model_cache import response_cache
+
+WORDS = [f'w{i}' for i in range(30)]
+
+
+def _text_model(seed_offset=0):
+    builder = CompactTextBuilder()
+    # 分岐の多い連鎖 (シードが違えば違う文になる)
+    for i in range(300):
+        builder.add_run([WORDS[(i * k + seed_offset) % len(WORDS)] for k in range(1, 9)])
+    return builder.build()
+
+
+@pytest.fixture
+def acct(db):
+    acct = f'{uuid.uuid4().hex}@example.com'
+    save_model(acct, _text_model(), True)
+    return acct
+
+
+def _text(response):
+    match = re.search(r'<div class="generated-text">\s*(.*?)\s*</div>', response.get_data(as_text=True), re.S)
+    return match and match.group(1)
+
+
+def test_seeded_generation_is_deterministic(acct):
+    text_model = load_text_model(acct, get_model_meta(acct))
+
+    results = [generate_sentence(text_model, 3, seed=seed) for seed in (1, 2, 1)]
+    assert results[0].text and results[0].seed == 1
+    assert results[0].text == results[2].text
+    assert len({generate_sentence(text_model, 3, seed=seed).text for seed in range(10)}) > 1
+
+
+def test_seeded_page_is_reproducible(client, acct):
+    url = f'/generate/do?acct={acct}&min_words=3&seed=42'
+
+    first = client.get(url)
+    assert first.status_code == 200
+    assert _text(first)
+    assert _text(client.get(url)) == _text(first)
+    assert first.headers['Cache-Control'] == 'public, max-age=300'
+    assert first.headers['ETag']
+
+
+def test_cached_page_size_is_counted_in_bytes(client, acct):
+    url = f'/generate/do?acct={acct}&min_words=3&seed=42'
+    first = client.get(url)
+
+    [entry] = [e for key, e in response_cache._entries.items() if key.startswith(acct)]
+    assert entry.model == first.data
+    assert entry.size == len(first.data) > len(first.get_data(as_text=True))
+    assert client.get(url).data == first.data
+
+
+def test_matching_etag_gets_304(client, acct):
+    url = f'/generate/do?acct={acct}&min_words=3&seed=42'
+    etag = client.get(url).headers['ETag']
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert client.get(f'/generate/do?acct={acct}&min_words=3&seed=43', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_etag_changes_after_retraining(client, acct):
+    url = f'/generate/do?acct={acct}&min_words=3&seed=42'
+    etag = client.get(url).headers['ETag']
+
+    save_model(acct, _text_model(seed_offset=7), True)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_cache_control(client, acct, monkeypatch):
+    url = f'/generate/do?acct={acct}&min_words=3&seed=42'
+
+    monkeypatch.setenv('GENERATE_CACHE_MAX_AGE', '60')
+    assert client.get(url).headers['Cache-Control'] == 'public, max-age=60'
+
+    # ログイン中の表示は共有キャッシュに載せない
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['acct'] = acct
+    response = client.get(url)
+    assert response.headers['Cache-Control'] == 'private, max-age=60'
+    assert _text(response) == _text(client.get(url))
+
+
+def test_private_model_is_not_served_from_cache(client, acct):
+    url = f'/generate/do?acct={acct}&min_words=3&seed=42'
+    assert _text(client.get(url))
+
+    set_allow_generate_by_other(acct, False)
+    response = client.get(url)
+    assert _text(response) is None
+    assert 'このユーザーは他のユーザーからの文章生成を許可していません' in response.get_data(as_text=True)
+
+
+def test_unseeded_page_links_its_seed(client, acct):
+    response = client.get(f'/generate/do?acct={acct}&min_words=3')
+    share = re.search(r'seed(?:=|%3D)(\d+)', response.get_data(as_text=True))
+    assert share
+
+    seeded = client.get(f'/generate/do?acct={acct}&min_words=3&seed={share.group(1)}')
+    assert _text(seeded) == _text(response)
+
+
+def test_api_seed(client, acct):
+    url = f'/api/generate?acct={acct}&count=3&min_words=3&seed=42'
+
+    first = client.get(url).get_json()['sentences']
+    again = client.get(url).get_json()['sentences']
+    # 文 i はシード seed + i で生成される
+    assert [s['seed'] for s in first] == [42, 43, 44]
+    assert [s['text'] for s in again] == [s['text'] for s in first]
+    assert client.get(f'/api/generate?acct={acct}&seed=abc').status_code == 400
@@ -0,0 +1,107 @@
+import uuid
+
+import pytest
+
+from app.models.import_checkpoint import delete_checkpoint, load_checkpoint, save_checkpoint
+from app.models.markov_model import create_markov_model_by_multiline
+from app.services.background_processor import _fetch_stage, _resume
+from app.services.data_import.base import DataImporter
+
+PAGES = [
+    ['きょうは晴れです', 'あしたは雨でしょう'],
+    ['猫が鳴いています', 'きょうは散歩に行きたい'],
+    ['あしたも晴れるといいな', '猫と散歩に行きました'],
+    ['雨の日は家で本を読みます', 'きょうも猫はかわいい'],
+]
+PARAMS = dict(platform='misskey', import_visibility='public_only', import_size=100, since_id=None)
+
+
+class PageImporter(DataImporter):
+    """Importer over fixed pages that can fail in the middle of one."""
+
+    def __init__(self, fail_in_page=None):
+        super().__init__({})
+        self.fail_in_page = fail_in_page
+        self.pages_fetched = []
+
+    def iter_lines(self, since_id=None):
+        for page in range(self.cursor.get('page', 0), len(PAGES)):
+            self.pages_fetched.append(page)
+            for i, line in enumerate(PAGES[page]):
+                if page == self.fail_in_page and i == 1:
+                    raise ConnectionError('connection reset')
+                self.imported_count += 1
+                self._track_newest(f'{page}{i}')
+                yield line
+            self._page_done(dict(page=page + 1))
+        self.finished = True
+
+
+@pytest.fixture(autouse=True)
+def _checkpoints(monkeypatch, tmp_path, db):
+    monkeypatch.setenv('IMPORT_CHECKPOINT_DIR', str(tmp_path))
+    # ページの区切りごとにチェックポイントを保存する
+    monkeypatch.setenv('IMPORT_CHECKPOINT_INTERVAL', '1e-9')
+
+
+def _train(importer, acct, base=None):
+    return create_markov_model_by_multiline(
+        _fetch_stage(importer, None, uuid.uuid4().hex, (acct, PARAMS)),
+        base=base,
+    )
+
+
+def test_save_and_load():
+    save_checkpoint('a@example.com', dict(params=PARAMS), b'model')
+
+    meta, data = load_checkpoint('a@example.com')
+    assert meta['params'] == PARAMS
+    assert data == b'model'
+    assert load_checkpoint('b@example.com') is None
+
+    delete_checkpoint('a@example.com')
+    assert load_checkpoint('a@example.com') is None
+
+
+def test_stale_and_broken_checkpoints_are_discarded(monkeypatch, tmp_path):
+    save_checkpoint('a@example.com', dict(params=PARAMS), b'model')
+    monkeypatch.setenv('IMPORT_CHECKPOINT_MAX_AGE', '-1')
+    assert load_checkpoint('a@example.com') is None
+    assert list(tmp_path.iterdir()) == []
+
+    monkeypatch.delenv('IMPORT_CHECKPOINT_MAX_AGE')
+    save_checkpoint('a@example.com', dict(params=PARAMS), b'model')
+    [path] = tmp_path.iterdir()
+    path.write_bytes(b'garbage')
+    assert load_checkpoint('a@example.com') is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resume_matches_uninterrupted_import():
+    expected = _train(PageImporter(), 'full@example.com')
+
+    with pytest.raises(ConnectionError):
+        _train(PageImporter(fail_in_page=2), 'resume@example.com')
+
+    importer = PageImporter()
+    partial = _resume(importer, 'resume@example.com', PARAMS)
+    assert partial is not None
+    # 最後に最後まで流したページの直後から再開する
+    assert importer.cursor == dict(page=2)
+    assert importer.imported_count == 4
+    resumed = _train(importer, 'resume@example.com', base=partial)
+
+    assert importer.pages_fetched == [2, 3]
+    assert importer.imported_count == 8
+    assert resumed.chain.counts() == expected.chain.counts()
+    assert resumed.originality.to_bytes() == expected.originality.to_bytes()
+
+
+def test_checkpoint_of_other_settings_is_not_used():
+    with pytest.raises(ConnectionError):
+        _train(PageImporter(fail_in_page=3), 'other@example.com')
+
+    importer = PageImporter()
+    assert _resume(importer, 'other@example.com', dict(PARAMS, import_visibility='followers')) is None
+    assert importer.cursor == {}
+    assert load_checkpoint('other@example.com') is None
@@ -0,0 +1,246 @@
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+from app.models.compact_model import CompactTextBuilder
+from app.models.database import write_transaction
+from app.models.job_store import (
+    claim_next_job,
+    enqueue_job,
+    finish_job,
+    get_job_state,
+    queue_position,
+    requeue_stale_jobs,
+    touch_jobs,
+)
+from app.models.model_store import get_model_meta, save_model
+from app.services.background_processor import _dedup_key, _reuse_recent_model
+from app.services.job_manager import job_status
+from app.services.job_queue import job_queue
+
+
+@pytest.fixture(autouse=True)
+def _empty_queue(db):
+    with write_transaction() as conn:
+        conn.execute('DELETE FROM job_queue')
+
+
+def _enqueue(acct='alice@example.com', **kwargs):
+    job_id = uuid.uuid4().hex
+    assert enqueue_job(job_id, 'test', acct, dict(n=1), **kwargs) == job_id
+    return job_id
+
+
+def _age_heartbeat(job_id, seconds):
+    with write_transaction() as conn:
+        conn.execute('UPDATE job_queue SET heartbeat_at = heartbeat_at - ? WHERE job_id = ?', (seconds, job_id))
+
+
+def test_claims_in_fifo_order():
+    first, second = _enqueue(), _enqueue()
+    assert queue_position(first) == 1
+    assert queue_position(second) == 2
+
+    job = claim_next_job()
+    assert job == dict(job_id=first, kind='test', acct='alice@example.com', payload=dict(n=1))
+    assert get_job_state(first) == 'running'
+    assert queue_position(first) is None
+    assert queue_position(second) == 1
+
+    assert claim_next_job()['job_id'] == second
+    assert claim_next_job() is None
+
+
+def test_stale_running_jobs_are_requeued_at_their_position():
+    first, second = _enqueue(), _enqueue()
+    claim_next_job()
+    claim_next_job()
+    _age_heartbeat(first, 600)
+
+    assert requeue_stale_jobs(120) == [first]
+    assert get_job_state(first) == 'queued'
+    assert get_job_state(second) == 'running'
+
+    third = _enqueue()
+    # 後から積まれたジョブより先に再開される
+    assert claim_next_job()['job_id'] == first
+    assert queue_position(third) == 1
+
+
+def test_heartbeat_keeps_running_jobs():
+    job_id = _enqueue()
+    claim_next_job()
+    _age_heartbeat(job_id, 600)
+    touch_jobs([job_id])
+
+    assert requeue_stale_jobs(120) == []
+    assert get_job_state(job_id) == 'running'
+
+
+def test_finished_jobs_are_not_claimed_again():
+    job_id = _enqueue()
+    claim_next_job()
+    finish_job(job_id, 'done')
+    _age_heartbeat(job_id, 600)
+
+    assert requeue_stale_jobs(120) == []
+    assert claim_next_job() is None
+    assert get_job_state(job_id) == 'done'
+
+
+def test_cancel_queued_job():
+    job_id = _enqueue()
+
+    assert job_queue.cancel(job_id)
+    assert get_job_state(job_id) == 'cancelled'
+    assert job_status[job_id]['cancelled']
+    assert claim_next_job() is None
+    assert not job_queue.cancel(job_id)
+
+
+def _login(client, acct):
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['acct'] = acct
+
+
+def test_cancel_route_requires_the_owner(client):
+    job_id = _enqueue('alice@example.com')
+
+    _login(client, 'mallory@example.com')
+    response = client.post('/job_cancel', data=dict(job_id=job_id))
+    assert response.status_code == 403
+    assert get_job_state(job_id) == 'queued'
+
+    with client.session_transaction() as session:
+        session.clear()
+    assert client.post('/job_cancel', data=dict(job_id=job_id)).status_code == 403
+
+    _login(client, 'alice@example.com')
+    response = client.post('/job_cancel', data=dict(job_id=job_id))
+    assert response.status_code == 302
+    assert get_job_state(job_id) == 'cancelled'
+
+
+def test_cancel_route_unknown_job(client):
+    _login(client, 'alice@example.com')
+
+    assert client.post('/job_cancel', data=dict(job_id='missing')).status_code == 404
+
+
+def test_duplicate_submissions_share_a_job():
+    key = 'alice-settings'
+    job_id = _enqueue(dedup_key=key)
+
+    assert enqueue_job(uuid.uuid4().hex, 'test', 'alice@example.com', {}, key) == job_id
+    claim_next_job()
+    # 実行中のジョブにもまとめる
+    assert enqueue_job(uuid.uuid4().hex, 'test', 'alice@example.com', {}, key) == job_id
+    assert queue_position(job_id) is None
+
+    finish_job(job_id, 'done')
+    assert _enqueue(dedup_key=key) != job_id
+
+
+def test_cancelled_job_frees_its_dedup_key():
+    job_id = _enqueue(dedup_key='alice-settings')
+    job_queue.cancel(job_id)
+
+    assert _enqueue(dedup_key='alice-settings') != job_id
+
+
+def test_unique_index_backs_up_dedup():
+    _enqueue(dedup_key='alice-settings')
+
+    # 別プロセスが同時に積もうとしても未完了のジョブは 1 つに限られる
+    with pytest.raises(sqlite3.IntegrityError):
+        with write_transaction() as conn:
+            conn.execute(
+                'INSERT INTO job_queue(job_id, kind, acct, payload, state, enqueued_at, dedup_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (uuid.uuid4().hex, 'test', 'alice@example.com', '{}', 'queued', time.time(), 'alice-settings'),
+            )
+
+
+def test_submit_returns_the_existing_job(monkeypatch):
+    monkeypatch.setattr(job_queue, 'start', lambda: None)
+    first = job_queue.submit(uuid.uuid4().hex, 'test', 'alice@example.com', {}, dedup_key='alice-settings')
+    duplicate = uuid.uuid4().hex
+
+    assert job_queue.submit(duplicate, 'test', 'alice@example.com', {}, dedup_key='alice-settings') == first
+    assert job_queue.position(first) == 1
+    assert duplicate not in job_status
+
+
+def test_dedup_key_covers_import_settings():
+    session_data = dict(
+        acct='alice@example.com',
+        importVisibility='public_only',
+        import_size='1000',
+        incrementalImport='false',
+        allowGenerateByOther='true',
+    )
+    key = _dedup_key('misskey', session_data)
+
+    assert _dedup_key('misskey', dict(session_data, import_size=1000, hostname='example.com')) == key
+    for changed in [
+        dict(acct='bob@example.com'),
+        dict(importVisibility='followers'),
+        dict(import_size='2000'),
+        dict(incrementalImport='true'),
+        dict(allowGenerateByOther='false'),
+    ]:
+        assert _dedup_key('misskey', dict(session_data, **changed)) != key
+    assert _dedup_key('mastodon', session_data) != key
+
+
+def test_reuse_recent_model(monkeypatch):
+    acct = f'{uuid.uuid4().hex}@example.com'
+    text_model = CompactTextBuilder().add_runs([['きょう', 'は', '晴れ', 'です']] * 3).build()
+    save_model(acct, text_model, False, dict(newest_id='1', import_visibility='public_only', post_count=3))
+    session_data = dict(acct=acct, importVisibility='public_only', allowGenerateByOther='true')
+    job_id = uuid.uuid4().hex
+
+    # 既定では使い回さない
+    assert not _reuse_recent_model(job_id, session_data)
+    monkeypatch.setenv('MODEL_REUSE_MAX_AGE', '600')
+    assert not _reuse_recent_model(job_id, dict(session_data, importVisibility='followers'))
+    assert _reuse_recent_model(job_id, session_data)
+    assert job_status[job_id]['completed']
+    assert get_model_meta(acct)['allow_generate_by_other']
+
+
+def _crash_in_thread(job_id=None, name='job-worker-0'):
+    from app.services.job_manager import _proc_error_hook
+
+    def run():
+        if job_id is not None:
+            job_queue._threads[threading.get_ident()] = job_id
+        try:
+            raise RuntimeError('boom')
+        except RuntimeError:
+            # pytest が差し替える threading.excepthook の代わりに直接呼ぶ
+            _proc_error_hook(threading.ExceptHookArgs(sys.exc_info() + (threading.current_thread(),)))
+
+    thread = threading.Thread(target=run, name=name)
+    thread.start()
+    thread.join()
+
+
+def test_crashed_worker_marks_its_job():
+    job_id = uuid.uuid4().hex
+
+    _crash_in_thread(job_id)
+    assert 'RuntimeError' in job_status[job_id]['error']
+    assert job_id not in job_queue._threads.values()
+
+
+def test_crash_outside_a_job_is_only_logged():
+    job_id = uuid.uuid4().hex
+
+    # スレッド名がジョブ ID と同じでも実行中のジョブでなければ記録しない
+    _crash_in_thread(name=job_id)
+    assert job_id not in job_status
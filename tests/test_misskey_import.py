@@ -0,0 +1,63 @@
+import pytest
+
+from app.services.data_import import misskey
+from app.services.data_import.misskey import MisskeyDataImporter
+
+NOTES = [dict(id=f'n{i:02d}', visibility='public', text=f'投稿その{i}です') for i in range(10)]
+
+
+class FakeMisskey:
+    """Client returning at most ``page_size`` notes per request, in either order."""
+
+    page_size = 3
+    ascending = False
+
+    def __init__(self, address, i=None, session=None):
+        self.calls = []
+
+    def users_show(self, user_id):
+        return dict(notesCount=len(NOTES))
+
+    def users_notes(self, user_id, include_replies, include_my_renotes, with_files, limit, since_id=None, until_id=None):
+        self.calls.append(dict(since_id=since_id, until_id=until_id))
+        notes = [n for n in NOTES if (since_id is None or n['id'] > since_id) and (until_id is None or n['id'] < until_id)]
+        # sinceId の指定にかかわらず範囲内の新しい方から返すサーバーを真似る
+        page = notes[::-1][:self.page_size]
+        return page[::-1] if self.ascending else page
+
+
+@pytest.fixture(params=[False, True], ids=['descending', 'ascending'])
+def importer(request, monkeypatch):
+    monkeypatch.setattr(FakeMisskey, 'ascending', request.param)
+    monkeypatch.setattr(misskey, 'Misskey', FakeMisskey)
+    return MisskeyDataImporter(dict(hostname='example.invalid', user_id='u1', import_size=100), 'token')
+
+
+def _imported(importer, since_id=None):
+    return sorted(line[2:] for line in importer.iter_lines(since_id))
+
+
+def test_full_import(importer):
+    assert _imported(importer) == sorted(f'その{i}です' for i in range(10))
+    assert importer.newest_id == 'n09'
+    assert importer.finished
+
+
+def test_incremental_import_does_not_skip_notes(importer):
+    assert _imported(importer, since_id='n03') == sorted(f'その{i}です' for i in range(4, 10))
+    assert importer.imported_count == 6
+    assert importer.newest_id == 'n09'
+    # 取得済みの ID に達したら遡るのをやめる
+    assert [call['until_id'] for call in importer.mi.calls] == [None, 'n07', 'n04']
+
+
+def test_incremental_import_without_new_notes(importer):
+    assert _imported(importer, since_id='n09') == []
+    assert len(importer.mi.calls) == 1
+
+
+def test_resume_from_cursor(importer):
+    importer.restore(dict(cursor=dict(params=dict(until_id='n07'), fetched=3), newest_id='n09', imported_count=3))
+
+    assert _imported(importer, since_id='n01') == sorted(f'その{i}です' for i in range(2, 7))
+    assert importer.imported_count == 8
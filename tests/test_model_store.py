@@ -0,0 +1,110 @@
+import uuid
+
+import pytest
+
+from app.models import model_store
+from app.models.compact_model import CompactTextBuilder, dump_model
+from app.models.database import read_connection, write_transaction
+from app.models.model_store import get_model_data, get_model_meta, get_model_storage, recompress_model, save_model
+
+
+def _text_model(words):
+    return CompactTextBuilder().add_runs([words] * 5 + [list(reversed(words))] * 3).build()
+
+
+def _rows(acct):
+    with read_connection() as db:
+        return db.execute(
+            'SELECT version, codec FROM model_data WHERE acct = ? ORDER BY version', (acct,)
+        ).fetchall()
+
+
+@pytest.fixture
+def legacy_model(db, monkeypatch):
+    """A model stored before compression existed (``codec`` NULL)."""
+    acct = f'{uuid.uuid4().hex}@example.com'
+    text_model = _text_model([f'w{i}' for i in range(200)])
+    monkeypatch.setenv('MODEL_CODEC', 'raw')
+    version = save_model(acct, text_model, True)
+    monkeypatch.delenv('MODEL_CODEC')
+    with write_transaction() as conn:
+        conn.execute('UPDATE model_data SET codec = NULL WHERE version = ?', (version,))
+    return acct, version, dump_model(text_model)
+
+
+def test_save_and_read(db):
+    acct = f'{uuid.uuid4().hex}@example.com'
+    text_model = _text_model(['きょう', 'は', '晴れ', 'です'])
+    version = save_model(acct, text_model, False)
+
+    assert get_model_meta(acct)['version'] == version
+    assert get_model_data(acct) == dump_model(text_model)
+    assert _rows(acct) == [dict(version=version, codec='zlib')]
+
+    retrained = _text_model(['あした', 'は', '雨', 'です'])
+    new_version = save_model(acct, retrained, False)
+    assert get_model_data(acct) == dump_model(retrained)
+    # 置き換えられた行は消える
+    assert _rows(acct) == [dict(version=new_version, codec='zlib')]
+
+
+def test_recompress(legacy_model):
+    acct, version, data = legacy_model
+    assert any(row['version'] == version for row in get_model_storage('zlib'))
+
+    codec, stored_size = recompress_model(acct, version, 'zlib')
+
+    assert codec == 'zlib'
+    assert stored_size < len(data)
+    meta = get_model_meta(acct)
+    assert meta['version'] != version
+    assert _rows(acct) == [dict(version=meta['version'], codec='zlib')]
+    assert get_model_data(acct) == data
+    assert not any(row['acct'] == acct for row in get_model_storage('zlib'))
+    # 一覧を取った後に変換済みになったモデル
+    assert recompress_model(acct, version, 'zlib') is None
+
+
+def test_recompress_is_claimed_once(legacy_model, monkeypatch):
+    acct, version, data = legacy_model
+    concurrent = []
+    compress_to_file = model_store.compress_to_file
+
+    def other_process_too(*args):
+        # 変換の途中で別のプロセスも同じモデルに取りかかる
+        concurrent.append(recompress_model(acct, version, 'zlib'))
+        return compress_to_file(*args)
+
+    monkeypatch.setattr(model_store, 'compress_to_file', other_process_too)
+    assert recompress_model(acct, version, 'zlib')[0] == 'zlib'
+    assert concurrent == [None]
+    assert get_model_data(acct) == data
+
+
+def test_recompress_yields_to_retraining(legacy_model, monkeypatch):
+    acct, version, _ = legacy_model
+    retrained = _text_model(['あした', 'は', '雨', 'です'])
+    compress_to_file = model_store.compress_to_file
+
+    def retrain_meanwhile(*args):
+        monkeypatch.setattr(model_store, 'compress_to_file', compress_to_file)
+        save_model(acct, retrained, True)
+        return compress_to_file(*args)
+
+    monkeypatch.setattr(model_store, 'compress_to_file', retrain_meanwhile)
+    assert recompress_model(acct, version, 'zlib') is None
+    assert get_model_data(acct) == dump_model(retrained)
+    assert _rows(acct) == [dict(version=get_model_meta(acct)['version'], codec='zlib')]
+
+
+def test_failed_recompress_leaves_no_row(legacy_model, monkeypatch):
+    acct, version, data = legacy_model
+
+    def fail(*args):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(model_store, 'compress_to_file', fail)
+    with pytest.raises(OSError):
+        recompress_model(acct, version, 'zlib')
+    assert _rows(acct) == [dict(version=version, codec=None)]
+    assert get_model_data(acct) == data
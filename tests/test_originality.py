@@ -0,0 +1,71 @@
+import markovify
+import pytest
+
+from app.models.originality import MAX_WINDOW, MIN_WINDOW, OriginalityFilter
+
+RUNS = [
+    [f'a{i}' for i in range(10)],
+    [f'b{i}' for i in range(10)],
+]
+
+
+def _original(filt: OriginalityFilter, words, window: int) -> bool:
+    # max_overlap_total = window - 1 で、window 語の窓だけを調べる
+    return filt.is_original(words, 1.0, window - 1)
+
+
+@pytest.fixture
+def filt():
+    return OriginalityFilter.from_runs(RUNS, fp_rate=1e-6)
+
+
+@pytest.mark.parametrize('window', range(MIN_WINDOW, MAX_WINDOW + 1))
+def test_stored_windows(filt, window):
+    for start in range(len(RUNS[0]) - window + 1):
+        assert not _original(filt, RUNS[0][start:start + window], window)
+    # 文をまたぐ窓・並びの違う窓は学習文に含まれない
+    assert _original(filt, RUNS[0][-2:] + RUNS[1][:window - 2], window)
+    assert _original(filt, list(reversed(RUNS[1][:window])), window)
+
+
+@pytest.mark.parametrize('window', range(1, MIN_WINDOW))
+def test_short_windows_are_always_seen(filt, window):
+    assert not _original(filt, ['x', 'y', 'z'][:window], window)
+
+
+@pytest.mark.parametrize('window', [MAX_WINDOW + 1, MAX_WINDOW + 4])
+def test_long_windows(filt, window):
+    assert not _original(filt, RUNS[1][:window], window)
+    assert _original(filt, RUNS[1][:window - 1] + ['new'], window)
+    assert _original(filt, RUNS[0][:MAX_WINDOW] + RUNS[1][:window - MAX_WINDOW], window)
+
+
+def test_matches_markovify_on_word_boundaries():
+    corpus = RUNS + [['c0', 'c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7']]
+    text_model = markovify.Text(None, parsed_sentences=corpus, retain_original=True)
+    filt = OriginalityFilter.from_runs(corpus, fp_rate=1e-6)
+    candidates = [
+        RUNS[0][:5],
+        RUNS[0][2:9],
+        corpus[2],
+        RUNS[0][:3] + RUNS[1][3:8],
+        ['a0', 'a1', 'b2', 'b3', 'c4', 'c5'],
+        RUNS[1][:4] + ['c4', 'c5', 'c6', 'c7'],
+    ]
+    for words in candidates:
+        expected = text_model.test_sentence_output(words, 0.7, 15)
+        assert filt.is_original(words, 0.7, 15) == expected, words
+
+
+def test_grows_and_round_trips():
+    runs = [[f'r{i}w{j}' for j in range(12)] for i in range(400)]
+    filt = OriginalityFilter(fp_rate=1e-4, capacity=10)
+    for run in runs:
+        filt.add_run(run)
+    assert len(filt.segments) > 1
+
+    loaded = OriginalityFilter.from_bytes(filt.to_bytes())
+    assert loaded.to_bytes() == filt.to_bytes()
+    for run in runs[::37]:
+        assert not _original(loaded, run[3:9], MAX_WINDOW)
+        assert not _original(loaded, run, len(run))
@@ -0,0 +1,204 @@
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from app.services.data_import.rate_limit import FetchController
+
+URL = 'https://example.invalid/api/notes'
+
+
+class FakeClock:
+    """Clock whose sleep only advances the time."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class LowJitter:
+    def uniform(self, a, b):
+        return a
+
+
+class ScriptedAdapter(BaseAdapter):
+    """Transport answering each request with the next scripted ``(status, headers)``."""
+
+    def __init__(self, script):
+        super().__init__()
+        self.script = list(script)
+        self.limits = []
+
+    def send(self, request, **kwargs):
+        self.limits.append(int(request.url.rsplit('limit=', 1)[1]))
+        item = self.script.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        status, headers = item
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.url = request.url
+        response.request = request
+        response._content = b'[]'
+        return response
+
+    def close(self):
+        pass
+
+
+def _rate(remaining: int, reset: int, limit: int = 100) -> dict:
+    return {
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(reset),
+    }
+
+
+@pytest.fixture(autouse=True)
+def _settings(monkeypatch):
+    monkeypatch.setenv('IMPORT_MAX_RETRIES', '3')
+    monkeypatch.setenv('IMPORT_BACKOFF_BASE', '1.0')
+    monkeypatch.setenv('IMPORT_BACKOFF_MAX', '60.0')
+
+
+def _controller(script, clock, reports=None, max_page_size=100):
+    controller = FetchController(
+        max_page_size,
+        report=reports.append if reports is not None else None,
+        clock=clock,
+        wall_clock=clock,
+        sleep=clock.sleep,
+        rng=LowJitter(),
+    )
+    adapter = ScriptedAdapter(script)
+    controller.session.mount('https://', adapter)
+    return controller, adapter
+
+
+def _fetch(controller):
+    def fetch(limit):
+        response = controller.session.get(URL, params={'limit': limit})
+        response.raise_for_status()
+        return limit
+    return controller.request(fetch)
+
+
+def test_no_wait_with_plenty_of_budget():
+    clock = FakeClock()
+    controller, adapter = _controller([(200, _rate(90 - i, 60)) for i in range(5)], clock)
+
+    for _ in range(5):
+        _fetch(controller)
+    assert clock.sleeps == []
+    assert adapter.limits == [100] * 5
+
+
+def test_spreads_remaining_budget_until_reset():
+    clock = FakeClock()
+    reports = []
+    controller, _ = _controller([(200, _rate(30, 60)), (200, _rate(29, 57))], clock, reports)
+
+    _fetch(controller)
+    _fetch(controller)
+    # 残り 30 回から予備の 10 回を除いた 20 回を 60 秒に均等に割り振る
+    assert clock.sleeps == [pytest.approx(3.0)]
+    assert '3.0 秒間隔' in reports[0]
+
+
+def test_waits_for_reset_when_reserve_is_reached():
+    clock = FakeClock()
+    reports = []
+    controller, _ = _controller([(200, _rate(10, 42)), (200, _rate(99, 60))], clock, reports)
+
+    _fetch(controller)
+    _fetch(controller)
+    assert clock.sleeps == [pytest.approx(42.0)]
+    assert '上限に達したため 42 秒待機' in reports[0]
+
+
+def test_reset_as_iso_date_uses_server_date():
+    clock = FakeClock()
+    headers = {
+        'Date': 'Sun, 18 Oct 2026 12:00:00 GMT',
+        'X-RateLimit-Limit': '100',
+        'X-RateLimit-Remaining': '5',
+        'X-RateLimit-Reset': '2026-10-18T12:00:30.000Z',
+    }
+    controller, _ = _controller([(200, headers), (200, _rate(99, 60))], clock)
+
+    _fetch(controller)
+    _fetch(controller)
+    assert clock.sleeps == [pytest.approx(30.0)]
+
+
+def test_retry_after_on_429():
+    clock = FakeClock()
+    reports = []
+    controller, adapter = _controller([(429, {'Retry-After': '7'}), (200, {})], clock, reports)
+
+    assert _fetch(controller) == 100
+    assert clock.sleeps == [pytest.approx(7.0)]
+    assert adapter.limits == [100, 100]
+    assert reports == ['レート制限に達しました: 7 秒後に再試行します (1/3、1 回 100 件)']
+
+
+def test_server_errors_back_off_and_shrink_page_size():
+    clock = FakeClock()
+    controller, adapter = _controller(
+        [(503, {}), (502, {}), (200, {}), (200, {}), (200, {}), (200, {})],
+        clock,
+    )
+
+    assert _fetch(controller) == 25
+    # 上限 1 秒 → 2 秒の equal jitter で、下限 (上限の半分) を引いた場合
+    assert clock.sleeps == [pytest.approx(0.5), pytest.approx(1.0)]
+    for _ in range(3):
+        _fetch(controller)
+    # 3 回続けて成功したら倍に戻す
+    assert adapter.limits == [100, 50, 25, 25, 25, 50]
+
+
+def test_connection_errors_are_retried():
+    clock = FakeClock()
+    controller, adapter = _controller([requests.ConnectionError('reset'), (200, {})], clock)
+
+    assert _fetch(controller) == 50
+    assert len(clock.sleeps) == 1
+
+
+def test_gives_up_after_max_retries():
+    clock = FakeClock()
+    controller, adapter = _controller([(500, {})] * 4, clock, max_page_size=40)
+
+    with pytest.raises(requests.HTTPError):
+        _fetch(controller)
+    assert len(adapter.limits) == 4
+    assert adapter.limits[-1] == 10
+
+
+def test_client_errors_are_not_retried():
+    clock = FakeClock()
+    controller, adapter = _controller([(404, {})], clock)
+
+    with pytest.raises(requests.HTTPError):
+        _fetch(controller)
+    assert clock.sleeps == []
+
+
+def test_cancel_interrupts_wait():
+    clock = FakeClock()
+    controller, _ = _controller([(429, {'Retry-After': '30'})], clock)
+
+    def sleep(seconds):
+        controller.cancel()
+
+    controller._sleep = sleep
+    with pytest.raises(InterruptedError):
+        _fetch(controller)
@@ -0,0 +1,28 @@
+from app.models.start_index import StartWordIndex
+
+WORDS = ['きょう', 'きょうも', 'きょうは', 'きのう', 'あした', '晴れ', '雨']
+
+
+def test_suggest_puts_prefix_matches_first():
+    index = StartWordIndex.build(WORDS)
+
+    assert index.prefix('きょう') == ['きょう', 'きょうは', 'きょうも']
+    assert index.suggest('きょう', limit=2) == ['きょう', 'きょうは']
+    suggestions = index.suggest('きょう', limit=5)
+    assert suggestions[:3] == ['きょう', 'きょうは', 'きょうも']
+    assert 'きのう' in suggestions[3:]
+
+
+def test_suggest_falls_back_to_fuzzy_matches():
+    index = StartWordIndex.build(WORDS)
+
+    assert index.suggest('あしたは')[0] == 'あした'
+    assert index.suggest('') == []
+
+
+def test_round_trip():
+    index = StartWordIndex.build(WORDS)
+    loaded = StartWordIndex.from_bytes(index.to_bytes())
+
+    assert loaded.words == index.words
+    assert loaded.suggest('きょ') == index.suggest('きょ')